@@ -8,7 +8,9 @@ import soundfile as sf
 import torch
 
 from encoder import inference as encoder
+from encoder.embedding_cache import EmbeddingCache
 from encoder.params_model import model_embedding_size as speaker_embedding_size
+from synthesizer.encoder_output_cache import EncoderOutputCache
 from synthesizer.inference import Synthesizer
 from utils.argutils import print_args
 from utils.default_models import ensure_default_models
@@ -34,6 +36,9 @@ if __name__ == '__main__':
         "If True, audio won't be played.")
     parser.add_argument("--seed", type=int, default=None, help=\
         "Optional random number seed value to make toolbox deterministic.")
+    parser.add_argument("--embed_cache_dir", type=Path, default=None, help=\
+        "Optional directory of a cache of embeddings. Voices that were already cloned will not "
+        "go through the encoder again.")
     args = parser.parse_args()
     arg_dict = vars(args)
     print_args(args, parser)
@@ -63,7 +68,13 @@ if __name__ == '__main__':
     print("Preparing the encoder, the synthesizer and the vocoder...")
     ensure_default_models(Path("saved_models"))
     encoder.load_model(args.enc_model_fpath)
-    synthesizer = Synthesizer(args.syn_model_fpath)
+    embed_cache = None
+    if args.embed_cache_dir is not None:
+        embed_cache = EmbeddingCache(args.embed_cache_dir, args.enc_model_fpath)
+    # With a seed, the encoder outputs of the texts are cached across the reloads of the
+    # synthesizer, which only reuses them when the same text is synthesized again
+    syn_cache = EncoderOutputCache() if args.seed is not None else None
+    synthesizer = Synthesizer(args.syn_model_fpath, cache=syn_cache)
     vocoder.load_model(args.voc_model_fpath)
 
 
@@ -125,23 +136,31 @@ if __name__ == '__main__':
                       "wav, m4a, flac, ...):\n"
             in_fpath = Path(input(message).replace("\"", "").replace("\'", ""))
 
-            ## Computing the embedding
-            # First, we load the wav using the function that the speaker encoder provides. This is
-            # important: there is preprocessing that must be applied.
-
-            # The following two methods are equivalent:
-            # - Directly load from the filepath:
-            preprocessed_wav = encoder.preprocess_wav(in_fpath)
-            # - If the wav is already loaded:
-            original_wav, sampling_rate = librosa.load(str(in_fpath))
-            preprocessed_wav = encoder.preprocess_wav(original_wav, sampling_rate)
-            print("Loaded file succesfully")
-
-            # Then we derive the embedding. There are many functions and parameters that the
-            # speaker encoder interfaces. These are mostly for in-depth research. You will typically
-            # only use this function (with its default parameters):
-            embed = encoder.embed_utterance(preprocessed_wav)
-            print("Created the embedding")
+            # If you use an embedding cache, you can retrieve the embedding of a voice that was
+            # already cloned without preprocessing the audio nor running the encoder.
+            embed = embed_cache.get(in_fpath) if embed_cache is not None else None
+            if embed is not None:
+                print("Retrieved the embedding from the cache")
+            else:
+                ## Computing the embedding
+                # First, we load the wav using the function that the speaker encoder provides. This
+                # is important: there is preprocessing that must be applied.
+
+                # The following two methods are equivalent:
+                # - Directly load from the filepath:
+                preprocessed_wav = encoder.preprocess_wav(in_fpath)
+                # - If the wav is already loaded:
+                original_wav, sampling_rate = librosa.load(str(in_fpath))
+                preprocessed_wav = encoder.preprocess_wav(original_wav, sampling_rate)
+                print("Loaded file succesfully")
+
+                # Then we derive the embedding. There are many functions and parameters that the
+                # speaker encoder interfaces. These are mostly for in-depth research. You will
+                # typically only use this function (with its default parameters):
+                embed = encoder.embed_utterance(preprocessed_wav)
+                print("Created the embedding")
+                if embed_cache is not None:
+                    embed_cache.put(in_fpath, embed)
 
 
             ## Generating the spectrogram
@@ -150,7 +169,7 @@ if __name__ == '__main__':
             # If seed is specified, reset torch seed and force synthesizer reload
             if args.seed is not None:
                 torch.manual_seed(args.seed)
-                synthesizer = Synthesizer(args.syn_model_fpath)
+                synthesizer = Synthesizer(args.syn_model_fpath, cache=syn_cache)
 
             # The synthesizer works in batch, so you need to put your data in a list or numpy array
             texts = [text]
@@ -22,6 +22,9 @@ if __name__ == '__main__':
         "If True, all inference will be done on CPU")
     parser.add_argument("--seed", type=int, default=None, help=\
         "Optional random number seed value to make toolbox deterministic.")
+    parser.add_argument("--embed_cache_dir", type=Path, default=None, help=\
+        "Optional directory of a cache of embeddings. Utterances that were already embedded "
+        "will not go through the encoder again.")
     args = parser.parse_args()
     arg_dict = vars(args)
     print_args(args, parser)
@@ -1,11 +1,11 @@
 from scipy.ndimage.morphology import binary_dilation
 from encoder.params_data import *
 from pathlib import Path
-from typing import Optional, Union
+from typing import List, Optional, Union
 from warnings import warn
 import numpy as np
+import scipy.fft
 import librosa
-import struct
 
 try:
     import webrtcvad
@@ -15,11 +15,18 @@ except:
 
 int16_max = (2 ** 15) - 1
 
+# Mel filterbank and STFT window, see mel_spectrogram_windows()
+_mel_basis = None
+_fft_window = None
+# Maximum number of frames whose FFT is computed at once in wavs_to_mel_spectrograms()
+_max_fft_batch_size = 256
+
 
 def preprocess_wav(fpath_or_wav: Union[str, Path, np.ndarray],
                    source_sr: Optional[int] = None,
                    normalize: Optional[bool] = True,
-                   trim_silence: Optional[bool] = True):
+                   trim_silence: Optional[bool] = True,
+                   vad_backend: Optional[str] = None):
     """
     Applies the preprocessing operations used in training the Speaker Encoder to a waveform 
     either on disk or in memory. The waveform will be resampled to match the data hyperparameters.
@@ -30,6 +37,8 @@ def preprocess_wav(fpath_or_wav: Union[str, Path, np.ndarray],
     preprocessing. After preprocessing, the waveform's sampling rate will match the data 
     hyperparameters. If passing a filepath, the sampling rate will be automatically detected and 
     this argument will be ignored.
+    :param vad_backend: the voice detection used to trim silences, see trim_long_silences(). If 
+    None, silences are only trimmed when webrtcvad is installed.
     """
     # Load the wav from disk if needed
     if isinstance(fpath_or_wav, str) or isinstance(fpath_or_wav, Path):
@@ -44,8 +53,8 @@ def preprocess_wav(fpath_or_wav: Union[str, Path, np.ndarray],
     # Apply the preprocessing: normalize volume and shorten long silences 
     if normalize:
         wav = normalize_volume(wav, audio_norm_target_dBFS, increase_only=True)
-    if webrtcvad and trim_silence:
-        wav = trim_long_silences(wav)
+    if trim_silence and (webrtcvad or vad_backend is not None):
+        wav = trim_long_silences(wav, vad_backend)
     
     return wav
 
@@ -65,31 +74,95 @@ def wav_to_mel_spectrogram(wav):
     return frames.astype(np.float32).T
 
 
-def trim_long_silences(wav):
+def wavs_to_mel_spectrograms(wavs: List[np.ndarray]):
+    """
+    Derives the mel spectrograms of several preprocessed audio waveforms at once, without 
+    librosa. The filterbank and the STFT window are computed once per process, the waveforms are 
+    concatenated so that their frames are views of a single buffer, and the FFTs of these frames 
+    are computed in large batches. This is several times faster than calling 
+    wav_to_mel_spectrogram() on each waveform.
+
+    The frames match those of wav_to_mel_spectrogram() up to floating point precision: the 
+    absolute difference is below 1e-5 times the largest value of the spectrogram.
+
+    :param wavs: the waveforms as a list of numpy arrays of floats
+    :return: the mel spectrograms as a list of numpy arrays of float32 of shape (n_frames, 
+    mel_n_channels), like wav_to_mel_spectrogram() returns.
+    """
+    n_fft = int(sampling_rate * mel_window_length / 1000)
+    hop_length = int(sampling_rate * mel_window_step / 1000)
+    if len(wavs) == 0:
+        return []
+
+    # Pad the waveforms by reflection as librosa does, and align each of them on a frame so that
+    # all frames are at a multiple of the hop length in the buffer
+    n_frames = [1 + len(wav) // hop_length for wav in wavs]
+    buffer_lengths = [int(np.ceil((len(wav) + n_fft) / hop_length)) * hop_length for wav in wavs]
+    offsets = np.concatenate(([0], np.cumsum(buffer_lengths)))
+    buffer = np.zeros(offsets[-1] + n_fft, dtype=np.float32)
+    for wav, offset in zip(wavs, offsets):
+        padded = np.pad(wav, n_fft // 2, "reflect")
+        buffer[offset:offset + len(padded)] = padded
+
+    # Compute the frames of the buffer, including a few discarded ones between waveforms
+    windows = np.lib.stride_tricks.as_strided(
+        buffer,
+        shape=((len(buffer) - n_fft) // hop_length + 1, n_fft),
+        strides=(hop_length * buffer.strides[0], buffer.strides[0]),
+        writeable=False,
+    )
+    frames = np.concatenate([mel_spectrogram_windows(windows[i:i + _max_fft_batch_size])
+                             for i in range(0, len(windows), _max_fft_batch_size)])
+
+    return [frames[offset // hop_length:offset // hop_length + n]
+            for offset, n in zip(offsets, n_frames)]
+
+
+def mel_spectrogram_windows(windows):
+    """
+    Derives mel spectrogram frames from windows of a waveform, each of length 
+    <mel_window_length> and centered on a frame. This gives the same frames as 
+    wav_to_mel_spectrogram() for the windows it would use, which is useful when the waveform is 
+    not available at once (e.g. when streaming).
+
+    :param windows: the windows as a numpy array of floats of shape (n_frames, n_fft)
+    :return: the frames as a numpy array of float32 of shape (n_frames, mel_n_channels)
+    """
+    global _mel_basis, _fft_window
+    if _mel_basis is None:
+        n_fft = int(sampling_rate * mel_window_length / 1000)
+        _mel_basis = librosa.filters.mel(sampling_rate, n_fft, n_mels=mel_n_channels).T.copy()
+        _fft_window = np.hanning(n_fft + 1)[:-1].astype(np.float32)
+
+    power = np.abs(scipy.fft.rfft(windows * _fft_window, axis=1)) ** 2
+    return (power @ _mel_basis).astype(np.float32)
+
+
+def trim_long_silences(wav, vad_backend: Optional[str] = None):
     """
     Ensures that segments without voice in the waveform remain no longer than a 
     threshold determined by the VAD parameters in params.py.
 
     :param wav: the raw waveform as a numpy array of floats 
+    :param vad_backend: either "webrtc" to detect voice with webrtcvad or "energy" to detect it 
+    from the energy and the spectral flatness of the waveform, which requires no additional 
+    package. If None, defaults to "webrtc" if webrtcvad is installed and to "energy" otherwise.
     :return: the same waveform with silences trimmed away (length <= original wav length)
     """
+    if vad_backend is None:
+        vad_backend = "webrtc" if webrtcvad else "energy"
+    if vad_backend not in _vad_backends:
+        raise ValueError("Unknown VAD backend \"%s\", use one of %s" %
+                         (vad_backend, list(_vad_backends)))
+
     # Compute the voice detection window size
     samples_per_window = (vad_window_length * sampling_rate) // 1000
     
     # Trim the end of the audio to have a multiple of the window size
     wav = wav[:len(wav) - (len(wav) % samples_per_window)]
     
-    # Convert the float waveform to 16-bit mono PCM
-    pcm_wave = struct.pack("%dh" % len(wav), *(np.round(wav * int16_max)).astype(np.int16))
-    
     # Perform voice activation detection
-    voice_flags = []
-    vad = webrtcvad.Vad(mode=3)
-    for window_start in range(0, len(wav), samples_per_window):
-        window_end = window_start + samples_per_window
-        voice_flags.append(vad.is_speech(pcm_wave[window_start * 2:window_end * 2],
-                                         sample_rate=sampling_rate))
-    voice_flags = np.array(voice_flags)
+    voice_flags = _vad_backends[vad_backend](wav, samples_per_window)
     
     # Smooth the voice detection with a moving average
     def moving_average(array, width):
@@ -99,7 +172,7 @@ def trim_long_silences(wav):
         return ret[width - 1:] / width
     
     audio_mask = moving_average(voice_flags, vad_moving_average_width)
-    audio_mask = np.round(audio_mask).astype(np.bool)
+    audio_mask = np.round(audio_mask).astype(bool)
     
     # Dilate the voiced regions
     audio_mask = binary_dilation(audio_mask, np.ones(vad_max_silence_length + 1))
@@ -108,6 +181,45 @@ def trim_long_silences(wav):
     return wav[audio_mask == True]
 
 
+def _webrtc_voice_flags(wav, samples_per_window):
+    # Convert the float waveform to 16-bit mono PCM. The buffer is then sliced through a
+    # memoryview so that the windows are not copied.
+    pcm_wave = memoryview((np.round(wav * int16_max)).astype(np.int16).tobytes())
+    
+    # A new VAD per waveform, so that its output does not depend on the waveforms processed
+    # before, and that threads never share one
+    vad = webrtcvad.Vad(3)
+    bytes_per_window = samples_per_window * 2
+    voice_flags = [vad.is_speech(pcm_wave[i:i + bytes_per_window], sample_rate=sampling_rate)
+                   for i in range(0, len(pcm_wave), bytes_per_window)]
+    return np.array(voice_flags, dtype=bool)
+
+
+def _energy_voice_flags(wav, samples_per_window):
+    # Cut the waveform in non-overlapping windows, without copying it
+    windows = wav.reshape(-1, samples_per_window)
+    if len(windows) == 0:
+        return np.zeros(0, dtype=bool)
+    
+    # Voiced windows are loud enough with regard to the noise floor of the waveform...
+    energy_dB = 10 * np.log10(np.mean(windows ** 2, axis=1) + 1e-10)
+    noise_floor_dB = np.percentile(energy_dB, 10)
+    loud = energy_dB > noise_floor_dB + vad_energy_threshold_dB
+    
+    # ... and have a harmonic spectrum, whereas noise has a flat one
+    spectrum = np.abs(np.fft.rfft(windows * np.hanning(samples_per_window), axis=1)) ** 2 + 1e-10
+    flatness = np.exp(np.mean(np.log(spectrum), axis=1)) / np.mean(spectrum, axis=1)
+    harmonic = flatness < vad_energy_max_flatness
+    
+    return loud & harmonic
+
+
+_vad_backends = {
+    "webrtc": _webrtc_voice_flags,
+    "energy": _energy_voice_flags,
+}
+
+
 def normalize_volume(wav, target_dBFS, increase_only=False, decrease_only=False):
     if increase_only and decrease_only:
         raise ValueError("Both increase only and decrease only are set")
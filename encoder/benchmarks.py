@@ -0,0 +1,440 @@
+"""
+Micro-benchmarks of the encoder. Run with:
+    python -m encoder.benchmarks [audio files...] [-e encoder.pt] [-d held_out_root]
+                                 [-p packed_root]
+Without audio files, random waveforms are used. The benchmarks of the model only run when its
+weights are given.
+"""
+from encoder.data_objects import SpeakerVerificationDataset, SpeakerVerificationDataLoader, \
+    BatchPrefetcher
+from encoder.data_objects.speaker_batch import SpeakerBatch
+from encoder.data_objects.frame_cache import FrameCache
+from encoder.params_data import *
+from encoder.model import SpeakerEncoder, equal_error_rate
+from encoder.params_model import model_embedding_size
+from scipy.interpolate import interp1d
+from scipy.ndimage.morphology import binary_dilation
+from sklearn.metrics import roc_curve
+from scipy.optimize import brentq
+from encoder import audio, inference
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter as timer
+from pathlib import Path
+from typing import List
+import numpy as np
+import tempfile
+import struct
+import argparse
+import random
+import torch
+
+
+def _time(func, n_runs):
+    # Warm up (caches, lazy imports) before timing
+    func()
+    start = timer()
+    for _ in range(n_runs):
+        func()
+    return (timer() - start) / n_runs
+
+
+def _random_wavs(n_wavs=64, min_duration=1, max_duration=8):
+    lengths = np.random.randint(min_duration * sampling_rate, max_duration * sampling_rate, n_wavs)
+    return [(np.random.randn(n) * 0.1).astype(np.float32) for n in lengths]
+
+
+def benchmark_mel_frontends(wavs=None, n_runs=3):
+    """
+    Compares the throughput in frames per second of wav_to_mel_spectrogram() and of
+    wavs_to_mel_spectrograms(), and the largest difference between their outputs relative to the
+    largest value of the spectrograms.
+    """
+    wavs = _random_wavs() if wavs is None else wavs
+    reference = [audio.wav_to_mel_spectrogram(wav) for wav in wavs]
+    n_frames = sum(len(frames) for frames in reference)
+    error = max(np.abs(ref - frames).max() / np.abs(ref).max() for ref, frames in
+                zip(reference, audio.wavs_to_mel_spectrograms(wavs)))
+
+    print("Mel frontends on %d waveforms (%d frames):" % (len(wavs), n_frames))
+    frontends = {
+        "librosa (wav_to_mel_spectrogram)":
+            lambda: [audio.wav_to_mel_spectrogram(wav) for wav in wavs],
+        "numpy, one call per waveform":
+            lambda: [audio.wavs_to_mel_spectrograms([wav]) for wav in wavs],
+        "numpy, one call for all waveforms":
+            lambda: audio.wavs_to_mel_spectrograms(wavs),
+    }
+    for name, func in frontends.items():
+        print("  %s: %d frames/s" % (name, n_frames / _time(func, n_runs)))
+    print("  Max relative difference: %.2e" % error)
+
+
+def _reference_trim_long_silences(wav):
+    # trim_long_silences() before the VAD backends: the waveform is converted with struct.pack()
+    # and each window is copied
+    samples_per_window = (vad_window_length * sampling_rate) // 1000
+    wav = wav[:len(wav) - (len(wav) % samples_per_window)]
+    pcm_wave = struct.pack("%dh" % len(wav), *(np.round(wav * audio.int16_max)).astype(np.int16))
+    voice_flags = []
+    vad = audio.webrtcvad.Vad(mode=3)
+    for window_start in range(0, len(wav), samples_per_window):
+        window_end = window_start + samples_per_window
+        voice_flags.append(vad.is_speech(pcm_wave[window_start * 2:window_end * 2],
+                                         sample_rate=sampling_rate))
+    voice_flags = np.array(voice_flags)
+
+    def moving_average(array, width):
+        array_padded = np.concatenate((np.zeros((width - 1) // 2), array, np.zeros(width // 2)))
+        ret = np.cumsum(array_padded, dtype=float)
+        ret[width:] = ret[width:] - ret[:-width]
+        return ret[width - 1:] / width
+
+    audio_mask = moving_average(voice_flags, vad_moving_average_width)
+    audio_mask = np.round(audio_mask).astype(bool)
+    audio_mask = binary_dilation(audio_mask, np.ones(vad_max_silence_length + 1))
+    audio_mask = np.repeat(audio_mask, samples_per_window)
+    return wav[audio_mask == True]
+
+
+def benchmark_vad(wavs=None, n_runs=3):
+    """
+    Compares the throughput in seconds of audio per second of the VAD backends of
+    trim_long_silences(), and of the webrtc VAD as it was called before, with struct.pack().
+    Reports whether the webrtc backend trims the waveforms as before.
+    """
+    wavs = _random_wavs() if wavs is None else wavs
+    duration = sum(len(wav) for wav in wavs) / sampling_rate
+
+    print("VAD backends on %.0f seconds of audio:" % duration)
+    backends = {
+        "energy": lambda: [audio.trim_long_silences(wav, "energy") for wav in wavs],
+    }
+    if audio.webrtcvad:
+        backends["webrtc"] = lambda: [audio.trim_long_silences(wav, "webrtc") for wav in wavs]
+        backends["webrtc, struct.pack (previous)"] = \
+            lambda: [_reference_trim_long_silences(wav) for wav in wavs]
+    for name, func in backends.items():
+        print("  %s: %.0fx real time" % (name, duration / _time(func, n_runs)))
+    if audio.webrtcvad:
+        same = all(np.array_equal(audio.trim_long_silences(wav, "webrtc"),
+                                  _reference_trim_long_silences(wav)) for wav in wavs)
+        print("  webrtc output identical to the previous one: %s" % same)
+
+
+def benchmark_sliding_lstm(wavs=None, n_runs=3):
+    """
+    Compares the exact partial embeddings of embed_utterance() with those approximated in a
+    single pass of the LSTM (sliding=True): the time taken and the cosine similarity between
+    the embeddings of both modes. The model must be loaded.
+    """
+    wavs = _random_wavs(16, 8, 60) if wavs is None else wavs
+    duration = sum(len(wav) for wav in wavs) / sampling_rate
+
+    print("Sliding LSTM on %.0f seconds of audio:" % duration)
+    with torch.no_grad():
+        for sliding in [False, True]:
+            func = lambda: [inference.embed_utterance(wav, sliding=sliding) for wav in wavs]
+            print("  %s: %.0fx real time" % ("sliding" if sliding else "exact",
+                                             duration / _time(func, n_runs)))
+
+        embeds_sim, partials_sim = [], []
+        for wav in wavs:
+            exact, exact_partials, _ = inference.embed_utterance(wav, return_partials=True)
+            approx, approx_partials, _ = inference.embed_utterance(wav, return_partials=True,
+                                                                   sliding=True)
+            embeds_sim.append(np.dot(exact, approx))
+            partials_sim.extend(np.sum(exact_partials * approx_partials, axis=1))
+    print("  Cosine similarity of the utterance embeddings: mean %.4f, min %.4f" %
+          (np.mean(embeds_sim), np.min(embeds_sim)))
+    print("  Cosine similarity of the partial embeddings: mean %.4f, min %.4f" %
+          (np.mean(partials_sim), np.min(partials_sim)))
+
+
+def benchmark_datasets(clean_data_roots: List[Path], speakers_per_batch=64,
+                       utterances_per_speaker=10, n_batches=20):
+    """
+    Compares the throughput in batches per second of SpeakerBatch on several datasets, e.g.
+    the output of the preprocessing and the same dataset packed by pack_dataset(). Run it on a
+    cold page cache to measure the reads from the disk.
+    """
+    print("Datasets, %d speakers per batch and %d utterances per speaker:" %
+          (speakers_per_batch, utterances_per_speaker))
+    for clean_data_root in clean_data_roots:
+        dataset = SpeakerVerificationDataset(clean_data_root)
+        def func():
+            speakers = [next(dataset.speaker_cycler) for _ in range(speakers_per_batch)]
+            SpeakerBatch(speakers, utterances_per_speaker, partials_n_frames)
+        print("  %s: %.1f batches/s" % (clean_data_root, 1 / _time(func, n_batches)))
+
+
+def benchmark_speaker_pool(clean_data_root: Path, pool_size=256, pool_reuse=20,
+                           speakers_per_batch=64, utterances_per_speaker=10, n_batches=100):
+    """
+    Compares the sampling of speakers with and without a speaker pool: the throughput in
+    batches per second, the hit rate of the frame cache and the bytes read per batch. Without a
+    pool, the bytes read are those of the utterances sampled.
+    """
+    print("Speaker pool of %d speakers sampled %d times, %d speakers per batch:" %
+          (pool_size, pool_reuse, speakers_per_batch))
+    for pool in [0, pool_size]:
+        dataset = SpeakerVerificationDataset(clean_data_root, pool, pool_reuse,
+                                             speakers_per_batch=speakers_per_batch)
+        cache = dataset.frame_cache if pool else FrameCache(0)
+        hits, misses, bytes_read = 0, 0, 0
+        start = timer()
+        for i in range(n_batches):
+            speakers = [dataset[i * speakers_per_batch + j] for j in range(speakers_per_batch)]
+            stats = SpeakerBatch(speakers, utterances_per_speaker, partials_n_frames,
+                                 cache).cache_stats
+            hits, misses = hits + stats["hits"], misses + stats["misses"]
+            bytes_read += stats["bytes_read"]
+        duration = timer() - start
+        print("  %s: %.1f batches/s, hit rate %.1f%%, %.1fMB read per batch" %
+              ("pool" if pool else "no pool", n_batches / duration, 100 * hits / (hits + misses),
+               bytes_read / n_batches / 1e6))
+
+
+def benchmark_prefetching(clean_data_root: Path, speakers_per_batch=64, utterances_per_speaker=10,
+                          num_workers=4, n_steps=30):
+    """
+    Measures the time the training loop blocks waiting for the next batch on the device, as the
+    "waiting for batch" and "data to device" ticks of the profiler of train(), with the batches
+    copied to the device in the loop and with a BatchPrefetcher. Each step runs the forward and
+    backward passes of a SpeakerEncoder.
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = SpeakerEncoder(device, device)
+    dataset = SpeakerVerificationDataset(clean_data_root)
+    print("Prefetching on %s, %d speakers per batch, %d workers:" %
+          (device, speakers_per_batch, num_workers))
+    for prefetch in [False, True]:
+        loader = SpeakerVerificationDataLoader(dataset, speakers_per_batch, utterances_per_speaker,
+                                               num_workers=num_workers)
+        if prefetch:
+            batches = iter(BatchPrefetcher(loader, device))
+        else:
+            batches = ((batch, torch.from_numpy(batch.data).to(device)) for batch in loader)
+
+        # The first batches are ready before the first step, skip them
+        wait_duration, step_duration = 0, 0
+        for step in range(num_workers + n_steps):
+            start = timer()
+            _, inputs = next(batches)
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            wait = timer() - start
+            embeds = model(inputs).view((speakers_per_batch, utterances_per_speaker, -1))
+            loss, _ = model.loss(embeds, compute_eer=False)
+            model.zero_grad()
+            loss.backward()
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            if step >= num_workers:
+                wait_duration += wait
+                step_duration += timer() - start - wait
+        batches.close()
+        print("  %s: %.1fms waiting for the batch, %.1fms for the training step" %
+              ("prefetcher" if prefetch else "no prefetcher", wait_duration / n_steps * 1000,
+               step_duration / n_steps * 1000))
+
+
+def _reference_similarity_matrix(model: SpeakerEncoder, embeds):
+    # The loop over speakers that SpeakerEncoder.similarity_matrix() replaced
+    speakers_per_batch, utterances_per_speaker = embeds.shape[:2]
+    centroids_incl = torch.mean(embeds, dim=1, keepdim=True)
+    centroids_incl = centroids_incl.clone() / (torch.norm(centroids_incl, dim=2, keepdim=True) + 1e-5)
+    centroids_excl = (torch.sum(embeds, dim=1, keepdim=True) - embeds)
+    centroids_excl /= (utterances_per_speaker - 1)
+    centroids_excl = centroids_excl.clone() / (torch.norm(centroids_excl, dim=2, keepdim=True) + 1e-5)
+    sim_matrix = torch.zeros(speakers_per_batch, utterances_per_speaker,
+                             speakers_per_batch).to(embeds.device)
+    mask_matrix = 1 - np.eye(speakers_per_batch, dtype=np.int)
+    for j in range(speakers_per_batch):
+        mask = np.where(mask_matrix[j])[0]
+        sim_matrix[mask, :, j] = (embeds[mask] * centroids_incl[j]).sum(dim=2)
+        sim_matrix[j, :, j] = (embeds[j] * centroids_excl[j]).sum(dim=1)
+    return sim_matrix * model.similarity_weight + model.similarity_bias
+
+
+def _reference_eer(sim_matrix, utterances_per_speaker):
+    # The computation of the EER with sklearn that SpeakerEncoder.loss() replaced
+    speakers_per_batch = sim_matrix.shape[1]
+    labels = np.repeat(np.eye(speakers_per_batch), utterances_per_speaker, axis=0)
+    fpr, tpr, thresholds = roc_curve(labels.flatten(), sim_matrix.detach().cpu().numpy().flatten())
+    return brentq(lambda x: 1. - x - interp1d(fpr, tpr)(x), 0., 1.)
+
+
+def benchmark_loss(speakers_per_batch_sizes=(16, 64, 128, 256), utterances_per_speaker=10,
+                   n_runs=10):
+    """
+    Compares the time taken by the GE2E loss (forward and backward) and its EER on each device,
+    for several numbers of speakers per batch, with the loop over speakers and the sklearn EER
+    they replaced. Also checks that both give the same results.
+    """
+    devices = [torch.device("cpu")] + ([torch.device("cuda")] if torch.cuda.is_available() else [])
+
+    print("GE2E loss with %d utterances per speaker:" % utterances_per_speaker)
+    for speakers_per_batch in speakers_per_batch_sizes:
+        # Embeddings of speakers with some structure, so that the EER is meaningful
+        centers = torch.randn(speakers_per_batch, 1, model_embedding_size)
+        embeds = centers + torch.randn(speakers_per_batch, utterances_per_speaker,
+                                       model_embedding_size) * 2
+        embeds = embeds / torch.norm(embeds, dim=2, keepdim=True)
+
+        for device in devices:
+            model = SpeakerEncoder(device, device)
+            inputs = embeds.to(device).requires_grad_()
+            def sync_after(func):
+                func()
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+            loss_new = lambda: model.loss(inputs, compute_eer=False)[0].backward()
+            loss_ref = lambda: model.loss_fn(
+                _reference_similarity_matrix(model, inputs).flatten(0, 1),
+                torch.arange(speakers_per_batch, device=device).repeat_interleave(
+                    utterances_per_speaker)).backward()
+            sim_matrix = model.similarity_matrix(inputs).flatten(0, 1).detach()
+            labels = torch.eye(speakers_per_batch, dtype=torch.bool, device=device)
+            labels = labels.repeat_interleave(utterances_per_speaker, dim=0)
+            eer_new = lambda: equal_error_rate(sim_matrix.flatten(), labels.flatten())
+            eer_ref = lambda: _reference_eer(sim_matrix, utterances_per_speaker)
+
+            difference = (model.similarity_matrix(inputs) -
+                          _reference_similarity_matrix(model, inputs)).abs().max().item()
+            print("  %d speakers on %s: loss %.2fms (loop %.2fms), EER %.2fms (sklearn %.2fms), "
+                  "max difference of the similarities %.1e, EER %.5f (sklearn %.5f)" %
+                  (speakers_per_batch, device.type,
+                   _time(lambda: sync_after(loss_new), n_runs) * 1000,
+                   _time(lambda: sync_after(loss_ref), n_runs) * 1000,
+                   _time(lambda: sync_after(eer_new), n_runs) * 1000,
+                   _time(eer_ref, n_runs) * 1000, difference, eer_new(), eer_ref()))
+
+
+def benchmark_backends(weights_fpath: Path, clean_data_root: Path = None, n_speakers=64,
+                       utterances_per_speaker=10, n_runs=3):
+    """
+    Compares the backends of load_model() on a single CPU core: their throughput in partial
+    utterances per second, the cosine similarity of their embeddings with those of the eager
+    fp32 model, and their EER.
+
+    :param weights_fpath: the path to saved model weights.
+    :param clean_data_root: a held-out set of utterances, in the format of the output of
+    encoder_preprocess.py. If None, random frames are used, for which the EER is meaningless.
+    :param n_speakers: the number of speakers to sample from the held-out set.
+    :param utterances_per_speaker: the number of partial utterances to sample per speaker.
+    """
+    if clean_data_root is not None:
+        speakers = SpeakerVerificationDataset(clean_data_root).speakers
+        speakers = random.sample(speakers, min(n_speakers, len(speakers)))
+        frames = SpeakerBatch(speakers, utterances_per_speaker, partials_n_frames).data
+    else:
+        frames = np.random.rand(n_speakers * utterances_per_speaker, partials_n_frames,
+                                mel_n_channels).astype(np.float32)
+    n_speakers = len(frames) // utterances_per_speaker
+
+    # The EER is computed as during training
+    cpu = torch.device("cpu")
+    loss_model = SpeakerEncoder(cpu, cpu)
+    def eer(embeds):
+        embeds = torch.from_numpy(embeds).view(n_speakers, utterances_per_speaker, -1)
+        return loss_model.loss(embeds)[1]
+
+    n_threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    print("Encoder backends on %d partial utterances of %d speakers (1 CPU core):" %
+          (len(frames), n_speakers))
+    with tempfile.TemporaryDirectory() as export_dir, torch.no_grad():
+        fp32_fpath = Path(export_dir, "encoder_fp32.pt")
+        int8_fpath = Path(export_dir, "encoder_int8.pt")
+        inference.export_model(weights_fpath, fp32_fpath)
+        inference.export_model(weights_fpath, int8_fpath, quantize=True)
+        backends = [
+            ("eager fp32", weights_fpath, "eager"),
+            ("eager int8", weights_fpath, "int8"),
+            ("torchscript fp32", fp32_fpath, "torchscript"),
+            ("torchscript int8", int8_fpath, "torchscript"),
+        ]
+
+        reference = None
+        for name, fpath, backend in backends:
+            inference.load_model(fpath, cpu, backend)
+            embeds = inference.embed_frames_batch(frames)
+            reference = embeds if reference is None else reference
+            similarity = np.sum(embeds * reference, axis=1)
+            duration = _time(lambda: inference.embed_frames_batch(frames), n_runs)
+            print("  %s: %.0f partials/s, similarity to fp32: mean %.4f min %.4f, EER %.4f" %
+                  (name, len(frames) / duration, np.mean(similarity), np.min(similarity),
+                   eer(embeds)))
+    torch.set_num_threads(n_threads)
+
+
+def benchmark_loading(weights_fpath: Path, n_runs=3):
+    """
+    Compares the time taken by load_model() to load the model from its training checkpoint and
+    from the slim inference checkpoint of convert_model(), on the CPU and on the GPU if there
+    is one.
+    """
+    devices = ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+
+    print("Loading of the encoder:")
+    with tempfile.TemporaryDirectory() as export_dir:
+        slim_fpath = Path(export_dir, "encoder.safetensors")
+        inference.convert_model(weights_fpath, slim_fpath)
+        for name, fpath in [("training checkpoint", weights_fpath), ("slim", slim_fpath)]:
+            for device in devices:
+                func = lambda: inference.EncoderSession(fpath, device)
+                print("  %s (%.1fMB) on %s: %.1fms" % (name, fpath.stat().st_size / 1e6, device,
+                                                      _time(func, n_runs) * 1000))
+
+
+def benchmark_session(weights_fpath: Path, wavs=None, n_clients=16, batch_window=0.005,
+                      n_runs=3):
+    """
+    Compares the throughput in utterances per second of an EncoderSession that serves
+    <n_clients> concurrent callers of embed_utterance(), with and without merging their batches.
+    """
+    wavs = _random_wavs(256, 1, 4) if wavs is None else wavs
+
+    print("Encoder session with %d concurrent clients on %d utterances:" % (n_clients, len(wavs)))
+    with ThreadPoolExecutor(n_clients) as pool:
+        for window in [None, batch_window]:
+            with inference.EncoderSession(weights_fpath, batch_window=window) as session:
+                func = lambda: list(pool.map(session.embed_utterance, wavs))
+                duration = _time(func, n_runs)
+                print("  batch window %s: %.0f utterances/s, %.1f requests per forward pass" %
+                      ("none" if window is None else "%.0fms" % (window * 1000),
+                       len(wavs) / duration, session.n_requests / session.n_forwards))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Runs micro-benchmarks of the encoder.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("fpaths", type=Path, nargs="*", help=\
+        "Audio files to run the benchmarks on. If none are given, random waveforms are used.")
+    parser.add_argument("-e", "--enc_model_fpath", type=Path, default=None, help=\
+        "Path to a saved encoder, to also run the benchmarks of the model.")
+    parser.add_argument("-d", "--clean_data_root", type=Path, default=None, help=\
+        "Path to a held-out set in the format of the output of encoder_preprocess.py, to "
+        "evaluate the accuracy of the backends of the model and the speed of the data loading.")
+    parser.add_argument("-p", "--packed_data_root", type=Path, default=None, help=\
+        "Path to the same dataset packed by encoder_pack.py, to compare the speed of the data "
+        "loading in both formats.")
+    args = parser.parse_args()
+
+    wavs = [audio.preprocess_wav(fpath, trim_silence=False) for fpath in args.fpaths] or None
+    benchmark_mel_frontends(wavs)
+    benchmark_loss()
+    benchmark_vad(wavs)
+    roots = [root for root in [args.clean_data_root, args.packed_data_root] if root is not None]
+    if len(roots) > 0:
+        benchmark_datasets(roots)
+        benchmark_speaker_pool(roots[-1])
+        benchmark_prefetching(roots[-1])
+    if args.enc_model_fpath is not None:
+        benchmark_loading(args.enc_model_fpath)
+        benchmark_backends(args.enc_model_fpath, args.clean_data_root)
+        inference.load_model(args.enc_model_fpath)
+        benchmark_sliding_lstm(wavs)
+        benchmark_session(args.enc_model_fpath, wavs)
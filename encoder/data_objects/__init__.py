@@ -1,2 +1,3 @@
 from encoder.data_objects.speaker_verification_dataset import SpeakerVerificationDataset
 from encoder.data_objects.speaker_verification_dataset import SpeakerVerificationDataLoader
+from encoder.data_objects.batch_prefetcher import BatchPrefetcher
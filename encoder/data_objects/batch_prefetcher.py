@@ -0,0 +1,98 @@
+from threading import Thread, Event
+from queue import Queue, Empty, Full
+import torch
+
+
+class BatchPrefetcher:
+    """
+    Iterates over the speaker batches of a loader while a background thread keeps the next
+    batches ready on the device of the model. The thread receives the batches from the workers of
+    the loader, and on GPU copies their frames to a rotation of pinned buffers and from there to
+    the device on a separate CUDA stream, so that both copies overlap the training step. Each
+    item is a tuple (speaker_batch, inputs) where inputs are the frames of the batch on the
+    device.
+    """
+    def __init__(self, loader, device: torch.device, n_batches=2):
+        """
+        :param loader: an iterable of SpeakerBatch, e.g. a SpeakerVerificationDataLoader
+        :param device: the device to copy the frames to
+        :param n_batches: the number of batches kept ready ahead of the one being trained on
+        """
+        if n_batches < 1:
+            raise ValueError("At least one batch must be prefetched, got %d" % n_batches)
+        self.loader = loader
+        self.device = device
+        self.n_batches = n_batches
+
+    def __iter__(self):
+        queue = Queue(self.n_batches)
+        stop = Event()
+        thread = Thread(target=self._prefetch, args=(queue, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = queue.get()
+                if isinstance(item, BaseException):
+                    raise item
+                if item is None:
+                    return
+                speaker_batch, inputs, copied = item
+                if copied is not None:
+                    # Order the training step after the copy, and keep the memory of the inputs
+                    # from being reused by the copy stream while they are in use
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(copied)
+                    inputs.record_stream(stream)
+                yield speaker_batch, inputs
+        finally:
+            # Unblock the thread if it is waiting for room in the queue
+            stop.set()
+            while thread.is_alive():
+                try:
+                    queue.get(timeout=0.1)
+                except Empty:
+                    pass
+
+    def _prefetch(self, queue: Queue, stop: Event):
+        try:
+            if self.device.type == "cuda":
+                items = self._copy_to_cuda()
+            else:
+                items = ((batch, batch.frames, None) for batch in self.loader)
+            for item in items:
+                _put(queue, item, stop)
+                if stop.is_set():
+                    return
+            _put(queue, None, stop)
+        except BaseException as e:
+            _put(queue, e, stop)
+
+    def _copy_to_cuda(self):
+        # One more buffer than batches in the queue: the batch given to the training step may
+        # still be copying from its buffer when the next batch is prefetched
+        stream = torch.cuda.Stream(self.device)
+        buffers = [None] * (self.n_batches + 1)
+        events = [None] * len(buffers)
+        for i, speaker_batch in enumerate(self.loader):
+            slot = i % len(buffers)
+            frames = speaker_batch.frames
+            if buffers[slot] is None or buffers[slot].shape != frames.shape:
+                buffers[slot] = torch.empty(frames.shape, dtype=frames.dtype, pin_memory=True)
+            elif events[slot] is not None:
+                events[slot].synchronize()
+            buffers[slot].copy_(frames)
+
+            with torch.cuda.stream(stream):
+                inputs = buffers[slot].to(self.device, non_blocking=True)
+                events[slot] = torch.cuda.Event()
+                events[slot].record(stream)
+            yield speaker_batch, inputs, events[slot]
+
+
+def _put(queue: Queue, item, stop: Event):
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return
+        except Full:
+            pass
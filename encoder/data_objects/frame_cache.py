@@ -0,0 +1,56 @@
+from collections import OrderedDict
+import numpy as np
+
+
+class FrameCache:
+    """
+    Keeps the frames of the most recently used utterances in memory, up to a total size in 
+    bytes. Each DataLoader worker has its own cache.
+    """
+    def __init__(self, max_bytes: int):
+        """
+        :param max_bytes: the maximum size of the frames in the cache. If 0, nothing is cached 
+        and the cache only counts the bytes read.
+        """
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._frames = OrderedDict()
+        
+        # Statistics since the last call to pop_stats()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        
+    def get_frames(self, utterance):
+        """
+        Returns the frames of an utterance, reading them from the disk if they are not cached.
+        """
+        frames = self._frames.get(utterance)
+        if frames is not None:
+            self._frames.move_to_end(utterance)
+            self.hits += 1
+            return frames
+        
+        # Frames of a packed dataset are read from their shard rather than kept as a view of it
+        frames = utterance.get_frames()
+        if isinstance(frames, np.memmap):
+            frames = np.array(frames)
+        self.misses += 1
+        self.bytes_read += frames.nbytes
+        
+        if frames.nbytes <= self.max_bytes:
+            self._frames[utterance] = frames
+            self.n_bytes += frames.nbytes
+            while self.n_bytes > self.max_bytes:
+                _, evicted_frames = self._frames.popitem(last=False)
+                self.n_bytes -= evicted_frames.nbytes
+        return frames
+    
+    def pop_stats(self):
+        """
+        Returns the number of hits, of misses and of bytes read since the last call, and resets 
+        them.
+        """
+        stats = {"hits": self.hits, "misses": self.misses, "bytes_read": self.bytes_read}
+        self.hits, self.misses, self.bytes_read = 0, 0, 0
+        return stats
@@ -1,14 +1,26 @@
 from encoder.data_objects.random_cycler import RandomCycler
 from encoder.data_objects.utterance import Utterance
 from pathlib import Path
+from typing import List
 
 # Contains the set of utterances of a single speaker
 class Speaker:
-    def __init__(self, root: Path):
+    def __init__(self, root: Path, utterances: List[Utterance] = None):
+        """
+        :param root: the directory of the speaker. In a packed dataset, the speaker has no 
+        directory and this is the root of the dataset joined with the name of the speaker.
+        :param utterances: the utterances of the speaker, if they are known from the index of a 
+        packed dataset. Otherwise, they are listed from the sources file of the speaker directory.
+        """
         self.root = root
         self.name = root.name
         self.utterances = None
         self.utterance_cycler = None
+        self.pool_utterance_cycler = None
+        self.pool_refs = 0
+        if utterances is not None:
+            self.utterances = utterances
+            self.utterance_cycler = RandomCycler(utterances)
         
     def _load_utterances(self):
         with self.root.joinpath("_sources.txt").open("r") as sources_file:
@@ -17,15 +29,46 @@ class Speaker:
         self.utterances = [Utterance(self.root.joinpath(f), w) for f, w in sources.items()]
         self.utterance_cycler = RandomCycler(self.utterances)
                
-    def random_partial(self, count, n_frames):
+    def enter_pool(self, n_utterances):
+        """
+        Draws the utterances that random_partial() samples from while the speaker is in the 
+        speaker pool of the dataset, so that they can be cached and reused. They are drawn from 
+        the cycler of all utterances, so that all of them still come up across the times the 
+        speaker enters the pool. The entries are counted: the utterances are only drawn when the 
+        speaker was not in the pool, and kept until it has left it as many times as it entered.
+        
+        :param n_utterances: the number of utterances to draw
+        """
+        self.pool_refs += 1
+        if self.pool_refs > 1:
+            return
+        if self.utterances is None:
+            self._load_utterances()
+        n_utterances = min(n_utterances, len(self.utterances))
+        self.pool_utterance_cycler = RandomCycler(self.utterance_cycler.sample(n_utterances))
+        
+    def leave_pool(self):
+        if self.pool_refs == 0:
+            raise Exception("Speaker %s is not in the pool" % self.name)
+        self.pool_refs -= 1
+        if self.pool_refs == 0:
+            self.pool_utterance_cycler = None
+
+    def in_pool(self):
+        return self.pool_refs > 0
+               
+    def random_partial(self, count, n_frames, cache=None):
         """
         Samples a batch of <count> unique partial utterances from the disk in a way that all 
         utterances come up at least once every two cycles and in a random order every time.
+        While the speaker is in the speaker pool, they are sampled in the same way from the 
+        utterances drawn by enter_pool().
         
         :param count: The number of partial utterances to sample from the set of utterances from 
         that speaker. Utterances are guaranteed not to be repeated if <count> is not larger than 
         the number of utterances available.
         :param n_frames: The number of frames in the partial utterance.
+        :param cache: an optional FrameCache to get the frames of the utterances from.
         :return: A list of tuples (utterance, frames, range) where utterance is an Utterance, 
         frames are the frames of the partial utterances and range is the range of the partial 
         utterance with regard to the complete utterance.
@@ -33,8 +76,11 @@ class Speaker:
         if self.utterances is None:
             self._load_utterances()
 
-        utterances = self.utterance_cycler.sample(count)
+        if self.pool_utterance_cycler is not None:
+            utterances = self.pool_utterance_cycler.sample(count)
+        else:
+            utterances = self.utterance_cycler.sample(count)
 
-        a = [(u,) + u.random_partial(n_frames) for u in utterances]
+        a = [(u,) + u.random_partial(n_frames, cache) for u in utterances]
 
         return a
@@ -1,13 +1,69 @@
-import numpy as np
+import torch
 from typing import List
 from encoder.data_objects.speaker import Speaker
+from encoder.data_objects.frame_cache import FrameCache
+from encoder.params_data import mel_n_channels
 
 
 class SpeakerBatch:
-    def __init__(self, speakers: List[Speaker], utterances_per_speaker: int, n_frames: int):
+    def __init__(self, speakers: List[Speaker], utterances_per_speaker: int, n_frames: int,
+                 cache: FrameCache = None):
         self.speakers = speakers
-        self.partials = {s: s.random_partial(utterances_per_speaker, n_frames) for s in speakers}
+        self.partials = {s: s.random_partial(utterances_per_speaker, n_frames, cache)
+                         for s in speakers}
 
-        # Array of shape (n_speakers * n_utterances, n_frames, mel_n), e.g. for 3 speakers with
-        # 4 utterances each of 160 frames of 40 mel coefficients: (12, 160, 40)
-        self.data = np.array([frames for s in speakers for _, frames, _ in self.partials[s]])
+        # Hits, misses and bytes read of the frame cache since the previous batch, if any
+        self.cache_stats = cache.pop_stats() if cache is not None else None
+
+        # Tensor of shape (n_speakers * n_utterances, n_frames, mel_n), e.g. for 3 speakers with
+        # 4 utterances each of 160 frames of 40 mel coefficients: (12, 160, 40). The frames are
+        # copied once into it, converting those stored in float16 in a packed dataset. A tensor
+        # rather than an array is passed from DataLoader workers through shared memory instead
+        # of being pickled, and the frames of the partials become views of it.
+        n_partials = sum(len(self.partials[s]) for s in speakers)
+        self.frames = torch.empty((n_partials, n_frames, mel_n_channels))
+        data = self.data
+        for s, i in self._speaker_rows():
+            for j, (_, frames, _) in enumerate(self.partials[s]):
+                data[i + j] = frames
+        self._view_partials()
+
+    @property
+    def data(self):
+        """
+        The frames of the batch as a numpy array of float32 that shares the memory of
+        self.frames.
+        """
+        return self.frames.numpy()
+
+    def __getstate__(self):
+        # The frames of the partials are views of self.frames, only the latter is pickled
+        state = self.__dict__.copy()
+        state["partials"] = {s: [(u, frames_range) for u, _, frames_range in partials]
+                             for s, partials in self.partials.items()}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._view_partials()
+
+    def _speaker_rows(self):
+        # The index of the first partial of each speaker in the frames. A speaker sampled twice
+        # in the batch has its partials repeated.
+        i = 0
+        for s in self.speakers:
+            yield s, i
+            i += len(self.partials[s])
+
+    def _view_partials(self):
+        # Replaces the frames of the partials by views of self.frames, at the rows of the first
+        # occurrence of their speaker
+        data = self.data
+        viewed = set()
+        for s, i in self._speaker_rows():
+            if s in viewed:
+                continue
+            viewed.add(s)
+            partials = [(p[0], p[-1]) for p in self.partials[s]]
+            self.partials[s] = [(u, data[i + j], frames_range) for j, (u, frames_range) in
+                                enumerate(partials)]
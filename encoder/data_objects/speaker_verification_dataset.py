@@ -1,27 +1,112 @@
 from encoder.data_objects.random_cycler import RandomCycler
+from encoder.data_objects.frame_cache import FrameCache
 from encoder.data_objects.speaker_batch import SpeakerBatch
 from encoder.data_objects.speaker import Speaker
+from encoder.data_objects.utterance import Utterance
 from encoder.params_data import partials_n_frames
 from torch.utils.data import Dataset, DataLoader
 from pathlib import Path
-
-# TODO: improve with a pool of speakers for data efficiency
+import json
 
 class SpeakerVerificationDataset(Dataset):
-    def __init__(self, datasets_root: Path):
+    def __init__(self, datasets_root: Path, pool_size=0, pool_reuse=20, pool_utterances=20,
+                 cache_size=1 << 30, rank=0, world_size=1, speakers_per_batch=None):
+        """
+        :param datasets_root: either the output directory of encoder_preprocess.py, or a packed
+        dataset created from it with encoder_pack.py.
+        :param pool_size: if not 0, speakers are sampled from a pool of <pool_size> speakers
+        rather than from all speakers. Each speaker of the pool is sampled <pool_reuse> times
+        before it is replaced by the next speaker of the dataset, and its partial utterances are
+        cropped from <pool_utterances> of its utterances, which are cached in memory. Each
+        utterance is then read once from the disk for about <pool_reuse> * utterances_per_speaker
+        / <pool_utterances> partial utterances, at the cost of consecutive batches sharing more
+        speakers. The pool should be several times larger than the number of speakers per batch.
+        A speaker holds at most one slot of the pool, and the slots of a batch are distinct, so
+        that the speakers of a batch are too.
+        :param cache_size: the maximum size in bytes of the frames cached by each DataLoader
+        worker, in pool mode.
+        :param rank: the rank of the process in distributed training. Each of the <world_size>
+        processes samples from its own share of the speakers, so that the speakers of their
+        batches are disjoint.
+        :param world_size: the number of processes in distributed training
+        :param speakers_per_batch: the number of speakers per batch of the DataLoader, i.e. of
+        consecutive indices, required in pool mode.
+        """
+        self.pool_size = pool_size
+        self.pool_reuse = pool_reuse
+        self.pool_utterances = pool_utterances
+        self.frame_cache = FrameCache(cache_size) if pool_size else None
+        self._pool = None
         self.root = datasets_root
-        speaker_dirs = [f for f in self.root.glob("*") if f.is_dir()]
-        if len(speaker_dirs) == 0:
+        if self.root.joinpath("_packed.json").exists():
+            self.speakers = _load_packed_speakers(self.root)
+        else:
+            speaker_dirs = [f for f in self.root.glob("*") if f.is_dir()]
+            self.speakers = [Speaker(speaker_dir) for speaker_dir in speaker_dirs]
+        if len(self.speakers) == 0:
             raise Exception("No speakers found. Make sure you are pointing to the directory "
                             "containing all preprocessed speaker directories.")
-        self.speakers = [Speaker(speaker_dir) for speaker_dir in speaker_dirs]
+        if world_size > 1:
+            # The speakers are sorted so that all processes split them the same way
+            self.speakers = sorted(self.speakers, key=lambda s: s.name)[rank::world_size]
         self.speaker_cycler = RandomCycler(self.speakers)
 
+        self.speakers_per_batch = speakers_per_batch
+        if pool_size:
+            if speakers_per_batch is None:
+                raise ValueError("The number of speakers per batch is required in pool mode")
+            if speakers_per_batch > min(pool_size, len(self.speakers)):
+                raise ValueError("Can't sample batches of %d distinct speakers from a pool of %d "
+                                 "speakers out of %d" % (speakers_per_batch, pool_size,
+                                                         len(self.speakers)))
+            # A speaker holds at most one slot, the pool can't be larger than the speakers
+            self.pool_size = min(pool_size, len(self.speakers))
+
     def __len__(self):
         return int(1e10)
         
     def __getitem__(self, index):
-        return next(self.speaker_cycler)
+        if self.pool_size == 0:
+            return next(self.speaker_cycler)
+
+        # Each process fills its own pool
+        if self._pool is None:
+            self._pool = [None] * self.pool_size
+            self._pool_uses = [0] * self.pool_size
+            self._pool_cycler = RandomCycler(range(self.pool_size))
+            # The slots skipped because they were already sampled in the batch, sampled first
+            # in the next ones
+            self._skipped_slots = []
+            self._batch = None
+
+        # The indices of a batch are consecutive. Its slots are sampled without replacement.
+        batch = index // self.speakers_per_batch
+        if batch != self._batch:
+            self._batch = batch
+            self._batch_slots = set()
+        slot = next((s for s in self._skipped_slots if s not in self._batch_slots), None)
+        if slot is not None:
+            self._skipped_slots.remove(slot)
+        else:
+            slot = next(self._pool_cycler)
+            while slot in self._batch_slots:
+                self._skipped_slots.append(slot)
+                slot = next(self._pool_cycler)
+        self._batch_slots.add(slot)
+
+        # Replace the speaker of the slot sampled once it has been sampled enough times, with the
+        # next speaker that is not in the pool
+        if self._pool_uses[slot] == 0:
+            if self._pool[slot] is not None:
+                self._pool[slot].leave_pool()
+            speaker = next(self.speaker_cycler)
+            while speaker.in_pool():
+                speaker = next(self.speaker_cycler)
+            self._pool[slot] = speaker
+            speaker.enter_pool(self.pool_utterances)
+            self._pool_uses[slot] = self.pool_reuse
+        self._pool_uses[slot] -= 1
+        return self._pool[slot]
     
     def get_logs(self):
         log_string = ""
@@ -29,8 +114,29 @@ class SpeakerVerificationDataset(Dataset):
             with log_fpath.open("r") as log_file:
                 log_string += "".join(log_file.readlines())
         return log_string
-    
-    
+
+
+
+def _load_packed_speakers(root: Path):
+    """
+    Lists the speakers of a packed dataset (see encoder.preprocess.pack_dataset()) and their
+    utterances from its index, without opening the shards.
+    """
+    with root.joinpath("_packed.json").open("r") as info_file:
+        dtype = json.load(info_file)["dtype"]
+
+    speakers_utterances = {}
+    with root.joinpath("_index.csv").open("r") as index_file:
+        for line in index_file:
+            speaker_name, shard_fname, start, end, wave_fpath = line.rstrip("\n").split(",", 4)
+            utterance = Utterance(root.joinpath(shard_fname), wave_fpath, (int(start), int(end)),
+                                  dtype)
+            speakers_utterances.setdefault(speaker_name, []).append(utterance)
+
+    return [Speaker(root.joinpath(name), utterances) for name, utterances in
+            speakers_utterances.items()]
+
+
 class SpeakerVerificationDataLoader(DataLoader):
     def __init__(self, dataset, speakers_per_batch, utterances_per_speaker, sampler=None, 
                  batch_sampler=None, num_workers=0, pin_memory=False, timeout=0, 
@@ -52,5 +158,6 @@ class SpeakerVerificationDataLoader(DataLoader):
         )
 
     def collate(self, speakers):
-        return SpeakerBatch(speakers, self.utterances_per_speaker, partials_n_frames) 
+        return SpeakerBatch(speakers, self.utterances_per_speaker, partials_n_frames,
+                            self.dataset.frame_cache)
     
\ No newline at end of file
@@ -1,26 +1,52 @@
+from functools import lru_cache
 import numpy as np
 
 
 class Utterance:
-    def __init__(self, frames_fpath, wave_fpath):
+    def __init__(self, frames_fpath, wave_fpath, frames_range=None, dtype=None):
+        """
+        :param frames_fpath: the path to the frames of the utterance, or in a packed dataset to
+        the shard that contains them.
+        :param wave_fpath: the path to the source audio of the utterance.
+        :param frames_range: in a packed dataset, the start and end of the frames of the utterance
+        in its shard. None otherwise.
+        :param dtype: in a packed dataset, the data type of the shard.
+        """
         self.frames_fpath = frames_fpath
         self.wave_fpath = wave_fpath
+        self.frames_range = frames_range
+        self.dtype = dtype
         
     def get_frames(self):
-        return np.load(self.frames_fpath)
+        """
+        Returns the frames of the utterance. In a packed dataset, they are a view of the memory
+        mapped shard, so that only the frames that are then indexed are read from the disk.
+        """
+        if self.frames_range is None:
+            return np.load(self.frames_fpath)
+        start, end = self.frames_range
+        return _open_shard(self.frames_fpath, self.dtype)[start:end]
 
-    def random_partial(self, n_frames):
+    def random_partial(self, n_frames, cache=None):
         """
         Crops the frames into a partial utterance of n_frames
         
         :param n_frames: The number of frames of the partial utterance
+        :param cache: an optional FrameCache to get the frames from.
         :return: the partial utterance frames and a tuple indicating the start and end of the 
         partial utterance in the complete utterance.
         """
-        frames = self.get_frames()
+        frames = self.get_frames() if cache is None else cache.get_frames(self)
         if frames.shape[0] == n_frames:
             start = 0
         else:
             start = np.random.randint(0, frames.shape[0] - n_frames)
         end = start + n_frames
-        return frames[start:end], (start, end)
\ No newline at end of file
+        return frames[start:end], (start, end)
+
+
+@lru_cache(maxsize=64)
+def _open_shard(fpath, dtype):
+    # Shards are mapped once per process and kept open, they are only read from
+    from encoder.params_data import mel_n_channels
+    return np.memmap(fpath, dtype=dtype, mode="r").reshape(-1, mel_n_channels)
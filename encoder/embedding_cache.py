@@ -0,0 +1,196 @@
+from encoder.params_model import model_embedding_size
+from functools import lru_cache
+from pathlib import Path
+from time import time
+from typing import Optional, Union
+import numpy as np
+import threading
+import hashlib
+import sqlite3
+import os
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of utterance embeddings, shared between the processes that use the same
+    cache directory. Embeddings are addressed by the content of the audio they were computed
+    from, the weights of the encoder and the data parameters, so that changing any of these
+    never returns a stale embedding.
+
+    The embeddings are stored in a memory-mapped array file of <max_entries> rows, and a SQLite
+    index maps each key to a row. When the cache is full, the least recently used embedding is
+    evicted. Every access is done in a transaction of the index, which serializes the accesses of
+    concurrent processes.
+    """
+    def __init__(self, cache_dir: Path, weights_fpath: Path, max_entries=100000):
+        """
+        :param cache_dir: the directory of the cache. It is created if needed.
+        :param weights_fpath: the path to the weights of the encoder that computes the
+        embeddings.
+        :param max_entries: the maximum number of embeddings in the cache. Each takes
+        4 * model_embedding_size bytes on the disk.
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(exist_ok=True, parents=True)
+        self.max_entries = max_entries
+        self.weights_digest = _file_digest(Path(weights_fpath).resolve(),
+                                           Path(weights_fpath).stat().st_mtime)
+        self.params_digest = _params_digest()
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._db = None
+        self._embeds = None
+
+    def key(self, fpath_or_wav: Union[str, Path, np.ndarray], source_sr: Optional[int] = None):
+        """
+        Derives the key of an utterance. The arguments are those of preprocess_wav().
+        """
+        h = hashlib.sha1()
+        h.update(self.weights_digest.encode())
+        h.update(self.params_digest.encode())
+        if isinstance(fpath_or_wav, str) or isinstance(fpath_or_wav, Path):
+            h.update(b"file")
+            h.update(Path(fpath_or_wav).read_bytes())
+        else:
+            h.update(b"wav%d" % (source_sr or 0))
+            h.update(np.ascontiguousarray(fpath_or_wav, dtype=np.float32).tobytes())
+        return h.hexdigest()
+
+    def get(self, fpath_or_wav: Union[str, Path, np.ndarray], source_sr: Optional[int] = None):
+        """
+        Retrieves the embedding of an utterance.
+
+        :return: the embedding as a numpy array of float32 of shape (model_embedding_size,), or
+        None if the utterance is not in the cache.
+        """
+        key = self.key(fpath_or_wav, source_sr)
+        with self._transaction() as db:
+            row = db.execute("SELECT slot FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            db.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time(), key))
+            self.hits += 1
+            return np.array(self._embeds[row[0]])
+
+    def put(self, fpath_or_wav: Union[str, Path, np.ndarray], embed: np.ndarray,
+            source_sr: Optional[int] = None):
+        """
+        Adds the embedding of an utterance to the cache, evicting the least recently used
+        embedding if the cache is full.
+        """
+        key = self.key(fpath_or_wav, source_sr)
+        with self._transaction() as db:
+            row = db.execute("SELECT slot FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                n_entries = db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+                if n_entries < self.max_entries:
+                    # Rows are never deleted without being replaced, so slots are contiguous
+                    slot = n_entries
+                else:
+                    slot = db.execute("SELECT slot FROM entries ORDER BY last_access "
+                                      "LIMIT 1").fetchone()[0]
+                    db.execute("DELETE FROM entries WHERE slot = ?", (slot,))
+            else:
+                slot = row[0]
+            self._embeds[slot] = embed
+            self._embeds.flush()
+            db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (key, slot, time()))
+
+    def embed_utterance(self, fpath_or_wav: Union[str, Path, np.ndarray],
+                        source_sr: Optional[int] = None, session=None):
+        """
+        Computes the embedding of an utterance as preprocess_wav() followed by embed_utterance()
+        would, unless it is already in the cache. The encoder must be loaded with the weights of
+        this cache.
+
+        :param session: the EncoderSession that computes the embedding. If None, that of the
+        module-level functions of encoder.inference is used.
+
+        :return: the embedding as a numpy array of float32 of shape (model_embedding_size,)
+        """
+        from encoder import inference
+
+        embed = self.get(fpath_or_wav, source_sr)
+        if embed is None:
+            wav = inference.preprocess_wav(fpath_or_wav, source_sr)
+            embed = (inference if session is None else session).embed_utterance(wav)
+            self.put(fpath_or_wav, embed, source_sr)
+        return embed
+
+    def __len__(self):
+        with self._transaction() as db:
+            return db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def _open(self):
+        # Connections can't be shared with forked processes, each process opens its own
+        self._pid = os.getpid()
+        self._db = sqlite3.connect(str(self.cache_dir.joinpath("index.sqlite")), timeout=60,
+                                   isolation_level=None, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, "
+                         "slot INTEGER UNIQUE, last_access REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries "
+                         "(last_access)")
+
+        # Create the embeddings file, or recreate it if the cache was resized
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            embeds_fpath = self.cache_dir.joinpath("embeds.npy")
+            shape = (self.max_entries, model_embedding_size)
+            if embeds_fpath.exists():
+                self._embeds = np.load(embeds_fpath, mmap_mode="r+")
+                if self._embeds.shape != shape or self._embeds.dtype != np.float32:
+                    del self._embeds
+                    embeds_fpath.unlink()
+            if not embeds_fpath.exists():
+                self._db.execute("DELETE FROM entries")
+                np.lib.format.open_memmap(embeds_fpath, "w+", np.float32, shape).flush()
+                self._embeds = np.load(embeds_fpath, mmap_mode="r+")
+            self._db.execute("COMMIT")
+        except:
+            self._db.execute("ROLLBACK")
+            raise
+
+    def _transaction(self):
+        return _Transaction(self)
+
+
+class _Transaction:
+    def __init__(self, cache: EmbeddingCache):
+        self.cache = cache
+
+    def __enter__(self):
+        self.cache._lock.acquire()
+        try:
+            if self.cache._pid != os.getpid():
+                self.cache._open()
+            self.cache._db.execute("BEGIN IMMEDIATE")
+        except:
+            self.cache._lock.release()
+            raise
+        return self.cache._db
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        try:
+            self.cache._db.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        finally:
+            self.cache._lock.release()
+
+
+@lru_cache(maxsize=None)
+def _file_digest(fpath: Path, mtime: float):
+    # The modification time is part of the arguments so as to hash modified files again
+    h = hashlib.sha1()
+    with fpath.open("rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _params_digest():
+    from encoder import params_data
+    params = [(p, getattr(params_data, p)) for p in dir(params_data) if not p.startswith("__")]
+    return hashlib.sha1(repr(params).encode()).hexdigest()
@@ -1,17 +1,335 @@
 from encoder.params_data import *
+from encoder.params_model import model_embedding_size
 from encoder.model import SpeakerEncoder
+from encoder.embedding_cache import EmbeddingCache
 from encoder.audio import preprocess_wav   # We want to expose this function from here
 from matplotlib import cm
 from encoder import audio
+from utils.tensor_file import load_tensors, save_tensors
+from concurrent.futures import Future
+from time import perf_counter as timer
+from queue import Queue, Empty
 from pathlib import Path
 import numpy as np
+import threading
 import torch
 
-_model = None # type: SpeakerEncoder
-_device = None # type: torch.device
+# The session of the module-level functions, see load_model()
+_session = None # type: EncoderSession
 
 
-def load_model(weights_fpath: Path, device=None):
+class EncoderSession:
+    """
+    An encoder with its own model, device, number of threads and optional embedding cache.
+    Several sessions can coexist in a process, e.g. on different devices or with different
+    weights, and the methods of a session can be called concurrently from several threads: the
+    forward passes of a session are serialized, and if <batch_window> is set, the batches
+    submitted within <batch_window> seconds of each other are merged into a single forward pass.
+    The module-level functions embed_utterance(), embed_utterances(), etc. are those of the
+    session created by load_model().
+    """
+    def __init__(self, weights_fpath: Path, device=None, backend="eager", n_threads=None,
+                 cache: EmbeddingCache = None, max_batch_size=inference_max_batch_size,
+                 batch_window=None):
+        """
+        :param weights_fpath: the path to saved model weights.
+        :param device: either a torch device or the name of a torch device (e.g. "cpu", "cuda").
+        The model will be loaded and will run on this device. Outputs will however always be on
+        the cpu. If None, will default to your GPU if it"s available, otherwise your CPU.
+        :param backend: how to run the model, see load_model().
+        :param n_threads: the number of threads of the forward passes on the CPU. PyTorch only
+        has a single thread pool per process, so it is set before each forward pass of this
+        session. If None, it is left as is.
+        :param cache: an embedding cache for the weights of this session, used by embed_audio().
+        :param max_batch_size: the maximum number of partial utterances to forward at once.
+        :param batch_window: if not None, the batches of concurrent calls are queued and merged
+        when they arrive within this many seconds of the first one, up to <max_batch_size>
+        partial utterances. A few milliseconds are enough to merge concurrent requests, which
+        serves many small requests much faster than forwarding each of them.
+        """
+        assert max_batch_size > 0
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu") \
+            if device is None else torch.device(device)
+        self.model, self.step = _load_model(weights_fpath, self.device, backend)
+        self.weights_fpath = Path(weights_fpath)
+        self.backend = backend
+        self.n_threads = n_threads
+        self.cache = cache
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+
+        # Number of submitted batches and of forward passes, to monitor the merging of batches
+        self.n_requests = 0
+        self.n_forwards = 0
+
+        self._lock = threading.Lock()
+        self._closed = False
+        self._queue = None
+        self._batcher = None
+        if batch_window is not None:
+            self._queue = Queue()
+            self._batcher = threading.Thread(target=self._batch_loop, daemon=True)
+            self._batcher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Stops the batching thread once the batches already submitted are computed. The session
+        can't be used afterwards.
+        """
+        # No batch can be submitted after the sentinel, as submitting checks the closed flag
+        # with the lock held
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._batcher is not None:
+                self._queue.put(None)
+        if self._batcher is not None:
+            self._batcher.join()
+            self._batcher = None
+
+            # Fail the batches the batching thread left, if it stopped on an error
+            while not self._queue.empty():
+                request = self._queue.get()
+                if request is not None:
+                    request[1].set_exception(Exception("The session was closed."))
+        with self._lock:
+            self.model = None
+
+    def embed_frames_batch(self, frames_batch):
+        """
+        See the module-level embed_frames_batch().
+        """
+        return self._submit(frames_batch).result()
+
+    def embed_frames_sliding(self, frames, partial_ends):
+        """
+        See the module-level embed_frames_sliding(). These are never merged with other batches.
+        """
+        frames = torch.from_numpy(np.ascontiguousarray(frames[None, :partial_ends[-1]]))
+        with self._lock:
+            self._check_open()
+            if self.n_threads is not None:
+                torch.set_num_threads(self.n_threads)
+            with torch.no_grad():
+                embeds, _ = self.model.forward_sliding(frames.to(self.device), partial_ends)
+        return embeds[0].cpu().numpy()
+
+    def embed_utterance(self, wav, using_partials=True, return_partials=False, sliding=False,
+                        **kwargs):
+        """
+        See the module-level embed_utterance().
+        """
+        # Process the entire utterance if not using partials
+        if not using_partials:
+            frames = audio.wav_to_mel_spectrogram(wav)
+            embed = self.embed_frames_batch(frames[None, ...])[0]
+            if return_partials:
+                return embed, None, None
+            return embed
+
+        # Compute the partial embeddings
+        frames, mel_ranges, wave_slices = _compute_partial_frames(wav, **kwargs)
+        if sliding:
+            partial_embeds = self.embed_frames_sliding(frames, mel_ranges[:, 1])
+        else:
+            partial_embeds = self.embed_frames_batch(partial_frames_view(frames, mel_ranges))
+
+        # Compute the utterance embedding from the partial embeddings
+        raw_embed = np.mean(partial_embeds, axis=0)
+        embed = raw_embed / np.linalg.norm(raw_embed, 2)
+
+        if return_partials:
+            return embed, partial_embeds, wave_slices
+        return embed
+
+    def embed_utterances(self, wavs, max_batch_size=None, return_partials=False, **kwargs):
+        """
+        See the module-level embed_utterances(). If <max_batch_size> is None, that of the
+        session is used.
+        """
+        max_batch_size = max_batch_size or self.max_batch_size
+        if len(wavs) == 0:
+            embeds = np.zeros((0, model_embedding_size), dtype=np.float32)
+            return (embeds, [], []) if return_partials else embeds
+
+        # Split all utterances into partials and remember where each utterance starts
+        frames_batches, wave_slices = zip(*[_split_partials(wav, **kwargs) for wav in wavs])
+        n_partials = [len(frames_batch) for frames_batch in frames_batches]
+
+        # Compute the partial embeddings in large batches, all submitted before waiting for any
+        futures = [self._submit(batch) for batch in
+                   _iterate_batches(frames_batches, max_batch_size)]
+        partial_embeds = np.concatenate([future.result() for future in futures])
+
+        # Scatter the partial embeddings back and compute each utterance embedding from them
+        partial_embeds = np.split(partial_embeds, np.cumsum(n_partials)[:-1])
+        raw_embeds = np.array([np.mean(p, axis=0) for p in partial_embeds])
+        embeds = raw_embeds / np.linalg.norm(raw_embeds, 2, axis=1, keepdims=True)
+
+        if return_partials:
+            return embeds, partial_embeds, list(wave_slices)
+        return embeds
+
+    def embed_speaker(self, wavs, **kwargs):
+        """
+        See the module-level embed_speaker().
+        """
+        raw_embed = np.mean(self.embed_utterances(wavs, **kwargs), axis=0)
+        return raw_embed / np.linalg.norm(raw_embed, 2)
+
+    def embed_audio(self, fpath_or_wav, source_sr=None):
+        """
+        Computes the embedding of an utterance as preprocess_wav() followed by embed_utterance()
+        would, skipping the encoder if the session has a cache that holds the utterance.
+
+        :return: the embedding as a numpy array of float32 of shape (model_embedding_size,)
+        """
+        if self.cache is not None:
+            return self.cache.embed_utterance(fpath_or_wav, source_sr, session=self)
+        return self.embed_utterance(preprocess_wav(fpath_or_wav, source_sr))
+
+    def _check_open(self):
+        if self._closed or self.model is None:
+            raise Exception("The session was closed.")
+
+    def _forward(self, frames_batch):
+        # Must be called with the lock held
+        if self.n_threads is not None:
+            torch.set_num_threads(self.n_threads)
+        # Torch does not support read-only arrays, e.g. from partial_frames_view(). The LSTM
+        # would make a strided view contiguous anyway.
+        if not frames_batch.flags.writeable:
+            frames_batch = np.array(frames_batch)
+        frames = torch.from_numpy(frames_batch).to(self.device)
+        with torch.no_grad():
+            embeds = self.model.forward(frames).cpu().numpy()
+        self.n_forwards += 1
+        return embeds
+
+    def _submit(self, frames_batch):
+        """
+        Computes the embeddings of a batch of frames, right away or in the batching thread.
+
+        :return: a Future of the embeddings
+        """
+        future = Future()
+        if self._queue is not None:
+            with self._lock:
+                self._check_open()
+                self._queue.put((frames_batch, future))
+            return future
+
+        with self._lock:
+            try:
+                self._check_open()
+                self.n_requests += 1
+                future.set_result(self._forward(frames_batch))
+            except Exception as e:
+                future.set_exception(e)
+        return future
+
+    def _batch_loop(self):
+        while True:
+            # Wait for a first batch, then for more batches until the window closes or enough
+            # partial utterances are gathered
+            requests = [self._queue.get()]
+            if requests[0] is None:
+                return
+            n_partials = len(requests[0][0])
+            deadline = timer() + self.batch_window
+            while n_partials < self.max_batch_size:
+                try:
+                    request = self._queue.get(timeout=max(deadline - timer(), 0))
+                except Empty:
+                    break
+                if request is None:
+                    # Stop after this batch
+                    self._queue.put(None)
+                    break
+                requests.append(request)
+                n_partials += len(request[0])
+            self.n_requests += len(requests)
+
+            # Only the frames of partial utterances of the same length can be merged
+            groups = {}
+            for request in requests:
+                groups.setdefault(request[0].shape[1:], []).append(request)
+            for group in groups.values():
+                try:
+                    frames = np.concatenate([frames_batch for frames_batch, _ in group])
+                    # The lock serializes these forward passes with those of the other methods
+                    with self._lock:
+                        embeds = np.concatenate([
+                            self._forward(frames[i:i + self.max_batch_size])
+                            for i in range(0, len(frames), self.max_batch_size)
+                        ])
+                except Exception as e:
+                    for _, future in group:
+                        future.set_exception(e)
+                    continue
+                splits = np.cumsum([len(frames_batch) for frames_batch, _ in group])[:-1]
+                for (_, future), group_embeds in zip(group, np.split(embeds, splits)):
+                    future.set_result(group_embeds)
+
+
+def _load_model(weights_fpath: Path, device: torch.device, backend: str):
+    """
+    Loads a model for inference on a device with one of the backends of load_model().
+
+    :return: the model and the step it was trained to
+    """
+    if backend == "int8" and device.type != "cpu":
+        raise ValueError("The int8 backend only runs on the CPU, not on %s" % device)
+
+    if backend == "torchscript":
+        extra_files = {"step": ""}
+        model = torch.jit.load(str(weights_fpath), device, _extra_files=extra_files)
+        step = int(extra_files["step"])
+    elif backend in ["eager", "int8"]:
+        model_state, step = _load_model_state(weights_fpath)
+        model = SpeakerEncoder(device, torch.device("cpu"))
+        model.load_state_dict(model_state)
+        model.eval()
+        if backend == "int8":
+            model = quantize_model(model)
+    else:
+        raise ValueError("Unknown backend \"%s\"" % backend)
+    return model, step
+
+
+def _load_model_state(weights_fpath: Path):
+    """
+    Reads the weights of a model from a training checkpoint or from a file of convert_model().
+    They are left on the CPU, to be copied to the device of the model by load_state_dict().
+
+    :return: the state dict of the model and the step it was trained to
+    """
+    if Path(weights_fpath).suffix == ".safetensors":
+        # The weights are mapped in memory
+        model_state, metadata = load_tensors(weights_fpath)
+        return model_state, int(metadata["step"])
+
+    # The whole checkpoint is unpickled, including the state of the optimizer. Loading it on the
+    # CPU avoids moving that state to the GPU, only for it to be discarded.
+    checkpoint = torch.load(weights_fpath, "cpu")
+    return checkpoint["model_state"], checkpoint["step"]
+
+
+def _get_session():
+    session = _session
+    if session is None:
+        raise Exception("Model was not loaded. Call load_model() before inference.")
+    return session
+
+
+def load_model(weights_fpath: Path, device=None, backend="eager"):
     """
     Loads the model in memory. If this function is not explicitely called, it will be run on the
     first call to embed_frames() with the default weights file.
@@ -20,23 +338,76 @@ def load_model(weights_fpath: Path, device=None):
     :param device: either a torch device or the name of a torch device (e.g. "cpu", "cuda"). The
     model will be loaded and will run on this device. Outputs will however always be on the cpu.
     If None, will default to your GPU if it"s available, otherwise your CPU.
+    :param backend: how to run the model. Either "eager" to run the model as it was trained,
+    "int8" to quantize the weights of its LSTM and linear layers to int8 (CPU only, faster), or
+    "torchscript" to load a model exported with export_model(). TorchScript models do not
+    support the sliding mode of embed_utterance(). The eager and int8 backends load either a
+    training checkpoint or, much faster, its weights converted with convert_model() to a
+    .safetensors file.
+    :return: the EncoderSession of the module-level functions. Calls made with the previous
+    session while it is replaced still complete with the previous model.
+    """
+    global _session
+    session = EncoderSession(weights_fpath, device, backend)
+    _session = session
+    print("Loaded encoder \"%s\" (%s) trained to step %d" % (session.weights_fpath.name, backend,
+                                                             session.step))
+    return session
+
+
+def quantize_model(model: SpeakerEncoder):
+    """
+    Returns a copy of a model on the CPU whose LSTM and linear layers are dynamically quantized
+    to int8: their weights are stored as int8 and the activations are quantized on the fly.
+    """
+    return torch.quantization.quantize_dynamic(model, {torch.nn.LSTM, torch.nn.Linear},
+                                               dtype=torch.qint8)
+
+
+def export_model(weights_fpath: Path, out_fpath: Path, quantize=False):
     """
-    # TODO: I think the slow loading of the encoder might have something to do with the device it
-    #   was saved on. Worth investigating.
-    global _model, _device
-    if device is None:
-        _device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    elif isinstance(device, str):
-        _device = torch.device(device)
-    _model = SpeakerEncoder(_device, torch.device("cpu"))
-    checkpoint = torch.load(weights_fpath, _device)
-    _model.load_state_dict(checkpoint["model_state"])
-    _model.eval()
-    print("Loaded encoder \"%s\" trained to step %d" % (weights_fpath.name, checkpoint["step"]))
+    Exports the model for inference as a TorchScript file, which load_model() can load with
+    the "torchscript" backend without the source code of the model.
+
+    :param weights_fpath: the path to saved model weights.
+    :param out_fpath: the path of the exported model.
+    :param quantize: if True, the LSTM and linear layers of the exported model are quantized to
+    int8 (see quantize_model()). The exported model then only runs on the CPU.
+    """
+    cpu = torch.device("cpu")
+    model = SpeakerEncoder(cpu, cpu)
+    model_state, step = _load_model_state(weights_fpath)
+    model.load_state_dict(model_state)
+    model.eval()
+    if quantize:
+        model = quantize_model(model)
+
+    # The batch size and the number of frames of the example do not constrain those of the
+    # traced model
+    example = torch.zeros(2, partials_n_frames, mel_n_channels)
+    with torch.no_grad():
+        traced_model = torch.jit.trace(model, example)
+    torch.jit.save(traced_model, str(out_fpath), _extra_files={"step": str(step)})
+
+
+def convert_model(weights_fpath: Path, out_fpath: Path):
+    """
+    Converts a training checkpoint to a slim inference checkpoint: a .safetensors file (see
+    utils.tensor_file) of the weights of the model and of the step it was trained to, without
+    the state of the optimizer. load_model() maps this file in memory rather than unpickling it.
+
+    :param weights_fpath: the path to saved model weights.
+    :param out_fpath: the path of the converted model, with the .safetensors extension.
+    """
+    if Path(out_fpath).suffix != ".safetensors":
+        raise ValueError("The converted model must have the .safetensors extension, got %s" %
+                         out_fpath)
+    model_state, step = _load_model_state(weights_fpath)
+    save_tensors(model_state, out_fpath, {"step": str(step)})
 
 
 def is_loaded():
-    return _model is not None
+    return _session is not None
 
 
 def embed_frames_batch(frames_batch):
@@ -47,12 +418,55 @@ def embed_frames_batch(frames_batch):
     (batch_size, n_frames, n_channels)
     :return: the embeddings as a numpy array of float32 of shape (batch_size, model_embedding_size)
     """
-    if _model is None:
-        raise Exception("Model was not loaded. Call load_model() before inference.")
+    return _get_session().embed_frames_batch(frames_batch)
 
-    frames = torch.from_numpy(frames_batch).to(_device)
-    embed = _model.forward(frames).detach().cpu().numpy()
-    return embed
+
+def embed_frames_sliding(frames, partial_ends):
+    """
+    Computes approximate embeddings of the overlapping partial utterances of a mel spectrogram
+    in a single pass of the LSTM. See SpeakerEncoder.forward_sliding().
+
+    :param frames: a mel spectrogram as a numpy array of float32 of shape (n_frames, n_channels)
+    :param partial_ends: the index of the frame following the last frame of each partial
+    utterance, in increasing order.
+    :return: the embeddings as a numpy array of float32 of shape (n_partials,
+    model_embedding_size)
+    """
+    return _get_session().embed_frames_sliding(frames, partial_ends)
+
+
+def compute_partial_ranges(n_samples, partial_utterance_n_frames=partials_n_frames,
+                           min_pad_coverage=0.75, overlap=0.5):
+    """
+    Computes the same partial utterances as compute_partial_slices(), with their boundaries
+    returned as arrays rather than lists of slices. See compute_partial_slices() for the
+    parameters.
+
+    :return: the waveform and mel spectrogram ranges as numpy arrays of int of shape
+    (n_partials, 2), where each row holds the start (inclusive) and the end (exclusive) of a
+    partial utterance.
+    """
+    assert 0 <= overlap < 1
+    assert 0 < min_pad_coverage <= 1
+
+    samples_per_frame = int((sampling_rate * mel_window_step / 1000))
+    n_frames = int(np.ceil((n_samples + 1) / samples_per_frame))
+    frame_step = max(int(np.round(partial_utterance_n_frames * (1 - overlap))), 1)
+
+    # Compute the ranges
+    steps = max(1, n_frames - partial_utterance_n_frames + frame_step + 1)
+    mel_starts = np.arange(0, steps, frame_step)
+    mel_ranges = np.stack((mel_starts, mel_starts + partial_utterance_n_frames), axis=1)
+    wav_ranges = mel_ranges * samples_per_frame
+
+    # Evaluate whether extra padding is warranted or not
+    last_start, last_stop = wav_ranges[-1]
+    coverage = (n_samples - last_start) / (last_stop - last_start)
+    if coverage < min_pad_coverage and len(mel_ranges) > 1:
+        mel_ranges = mel_ranges[:-1]
+        wav_ranges = wav_ranges[:-1]
+
+    return wav_ranges, mel_ranges
 
 
 def compute_partial_slices(n_samples, partial_utterance_n_frames=partials_n_frames,
@@ -81,37 +495,96 @@ def compute_partial_slices(n_samples, partial_utterance_n_frames=partials_n_fram
     respectively the waveform and the mel spectrogram with these slices to obtain the partial
     utterances.
     """
-    assert 0 <= overlap < 1
-    assert 0 < min_pad_coverage <= 1
+    wav_ranges, mel_ranges = compute_partial_ranges(n_samples, partial_utterance_n_frames,
+                                                    min_pad_coverage, overlap)
+    wav_slices = [slice(*wav_range) for wav_range in wav_ranges]
+    mel_slices = [slice(*mel_range) for mel_range in mel_ranges]
+    return wav_slices, mel_slices
 
-    samples_per_frame = int((sampling_rate * mel_window_step / 1000))
-    n_frames = int(np.ceil((n_samples + 1) / samples_per_frame))
-    frame_step = max(int(np.round(partial_utterance_n_frames * (1 - overlap))), 1)
 
-    # Compute the slices
-    wav_slices, mel_slices = [], []
-    steps = max(1, n_frames - partial_utterance_n_frames + frame_step + 1)
-    for i in range(0, steps, frame_step):
-        mel_range = np.array([i, i + partial_utterance_n_frames])
-        wav_range = mel_range * samples_per_frame
-        mel_slices.append(slice(*mel_range))
-        wav_slices.append(slice(*wav_range))
+def partial_frames_view(frames, mel_ranges):
+    """
+    Returns the partial utterances of a mel spectrogram as a view of it, without copying the
+    frames they share. The view is read-only.
+
+    :param frames: the mel spectrogram as a numpy array of shape (n_frames, n_channels). It
+    must be long enough for all partial utterances, e.g. computed from a waveform padded as
+    compute_partial_slices() recommends.
+    :param mel_ranges: the mel spectrogram ranges returned by compute_partial_ranges()
+    :return: the partial utterances as a numpy array of shape (n_partials,
+    partial_utterance_n_frames, n_channels)
+    """
+    assert mel_ranges[-1, 1] <= len(frames)
+    partial_utterance_n_frames = mel_ranges[0, 1] - mel_ranges[0, 0]
+    frame_step = mel_ranges[1, 0] - mel_ranges[0, 0] if len(mel_ranges) > 1 else 1
+    return np.lib.stride_tricks.as_strided(
+        frames[mel_ranges[0, 0]:],
+        shape=(len(mel_ranges), partial_utterance_n_frames, frames.shape[1]),
+        strides=(frame_step * frames.strides[0], frames.strides[0], frames.strides[1]),
+        writeable=False,
+    )
+
+
+def _compute_partial_frames(wav, **kwargs):
+    """
+    Pads a waveform if necessary and computes its mel spectrogram along with its partial
+    utterances.
 
-    # Evaluate whether extra padding is warranted or not
-    last_wav_range = wav_slices[-1]
-    coverage = (n_samples - last_wav_range.start) / (last_wav_range.stop - last_wav_range.start)
-    if coverage < min_pad_coverage and len(mel_slices) > 1:
-        mel_slices = mel_slices[:-1]
-        wav_slices = wav_slices[:-1]
+    :param wav: a preprocessed utterance waveform as a numpy array of float32
+    :param kwargs: additional arguments to compute_partial_splits()
+    :return: the mel spectrogram as a numpy array of float32 of shape (n_frames, n_channels),
+    the mel spectrogram ranges (see compute_partial_ranges()) and the wav partials as a list of
+    slices.
+    """
+    # Compute where to split the utterance into partials and pad if necessary
+    wav_ranges, mel_ranges = compute_partial_ranges(len(wav), **kwargs)
+    max_wave_length = wav_ranges[-1, 1]
+    if max_wave_length >= len(wav):
+        wav = np.pad(wav, (0, max_wave_length - len(wav)), "constant")
 
-    return wav_slices, mel_slices
+    frames = audio.wav_to_mel_spectrogram(wav)
+    wave_slices = [slice(*wav_range) for wav_range in wav_ranges]
+    return frames, mel_ranges, wave_slices
 
 
-def embed_utterance(wav, using_partials=True, return_partials=False, **kwargs):
+def _split_partials(wav, **kwargs):
     """
-    Computes an embedding for a single utterance.
+    Pads a waveform if necessary and splits its mel spectrogram into partial utterances.
+
+    :param wav: a preprocessed utterance waveform as a numpy array of float32
+    :param kwargs: additional arguments to compute_partial_splits()
+    :return: the partial utterances frames as a view (see partial_frames_view()) of shape
+    (n_partials, partial_utterance_n_frames, n_channels) and the wav partials as a list of
+    slices.
+    """
+    frames, mel_ranges, wave_slices = _compute_partial_frames(wav, **kwargs)
+    return partial_frames_view(frames, mel_ranges), wave_slices
+
+
+def _iterate_batches(frames_batches, max_batch_size):
+    """
+    Regroups the partial utterances of several utterances into batches of <max_batch_size>
+    partial utterances (the last one may be smaller), copying a single batch at a time.
+    """
+    batch, batch_size = [], 0
+    for frames_batch in frames_batches:
+        while len(frames_batch) > 0:
+            n = min(len(frames_batch), max_batch_size - batch_size)
+            batch.append(frames_batch[:n])
+            batch_size += n
+            frames_batch = frames_batch[n:]
+            if batch_size == max_batch_size:
+                yield np.concatenate(batch)
+                batch, batch_size = [], 0
+    if batch_size > 0:
+        yield np.concatenate(batch)
+
+
+def embed_utterance(wav, using_partials=True, return_partials=False, sliding=False, **kwargs):
+    """
+    Computes an embedding for a single utterance. To embed several utterances at once, prefer
+    embed_utterances() which batches their partial utterances together.
 
-    # TODO: handle multiple wavs to benefit from batching on GPU
     :param wav: a preprocessed (see audio.py) utterance waveform as a numpy array of float32
     :param using_partials: if True, then the utterance is split in partial utterances of
     <partial_utterance_n_frames> frames and the utterance embedding is computed from their
@@ -119,6 +592,10 @@ def embed_utterance(wav, using_partials=True, return_partials=False, **kwargs):
     spectogram to the network.
     :param return_partials: if True, the partial embeddings will also be returned along with the
     wav slices that correspond to the partial embeddings.
+    :param sliding: experimental. If True (and <using_partials> is True), the partial
+    embeddings are approximated in a single pass of the LSTM over the utterance, which takes
+    about half the operations. See SpeakerEncoder.forward_sliding() and
+    benchmarks.benchmark_sliding_lstm() for how much the embeddings diverge.
     :param kwargs: additional arguments to compute_partial_splits()
     :return: the embedding as a numpy array of float32 of shape (model_embedding_size,). If
     <return_partials> is True, the partial utterances as a numpy array of float32 of shape
@@ -126,36 +603,203 @@ def embed_utterance(wav, using_partials=True, return_partials=False, **kwargs):
     returned. If <using_partials> is simultaneously set to False, both these values will be None
     instead.
     """
-    # Process the entire utterance if not using partials
-    if not using_partials:
-        frames = audio.wav_to_mel_spectrogram(wav)
-        embed = embed_frames_batch(frames[None, ...])[0]
-        if return_partials:
-            return embed, None, None
-        return embed
+    return _get_session().embed_utterance(wav, using_partials, return_partials, sliding, **kwargs)
 
-    # Compute where to split the utterance into partials and pad if necessary
-    wave_slices, mel_slices = compute_partial_slices(len(wav), **kwargs)
-    max_wave_length = wave_slices[-1].stop
-    if max_wave_length >= len(wav):
-        wav = np.pad(wav, (0, max_wave_length - len(wav)), "constant")
 
-    # Split the utterance into partials
-    frames = audio.wav_to_mel_spectrogram(wav)
-    frames_batch = np.array([frames[s] for s in mel_slices])
-    partial_embeds = embed_frames_batch(frames_batch)
+def embed_utterances(wavs, max_batch_size=inference_max_batch_size, return_partials=False,
+                     **kwargs):
+    """
+    Computes an embedding for each of several utterances. The partial utterances of all
+    waveforms are pooled together and forwarded in batches of at most <max_batch_size>, which is
+    much faster than calling embed_utterance() in a loop. The embeddings returned are the same
+    (up to floating point precision) as those of embed_utterance() with <using_partials> set.
+
+    :param wavs: a list of preprocessed (see audio.py) utterance waveforms as numpy arrays of
+    float32
+    :param max_batch_size: the maximum number of partial utterances to forward at once. Lower
+    it if you run out of memory.
+    :param return_partials: if True, the partial embeddings will also be returned along with the
+    wav slices that correspond to the partial embeddings, for each utterance.
+    :param kwargs: additional arguments to compute_partial_splits()
+    :return: the embeddings as a numpy array of float32 of shape (n_utterances,
+    model_embedding_size). If <return_partials> is True, a list of the partial embeddings of
+    each utterance as numpy arrays of float32 of shape (n_partials, model_embedding_size) and a
+    list of the wav partials of each utterance as lists of slices will also be returned.
+    """
+    return _get_session().embed_utterances(wavs, max_batch_size, return_partials, **kwargs)
+
 
-    # Compute the utterance embedding from the partial embeddings
-    raw_embed = np.mean(partial_embeds, axis=0)
-    embed = raw_embed / np.linalg.norm(raw_embed, 2)
+def embed_speaker(wavs, **kwargs):
+    """
+    Computes the embedding of a speaker from several of its utterances, as the normalized
+    average of the utterance embeddings.
 
-    if return_partials:
-        return embed, partial_embeds, wave_slices
-    return embed
+    :param wavs: a list of preprocessed (see audio.py) utterance waveforms of the same speaker as
+    numpy arrays of float32
+    :param kwargs: additional arguments to embed_utterances()
+    :return: the embedding as a numpy array of float32 of shape (model_embedding_size,)
+    """
+    return _get_session().embed_speaker(wavs, **kwargs)
 
 
-def embed_speaker(wavs, **kwargs):
-    raise NotImplemented()
+class StreamingEmbedder:
+    """
+    Computes the embedding of an utterance while its waveform is being received, e.g. from live
+    audio. The mel spectrogram is updated incrementally with each chunk of audio and a partial
+    embedding is computed as soon as the frames of a partial utterance are available, so that a
+    first embedding is available after <partial_utterance_n_frames> frames of audio (1.6s by
+    default). Only the samples and frames that are still needed are kept in memory, so streams
+    can be arbitrarily long.
+
+    The partial utterances are those of embed_utterance(), which returns the same embedding as
+    this class after flush() (up to floating point precision). Unlike preprocess_wav(), no volume
+    normalization or silence trimming is applied to the chunks, since they require the entire
+    waveform.
+    """
+    def __init__(self, partial_utterance_n_frames=partials_n_frames, min_pad_coverage=0.75,
+                 overlap=0.5, session: EncoderSession = None):
+        """
+        :param partial_utterance_n_frames: the number of mel spectrogram frames in each partial
+        utterance
+        :param min_pad_coverage: see compute_partial_slices(), only used when flushing.
+        :param overlap: by how much the partial utterances should overlap, see
+        compute_partial_slices().
+        :param session: the session that computes the embeddings. If None, that of the
+        module-level functions is used.
+        """
+        assert 0 <= overlap < 1
+        self.session = session
+        self.partial_utterance_n_frames = partial_utterance_n_frames
+        self.min_pad_coverage = min_pad_coverage
+        self.overlap = overlap
+        self.frame_step = max(int(np.round(partial_utterance_n_frames * (1 - overlap))), 1)
+        self.samples_per_frame = int((sampling_rate * mel_window_step / 1000))
+        self.n_fft = int(sampling_rate * mel_window_length / 1000)
+
+        # Samples are indexed as in the waveform padded by reflection at its start, as librosa
+        # does when computing the spectrogram. Only the samples that remain to be framed are kept.
+        self.n_samples = 0
+        self._samples = np.zeros(0, dtype=np.float32)
+        self._samples_start = 0
+
+        # Likewise, only the frames of the partial utterances that remain to be embedded are kept
+        self.n_frames = 0
+        self._frames = np.zeros((0, mel_n_channels), dtype=np.float32)
+        self._frames_start = 0
+
+        self.n_partials = 0
+        self._embeds_sum = np.zeros(model_embedding_size, dtype=np.float64)
+        self.finished = False
+
+    @property
+    def embedding(self):
+        """
+        The embedding of the audio received so far as a numpy array of float32 of shape
+        (model_embedding_size,), or None if there isn't enough audio for a partial utterance yet.
+        """
+        if self.n_partials == 0:
+            return None
+        return (self._embeds_sum / np.linalg.norm(self._embeds_sum, 2)).astype(np.float32)
+
+    def push(self, wav_chunk):
+        """
+        Adds audio to the stream and computes the embeddings of the partial utterances it
+        completes.
+
+        :param wav_chunk: the next samples of the waveform as a numpy array of floats, at the
+        sampling rate of the encoder.
+        :return: the new partial embeddings as a numpy array of float32 of shape (n_new_partials,
+        model_embedding_size).
+        """
+        if self.finished:
+            raise Exception("The stream was flushed, create a new StreamingEmbedder.")
+        wav_chunk = np.asarray(wav_chunk, dtype=np.float32)
+        self.n_samples += len(wav_chunk)
+
+        if self._samples_start == 0 and len(self._samples) <= self.n_fft // 2:
+            # The start of the waveform is padded once there are enough samples to reflect
+            self._samples = np.concatenate((self._samples, wav_chunk))
+            if len(self._samples) <= self.n_fft // 2:
+                return self._embed_partials()
+            self._samples = np.pad(self._samples, (self.n_fft // 2, 0), "reflect")
+        else:
+            self._samples = np.concatenate((self._samples, wav_chunk))
+
+        self._update_frames()
+        return self._embed_partials()
+
+    def flush(self):
+        """
+        Ends the stream. The last partial utterances are computed as embed_utterance() does, by
+        padding the waveform if needed.
+
+        :return: the new partial embeddings as a numpy array of float32 of shape (n_new_partials,
+        model_embedding_size).
+        """
+        if self.finished:
+            return np.zeros((0, model_embedding_size), dtype=np.float32)
+        self.finished = True
+
+        # Pad the waveform to the length embed_utterance() uses, and its end by reflection
+        wave_slices, _ = compute_partial_slices(self.n_samples, self.partial_utterance_n_frames,
+                                                self.min_pad_coverage, self.overlap)
+        n_padded = max(self.n_samples, wave_slices[-1].stop)
+        if self._samples_start == 0 and len(self._samples) == self.n_samples:
+            # The waveform is too short to have been padded at its start yet
+            wav = np.pad(self._samples, (0, n_padded - self.n_samples), "constant")
+            self._samples = np.pad(wav, self.n_fft // 2, "reflect")
+        else:
+            wav_end = np.pad(self._samples, (0, n_padded - self.n_samples), "constant")
+            self._samples = np.pad(wav_end, (0, self.n_fft // 2), "reflect")
+        self._update_frames()
+
+        return self._embed_partials(len(wave_slices))
+
+    def _update_frames(self):
+        # Compute all frames whose window is complete
+        samples_end = self._samples_start + len(self._samples)
+        n_frames = (samples_end - self.n_fft) // self.samples_per_frame + 1
+        if n_frames > self.n_frames:
+            offset = self.n_frames * self.samples_per_frame - self._samples_start
+            windows = np.lib.stride_tricks.as_strided(
+                self._samples[offset:],
+                shape=(n_frames - self.n_frames, self.n_fft),
+                strides=(self.samples_per_frame * self._samples.strides[0],
+                         self._samples.strides[0]),
+                writeable=False,
+            )
+            new_frames = audio.mel_spectrogram_windows(windows)
+            self._frames = np.concatenate((self._frames, new_frames))
+            self.n_frames = n_frames
+
+        # Forget the samples that won't be part of any window anymore
+        drop = self.n_frames * self.samples_per_frame - self._samples_start
+        self._samples = self._samples[drop:].copy()
+        self._samples_start += drop
+
+    def _embed_partials(self, max_partials=None):
+        # Gather the partial utterances whose frames are all available
+        frames_batch = []
+        while max_partials is None or self.n_partials + len(frames_batch) < max_partials:
+            start = (self.n_partials + len(frames_batch)) * self.frame_step - self._frames_start
+            end = start + self.partial_utterance_n_frames
+            if self._frames_start + end > self.n_frames:
+                break
+            frames_batch.append(self._frames[start:end])
+        if len(frames_batch) == 0:
+            return np.zeros((0, model_embedding_size), dtype=np.float32)
+
+        session = _get_session() if self.session is None else self.session
+        partial_embeds = session.embed_frames_batch(np.array(frames_batch))
+        self.n_partials += len(partial_embeds)
+        self._embeds_sum += partial_embeds.sum(axis=0)
+
+        # Forget the frames that won't be part of any partial utterance anymore
+        drop = min(self.n_partials * self.frame_step, self.n_frames) - self._frames_start
+        self._frames = self._frames[drop:]
+        self._frames_start += drop
+
+        return partial_embeds
 
 
 def plot_embedding_as_heatmap(embed, ax=None, title="", shape=None, color_range=(0, 0.30)):
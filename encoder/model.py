@@ -1,11 +1,7 @@
 from encoder.params_model import *
 from encoder.params_data import *
-from scipy.interpolate import interp1d
-from sklearn.metrics import roc_curve
 from torch.nn.utils import clip_grad_norm_
-from scipy.optimize import brentq
 from torch import nn
-import numpy as np
 import torch
 
 
@@ -23,9 +19,11 @@ class SpeakerEncoder(nn.Module):
                                 out_features=model_embedding_size).to(device)
         self.relu = torch.nn.ReLU().to(device)
         
-        # Cosine similarity scaling (with fixed initial parameter values)
-        self.similarity_weight = nn.Parameter(torch.tensor([10.])).to(loss_device)
-        self.similarity_bias = nn.Parameter(torch.tensor([-5.])).to(loss_device)
+        # Cosine similarity scaling (with fixed initial parameter values). The parameters are
+        # created on the loss device: moving them there with .to() would return tensors that are
+        # not parameters of the model, whose gradient is never set.
+        self.similarity_weight = nn.Parameter(torch.tensor([10.], device=loss_device))
+        self.similarity_bias = nn.Parameter(torch.tensor([-5.], device=loss_device))
 
         # Loss
         self.loss_fn = nn.CrossEntropyLoss().to(loss_device)
@@ -59,6 +57,35 @@ class SpeakerEncoder(nn.Module):
         embeds = embeds_raw / (torch.norm(embeds_raw, dim=1, keepdim=True) + 1e-5)        
 
         return embeds
+
+    def forward_sliding(self, utterances, partial_ends, hidden_init=None):
+        """
+        Experimental. Computes approximate embeddings of the overlapping partial utterances of a
+        batch of long utterances, running each frame through the LSTM once. Rather than starting
+        from a zero hidden state for each partial utterance, the LSTM runs over the whole
+        utterances and the embedding of each partial utterance is read from the state at its
+        last frame. This state also depends on the frames before the partial utterance, so the
+        embeddings differ from those of forward(). With partial utterances that overlap by 50%,
+        this takes about half the operations.
+
+        :param utterances: batch of mel-scale filterbanks of same duration as a tensor of shape
+        (batch_size, n_frames, n_channels)
+        :param partial_ends: the index of the frame following the last frame of each partial
+        utterance, in increasing order. The frames after the last partial utterance are ignored.
+        :param hidden_init: initial hidden and cell states of the LSTM as tensors of shape
+        (num_layers, batch_size, hidden_size), e.g. the states returned for the previous frames
+        of the utterances. Will default to tensors of zeros if None.
+        :return: the embeddings as a tensor of shape (batch_size, n_partials, embedding_size)
+        and the hidden and cell states of the LSTM after the last partial utterance.
+        """
+        partial_ends = torch.as_tensor(partial_ends, dtype=torch.long, device=utterances.device)
+        out, (hidden, cell) = self.lstm(utterances[:, :partial_ends[-1]], hidden_init)
+
+        # The output of the LSTM is the hidden state of the last layer at each frame
+        embeds_raw = self.relu(self.linear(out[:, partial_ends - 1]))
+        embeds = embeds_raw / (torch.norm(embeds_raw, dim=2, keepdim=True) + 1e-5)
+
+        return embeds, (hidden, cell)
     
     def similarity_matrix(self, embeds):
         """
@@ -81,36 +108,27 @@ class SpeakerEncoder(nn.Module):
         centroids_excl = centroids_excl.clone() / (torch.norm(centroids_excl, dim=2, keepdim=True) + 1e-5)
 
         # Similarity matrix. The cosine similarity of already 2-normed vectors is simply the dot
-        # product of these vectors (which is just an element-wise multiplication reduced by a sum).
-        # We vectorize the computation for efficiency.
-        sim_matrix = torch.zeros(speakers_per_batch, utterances_per_speaker,
-                                 speakers_per_batch).to(self.loss_device)
-        mask_matrix = 1 - np.eye(speakers_per_batch, dtype=np.int)
-        for j in range(speakers_per_batch):
-            mask = np.where(mask_matrix[j])[0]
-            sim_matrix[mask, :, j] = (embeds[mask] * centroids_incl[j]).sum(dim=2)
-            sim_matrix[j, :, j] = (embeds[j] * centroids_excl[j]).sum(dim=1)
-        
-        ## Even more vectorized version (slower maybe because of transpose)
-        # sim_matrix2 = torch.zeros(speakers_per_batch, speakers_per_batch, utterances_per_speaker
-        #                           ).to(self.loss_device)
-        # eye = np.eye(speakers_per_batch, dtype=np.int)
-        # mask = np.where(1 - eye)
-        # sim_matrix2[mask] = (embeds[mask[0]] * centroids_incl[mask[1]]).sum(dim=2)
-        # mask = np.where(eye)
-        # sim_matrix2[mask] = (embeds * centroids_excl).sum(dim=2)
-        # sim_matrix2 = sim_matrix2.transpose(1, 2)
-        
+        # product of these vectors. The similarities of all utterances with all inclusive
+        # centroids are computed at once, then those of each utterance with the centroid of its
+        # own speaker are replaced by the similarity with its exclusive centroid.
+        sim_matrix = torch.einsum("ije,ke->ijk", embeds, centroids_incl[:, 0])
+        sim_excl = torch.sum(embeds * centroids_excl, dim=2)
+        same_speaker = torch.eye(speakers_per_batch, dtype=torch.bool, device=embeds.device)
+        sim_matrix = torch.where(same_speaker[:, None, :], sim_excl[:, :, None], sim_matrix)
+
         sim_matrix = sim_matrix * self.similarity_weight + self.similarity_bias
         return sim_matrix
     
-    def loss(self, embeds):
+    def loss(self, embeds, compute_eer=True):
         """
         Computes the softmax loss according the section 2.1 of GE2E.
         
         :param embeds: the embeddings as a tensor of shape (speakers_per_batch, 
         utterances_per_speaker, embedding_size)
-        :return: the loss and the EER for this batch of embeddings.
+        :param compute_eer: whether to compute the EER. It is the only part of the loss that
+        waits for the device, so it can be skipped on most steps.
+        :return: the loss and the EER for this batch of embeddings, or None for the EER if
+        <compute_eer> is False.
         """
         speakers_per_batch, utterances_per_speaker = embeds.shape[:2]
         
@@ -118,18 +136,45 @@ class SpeakerEncoder(nn.Module):
         sim_matrix = self.similarity_matrix(embeds)
         sim_matrix = sim_matrix.reshape((speakers_per_batch * utterances_per_speaker, 
                                          speakers_per_batch))
-        ground_truth = np.repeat(np.arange(speakers_per_batch), utterances_per_speaker)
-        target = torch.from_numpy(ground_truth).long().to(self.loss_device)
+        target = torch.arange(speakers_per_batch, device=embeds.device)
+        target = target.repeat_interleave(utterances_per_speaker)
         loss = self.loss_fn(sim_matrix, target)
         
         # EER (not backpropagated)
-        with torch.no_grad():
-            inv_argmax = lambda i: np.eye(1, speakers_per_batch, i, dtype=np.int)[0]
-            labels = np.array([inv_argmax(i) for i in ground_truth])
-            preds = sim_matrix.detach().cpu().numpy()
-
-            # Snippet from https://yangcha.github.io/EER-ROC/
-            fpr, tpr, thresholds = roc_curve(labels.flatten(), preds.flatten())           
-            eer = brentq(lambda x: 1. - x - interp1d(fpr, tpr)(x), 0., 1.)
+        eer = None
+        if compute_eer:
+            with torch.no_grad():
+                labels = nn.functional.one_hot(target, speakers_per_batch).bool()
+                eer = equal_error_rate(sim_matrix.detach().flatten(), labels.flatten())
             
         return loss, eer
+
+
+def equal_error_rate(scores, labels):
+    """
+    Computes the equal error rate of binary predictions on the device of the scores, as the
+    false positive rate at which it equals the false negative rate. The ROC curve is
+    interpolated linearly between thresholds, as with sklearn.metrics.roc_curve() and
+    scipy.interpolate.interp1d().
+
+    :param scores: the scores of the predictions as a tensor of shape (n,). Higher is positive.
+    :param labels: the ground truth as a tensor of bools of shape (n,)
+    :return: the EER as a float
+    """
+    # Count the true and false positives at each threshold, from the highest score to the lowest.
+    # Predictions with the same score share a threshold, so only the last one of each is kept.
+    scores, order = torch.sort(scores, descending=True)
+    labels = labels[order]
+    tps = torch.cumsum(labels, dim=0)
+    fps = torch.arange(1, len(labels) + 1, device=labels.device) - tps
+    thresholds = torch.cat((scores[1:] != scores[:-1], scores.new_ones(1, dtype=torch.bool)))
+    zero = tps.new_zeros(1)
+    tpr = torch.cat((zero, tps[thresholds])) / tps[-1]
+    fpr = torch.cat((zero, fps[thresholds])) / fps[-1]
+
+    # The false negative rate minus the false positive rate decreases from 1 to -1, the EER is
+    # where the segment of the ROC curve on which it changes sign crosses 0
+    diff = 1 - tpr - fpr
+    i = torch.nonzero(diff <= 0)[0, 0]
+    eer = fpr[i - 1] + (fpr[i] - fpr[i - 1]) * diff[i - 1] / (diff[i - 1] - diff[i])
+    return eer.item()
@@ -11,6 +11,8 @@ sampling_rate = 16000
 partials_n_frames = 160     # 1600 ms
 # Number of spectrogram frames at inference
 inference_n_frames = 80     #  800 ms
+# Maximum number of partial utterances forwarded at once when embedding several utterances
+inference_max_batch_size = 256
 
 
 ## Voice Activation Detection
@@ -22,6 +24,12 @@ vad_window_length = 30  # In milliseconds
 vad_moving_average_width = 8
 # Maximum number of consecutive silent frames a segment can have.
 vad_max_silence_length = 6
+# Minimum energy above the noise floor for a window to be considered voiced, when using the
+# energy-based VAD.
+vad_energy_threshold_dB = 6
+# Maximum spectral flatness for a window to be considered voiced, when using the energy-based VAD.
+# Noise has a flatness close to 1, voiced speech a flatness close to 0.
+vad_energy_max_flatness = 0.3
 
 
 ## Audio volume normalization
@@ -1,7 +1,11 @@
 from datetime import datetime
-from functools import partial
 from multiprocessing import Pool
+from time import perf_counter as timer
 from pathlib import Path
+from array import array
+import shutil
+import json
+import os
 
 import numpy as np
 from tqdm import tqdm
@@ -40,7 +44,7 @@ class DatasetLog:
     def add_sample(self, **kwargs):
         for param_name, value in kwargs.items():
             if not param_name in self.sample_data:
-                self.sample_data[param_name] = []
+                self.sample_data[param_name] = array("d")
             self.sample_data[param_name].append(value)
 
     def finalize(self):
@@ -63,74 +67,196 @@ def _init_preprocess_dataset(dataset_name, datasets_root, out_dir) -> (Path, Dat
     return dataset_root, DatasetLog(out_dir, dataset_name)
 
 
-def _preprocess_speaker(speaker_dir: Path, datasets_root: Path, out_dir: Path, skip_existing: bool):
-    # Give a name to the speaker that includes its dataset
-    speaker_name = "_".join(speaker_dir.relative_to(datasets_root).parts)
-
-    # Create an output directory with that name, as well as a txt file containing a
-    # reference to each source file.
-    speaker_out_dir = out_dir.joinpath(speaker_name)
-    speaker_out_dir.mkdir(exist_ok=True)
-    sources_fpath = speaker_out_dir.joinpath("_sources.txt")
+def _list_utterances(speaker_dirs, datasets_root: Path, out_dir: Path, skip_existing: bool,
+                     journal_fpath: Path):
+    """
+    Lists the audio files of the speakers that remain to be preprocessed, grouped by speaker.
+    With skip_existing, the files listed in the journal of a previous run or in the _sources.txt
+    of their speaker are skipped.
 
-    # There's a possibility that the preprocessing was interrupted earlier, check if
-    # there already is a sources file.
-    if sources_fpath.exists():
-        try:
+    :return: a list of tuples (speaker_out_dir, in_fpath, out_fname), with in_fpath relative to
+    datasets_root
+    """
+    journal = _read_journal(journal_fpath) if skip_existing else set()
+    utterances = []
+    for speaker_dir in speaker_dirs:
+        # Give a name to the speaker that includes its dataset
+        speaker_name = "_".join(speaker_dir.relative_to(datasets_root).parts)
+
+        # Create an output directory with that name, as well as a txt file containing a
+        # reference to each source file.
+        speaker_out_dir = out_dir.joinpath(speaker_name)
+        speaker_out_dir.mkdir(exist_ok=True)
+        sources_fpath = speaker_out_dir.joinpath("_sources.txt")
+
+        # There's a possibility that the preprocessing was interrupted earlier, check if
+        # there already is a sources file.
+        existing_fnames = set()
+        if skip_existing and sources_fpath.exists():
             with sources_fpath.open("r") as sources_file:
                 existing_fnames = {line.split(",")[0] for line in sources_file}
-        except:
-            existing_fnames = {}
-    else:
-        existing_fnames = {}
-
-    # Gather all audio files for that speaker recursively
-    sources_file = sources_fpath.open("a" if skip_existing else "w")
-    audio_durs = []
-    for extension in _AUDIO_EXTENSIONS:
-        for in_fpath in speaker_dir.glob("**/*.%s" % extension):
-            # Check if the target output file already exists
-            out_fname = "_".join(in_fpath.relative_to(speaker_dir).parts)
-            out_fname = out_fname.replace(".%s" % extension, ".npy")
-            if skip_existing and out_fname in existing_fnames:
-                continue
-
-            # Load and preprocess the waveform
-            wav = audio.preprocess_wav(in_fpath)
-            if len(wav) == 0:
-                continue
-
-            # Create the mel spectrogram, discard those that are too short
-            frames = audio.wav_to_mel_spectrogram(wav)
-            if len(frames) < partials_n_frames:
-                continue
-
-            out_fpath = speaker_out_dir.joinpath(out_fname)
-            np.save(out_fpath, frames)
-            sources_file.write("%s,%s\n" % (out_fname, in_fpath))
-            audio_durs.append(len(wav) / sampling_rate)
-
-    sources_file.close()
-
-    return audio_durs
-
-
-def _preprocess_speaker_dirs(speaker_dirs, dataset_name, datasets_root, out_dir, skip_existing, logger):
-    print("%s: Preprocessing data for %d speakers." % (dataset_name, len(speaker_dirs)))
-
-    # Process the utterances for each speaker
-    work_fn = partial(_preprocess_speaker, datasets_root=datasets_root, out_dir=out_dir, skip_existing=skip_existing)
-    with Pool(4) as pool:
-        tasks = pool.imap(work_fn, speaker_dirs)
-        for sample_durs in tqdm(tasks, dataset_name, len(speaker_dirs), unit="speakers"):
-            for sample_dur in sample_durs:
-                logger.add_sample(duration=sample_dur)
+        sources_fpath.open("a" if skip_existing else "w").close()
+
+        # Gather all audio files for that speaker recursively
+        for extension in _AUDIO_EXTENSIONS:
+            for in_fpath in speaker_dir.glob("**/*.%s" % extension):
+                out_fname = "_".join(in_fpath.relative_to(speaker_dir).parts)
+                out_fname = out_fname.replace(".%s" % extension, ".npy")
+                in_fpath = str(in_fpath.relative_to(datasets_root))
+                if out_fname in existing_fnames or in_fpath in journal:
+                    continue
+                utterances.append((speaker_out_dir, in_fpath, out_fname))
+
+    return utterances
+
+
+def _read_journal(journal_fpath: Path):
+    if not journal_fpath.exists():
+        return set()
+    with journal_fpath.open("r") as journal_file:
+        # A line without its newline was being written when the preprocessing was interrupted
+        return {line[:-1] for line in journal_file if line.endswith("\n")}
+
+
+def _preprocess_utterance(in_fpath: Path):
+    # Runs in the workers. The frames are None if the utterance is discarded.
+    wav = audio.preprocess_wav(in_fpath)
+    if len(wav) == 0:
+        return None, 0
 
+    # Create the mel spectrogram, discard those that are too short
+    frames = audio.wav_to_mel_spectrogram(wav)
+    if len(frames) < partials_n_frames:
+        frames = None
+    return frames, len(wav) / sampling_rate
+
+
+class _UtteranceWriter:
+    """
+    Writes the utterances preprocessed by the workers, in the order they were listed: the frames,
+    the line of _sources.txt of their speaker, and last the line of the journal. The journal lists
+    every audio file preprocessed, including those discarded, and is synced to the disk every
+    <sync_every> seconds, so that an interrupted preprocessing resumes where it stopped. The frames
+    are written to a temporary file and then renamed, so that an utterance in the journal is never
+    left truncated, and synced to the disk with the journal rather than one by one.
+    """
+    def __init__(self, datasets_root: Path, journal_fpath: Path, skip_existing: bool,
+                 sync_every=1.):
+        self.datasets_root = datasets_root
+        self.journal_file = journal_fpath.open("a" if skip_existing else "w")
+        if self.journal_file.tell() > 0:
+            # End the line that was being written if the preprocessing was interrupted
+            with journal_fpath.open("rb") as journal_file:
+                journal_file.seek(-1, os.SEEK_END)
+                if journal_file.read(1) != b"\n":
+                    self.journal_file.write("\n")
+        self.sync_every = sync_every
+        self.last_sync = timer()
+        self.sources_file = None
+        # The frames written since the last sync, and their directories
+        self.pending_fpaths = []
+        self.pending_dirs = set()
+
+    def write(self, speaker_out_dir: Path, in_fpath: str, out_fname: str, frames: np.ndarray):
+        if frames is not None:
+            sources_fpath = speaker_out_dir.joinpath("_sources.txt")
+            if self.sources_file is None or self.sources_file.name != str(sources_fpath):
+                self._close_sources()
+                self.sources_file = sources_fpath.open("a")
+            self._save_frames(speaker_out_dir.joinpath(out_fname), frames)
+            self.sources_file.write("%s,%s\n" % (out_fname, self.datasets_root / in_fpath))
+            # The journal is buffered separately and may reach the OS first when its buffer is
+            # full: the line of the sources must reach it before, even if the process is killed
+            self.sources_file.flush()
+
+        self.journal_file.write("%s\n" % in_fpath)
+        if timer() - self.last_sync >= self.sync_every:
+            self._sync()
+
+    def _save_frames(self, out_fpath: Path, frames: np.ndarray):
+        tmp_fpath = out_fpath.with_name(out_fpath.name + ".tmp")
+        with tmp_fpath.open("wb") as tmp_file:
+            np.save(tmp_file, frames)
+        os.replace(tmp_fpath, out_fpath)
+        self.pending_fpaths.append(out_fpath)
+        self.pending_dirs.add(out_fpath.parent)
+
+    def _sync(self):
+        # The frames and the sources are synced first, the journal must not be ahead of them
+        for fpath in self.pending_fpaths:
+            _fsync_path(fpath)
+        # The renames are synced with their directories, which can't be opened on Windows
+        if os.name != "nt":
+            for dpath in self.pending_dirs:
+                _fsync_path(dpath)
+        self.pending_fpaths = []
+        self.pending_dirs = set()
+        if self.sources_file is not None:
+            self.sources_file.flush()
+            os.fsync(self.sources_file.fileno())
+        self.journal_file.flush()
+        os.fsync(self.journal_file.fileno())
+        self.last_sync = timer()
+
+    def _close_sources(self):
+        if self.sources_file is not None:
+            self.sources_file.flush()
+            os.fsync(self.sources_file.fileno())
+            self.sources_file.close()
+            self.sources_file = None
+
+    def close(self):
+        self._sync()
+        self._close_sources()
+        self.journal_file.close()
+
+
+def _fsync_path(fpath: Path):
+    fd = os.open(fpath, os.O_RDONLY if fpath.is_dir() else os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _preprocess_speaker_dirs(speaker_dirs, dataset_name, datasets_root, out_dir, skip_existing,
+                             logger, n_processes):
+    journal_fpath = out_dir.joinpath("_journal_%s.lst" % dataset_name.replace("/", "_"))
+    utterances = _list_utterances(speaker_dirs, datasets_root, out_dir, skip_existing,
+                                  journal_fpath)
+    print("%s: Preprocessing %d utterances of %d speakers with %d processes." %
+          (dataset_name, len(utterances), len(speaker_dirs), n_processes))
+
+    # The utterances are scheduled one by one, so that a speaker with many of them does not hold
+    # up a worker, and received in order
+    in_fpaths = [datasets_root.joinpath(in_fpath) for _, in_fpath, _ in utterances]
+    writer = _UtteranceWriter(datasets_root, journal_fpath, skip_existing)
+    total_dur = 0
+    start = timer()
+    try:
+        with Pool(n_processes) as pool:
+            tasks = pool.imap(_preprocess_utterance, in_fpaths, chunksize=4)
+            progress = tqdm(zip(utterances, tasks), dataset_name, len(utterances),
+                            unit="utterances")
+            for (speaker_out_dir, in_fpath, out_fname), (frames, duration) in progress:
+                writer.write(speaker_out_dir, in_fpath, out_fname, frames)
+                if frames is not None:
+                    logger.add_sample(duration=duration)
+                total_dur += duration
+                progress.set_postfix_str("%.2f hours of audio/min" %
+                                         (total_dur / 3600 / ((timer() - start) / 60)), False)
+    finally:
+        # Keep the progress made if the preprocessing is interrupted
+        writer.close()
+
+    throughput = total_dur / 3600 / ((timer() - start) / 60)
+    logger.write_line("Preprocessed %.1f hours of audio at %.2f hours/min with %d processes" %
+                      (total_dur / 3600, throughput, n_processes))
     logger.finalize()
     print("Done preprocessing %s.\n" % dataset_name)
 
 
-def preprocess_librispeech(datasets_root: Path, out_dir: Path, skip_existing=False):
+def preprocess_librispeech(datasets_root: Path, out_dir: Path, skip_existing=False, n_processes=4):
     for dataset_name in librispeech_datasets["train"]["other"]:
         # Initialize the preprocessing
         dataset_root, logger = _init_preprocess_dataset(dataset_name, datasets_root, out_dir)
@@ -139,10 +265,11 @@ def preprocess_librispeech(datasets_root: Path, out_dir: Path, skip_existing=Fal
 
         # Preprocess all speakers
         speaker_dirs = list(dataset_root.glob("*"))
-        _preprocess_speaker_dirs(speaker_dirs, dataset_name, datasets_root, out_dir, skip_existing, logger)
+        _preprocess_speaker_dirs(speaker_dirs, dataset_name, datasets_root, out_dir, skip_existing,
+                                 logger, n_processes)
 
 
-def preprocess_voxceleb1(datasets_root: Path, out_dir: Path, skip_existing=False):
+def preprocess_voxceleb1(datasets_root: Path, out_dir: Path, skip_existing=False, n_processes=4):
     # Initialize the preprocessing
     dataset_name = "VoxCeleb1"
     dataset_root, logger = _init_preprocess_dataset(dataset_name, datasets_root, out_dir)
@@ -168,10 +295,11 @@ def preprocess_voxceleb1(datasets_root: Path, out_dir: Path, skip_existing=False
           (len(speaker_dirs), len(keep_speaker_ids) - len(speaker_dirs)))
 
     # Preprocess all speakers
-    _preprocess_speaker_dirs(speaker_dirs, dataset_name, datasets_root, out_dir, skip_existing, logger)
+    _preprocess_speaker_dirs(speaker_dirs, dataset_name, datasets_root, out_dir, skip_existing,
+                             logger, n_processes)
 
 
-def preprocess_voxceleb2(datasets_root: Path, out_dir: Path, skip_existing=False):
+def preprocess_voxceleb2(datasets_root: Path, out_dir: Path, skip_existing=False, n_processes=4):
     # Initialize the preprocessing
     dataset_name = "VoxCeleb2"
     dataset_root, logger = _init_preprocess_dataset(dataset_name, datasets_root, out_dir)
@@ -181,4 +309,70 @@ def preprocess_voxceleb2(datasets_root: Path, out_dir: Path, skip_existing=False
     # Get the speaker directories
     # Preprocess all speakers
     speaker_dirs = list(dataset_root.joinpath("dev", "aac").glob("*"))
-    _preprocess_speaker_dirs(speaker_dirs, dataset_name, datasets_root, out_dir, skip_existing, logger)
+    _preprocess_speaker_dirs(speaker_dirs, dataset_name, datasets_root, out_dir, skip_existing,
+                             logger, n_processes)
+
+
+def pack_dataset(clean_data_root: Path, out_dir: Path, max_shard_size=1 << 30, dtype="float32"):
+    """
+    Packs the output of the preprocessing in a few large files that the training reads from
+    faster than from one file per utterance. The frames of all utterances are concatenated in
+    shards of about <max_shard_size> bytes, a speaker never being split between two shards.
+    The index _index.csv gives the speaker, the shard and the range of frames of each utterance
+    in the shard, and _packed.json the data type of the shards.
+
+    :param clean_data_root: the output directory of the preprocessing
+    :param out_dir: the directory of the packed dataset. SpeakerVerificationDataset reads it
+    like the output of the preprocessing.
+    :param max_shard_size: the size in bytes above which a shard gets no more speakers
+    :param dtype: the data type of the frames in the shards, either "float32" or "float16" to
+    halve their size. In float16, the frames are exact to about 3 significant digits.
+    """
+    if dtype not in ["float32", "float16"]:
+        raise ValueError("Unsupported data type \"%s\", use float32 or float16" % dtype)
+    speaker_dirs = sorted(f for f in clean_data_root.glob("*") if f.is_dir())
+    if len(speaker_dirs) == 0:
+        raise Exception("No speakers found in %s" % clean_data_root)
+    out_dir.mkdir(exist_ok=True, parents=True)
+
+    # The index is written last, so that an interrupted packing is not mistaken for a dataset
+    index_fpath = out_dir.joinpath("_index.csv")
+    index_tmp_fpath = out_dir.joinpath("_index.csv.tmp")
+    index_file = index_tmp_fpath.open("w")
+    shard_id, shard_file, shard_n_frames = -1, None, 0
+    frame_size = mel_n_channels * np.dtype(dtype).itemsize
+    for speaker_dir in tqdm(speaker_dirs, "Packing", unit="speakers"):
+        sources_fpath = speaker_dir.joinpath("_sources.txt")
+        if not sources_fpath.exists():
+            continue
+        with sources_fpath.open("r") as sources_file:
+            sources = dict(line.rstrip("\n").split(",", 1) for line in sources_file)
+
+        # Start a new shard once the current one is full
+        if shard_file is None or shard_n_frames * frame_size >= max_shard_size:
+            if shard_file is not None:
+                shard_file.close()
+            shard_id += 1
+            shard_fname = "shard_%05d.bin" % shard_id
+            shard_file = out_dir.joinpath(shard_fname).open("wb")
+            shard_n_frames = 0
+
+        for frames_fname, wave_fpath in sources.items():
+            frames = np.load(speaker_dir.joinpath(frames_fname)).astype(dtype)
+            if not np.isfinite(frames).all():
+                raise ValueError("The frames of %s overflow in %s" % (frames_fname, dtype))
+            shard_file.write(frames.tobytes())
+            index_file.write("%s,%s,%d,%d,%s\n" % (speaker_dir.name, shard_fname, shard_n_frames,
+                                                   shard_n_frames + len(frames), wave_fpath))
+            shard_n_frames += len(frames)
+
+    if shard_file is not None:
+        shard_file.close()
+    index_file.close()
+    index_tmp_fpath.replace(index_fpath)
+    with out_dir.joinpath("_packed.json").open("w") as info_file:
+        json.dump({"dtype": dtype, "n_shards": shard_id + 1}, info_file)
+
+    # Keep the logs of the preprocessing, they are shown during training
+    for log_fpath in clean_data_root.glob("Log_*.txt"):
+        shutil.copy(log_fpath, out_dir.joinpath(log_fpath.name))
@@ -1,11 +1,17 @@
 from pathlib import Path
+import os
 
 import torch
+import torch.distributed as dist
+from torch.distributed.nn.functional import all_gather
+from torch.nn.parallel import DistributedDataParallel
 
-from encoder.data_objects import SpeakerVerificationDataLoader, SpeakerVerificationDataset
+from encoder.data_objects import SpeakerVerificationDataLoader, SpeakerVerificationDataset, \
+    BatchPrefetcher
 from encoder.model import SpeakerEncoder
 from encoder.params_model import *
 from encoder.visualizations import Visualizations
+from utils.checkpoint_writer import CheckpointWriter
 from utils.profiler import Profiler
 
 
@@ -15,31 +21,64 @@ def sync(device: torch.device):
         torch.cuda.synchronize(device)
 
 
+def gather_embeds(embeds: torch.Tensor):
+    """
+    Concatenates the embeddings of all processes of a distributed training, in the order of their
+    rank. The gradient of the loss computed on the result by each process flows back to the
+    embeddings of every process, summed over processes.
+    """
+    return torch.cat(all_gather(embeds), dim=0)
+
+
 def train(run_id: str, clean_data_root: Path, models_dir: Path, umap_every: int, save_every: int,
           backup_every: int, vis_every: int, force_restart: bool, visdom_server: str,
-          no_visdom: bool):
+          no_visdom: bool, eer_every=10, speaker_pool_size=0, speaker_pool_reuse=20,
+          frame_cache_size=1024, prefetch_batches=2, amp=False, keep_backups=0):
+    # Distributed training, with one process per GPU launched by torchrun. Each process computes
+    # the embeddings of speakers_per_batch / world_size speakers, and the loss on the embeddings
+    # of all processes.
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    rank = int(os.environ.get("RANK", 0))
+    if world_size > 1:
+        if speakers_per_batch % world_size != 0:
+            raise ValueError("The %d speakers per batch can't be split between %d processes" %
+                             (speakers_per_batch, world_size))
+        dist.init_process_group("nccl" if torch.cuda.is_available() else "gloo")
+
     # Create a dataset and a dataloader
-    dataset = SpeakerVerificationDataset(clean_data_root)
+    dataset = SpeakerVerificationDataset(clean_data_root, speaker_pool_size, speaker_pool_reuse,
+                                         cache_size=frame_cache_size * 1024 ** 2, rank=rank,
+                                         world_size=world_size,
+                                         speakers_per_batch=speakers_per_batch // world_size)
     loader = SpeakerVerificationDataLoader(
         dataset,
-        speakers_per_batch,
+        speakers_per_batch // world_size,
         utterances_per_speaker,
         num_workers=4,
     )
 
-    # Setup the device on which to run the forward pass and the loss. These can be different,
-    # because the forward pass is faster on the GPU whereas the loss is often (depending on your
-    # hyperparameters) faster on the CPU.
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    # FIXME: currently, the gradient is None if loss_device is cuda
-    loss_device = torch.device("cpu")
+    # Setup the device on which to run the forward pass and the loss. These can be different, but
+    # the computation of the loss is vectorized and runs faster next to the embeddings.
+    if torch.cuda.is_available():
+        device = torch.device("cuda", int(os.environ.get("LOCAL_RANK", 0)))
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device("cpu")
+    loss_device = device
+
+    # Mixed precision: the forward pass runs in float16 where it is safe, the loss in float32
+    if amp and device.type != "cuda":
+        print("Mixed precision requires a GPU, training in float32.")
+        amp = False
+    scaler = torch.cuda.amp.GradScaler(enabled=amp)
 
     # Create the model and the optimizer
     model = SpeakerEncoder(device, loss_device)
     optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate_init)
     init_step = 1
 
-    # Configure file path for the model
+    # Configure file path for the model. The model is saved from a background thread.
+    writer = CheckpointWriter(keep_backups)
     model_dir = models_dir / run_id
     model_dir.mkdir(exist_ok=True, parents=True)
     state_fpath = model_dir / "encoder.pt"
@@ -48,78 +87,112 @@ def train(run_id: str, clean_data_root: Path, models_dir: Path, umap_every: int,
     if not force_restart:
         if state_fpath.exists():
             print("Found existing model \"%s\", loading it and resuming training." % run_id)
-            checkpoint = torch.load(state_fpath)
+            checkpoint = torch.load(state_fpath, map_location=device)
             init_step = checkpoint["step"]
             model.load_state_dict(checkpoint["model_state"])
             optimizer.load_state_dict(checkpoint["optimizer_state"])
             optimizer.param_groups[0]["lr"] = learning_rate_init
+            if amp and "scaler_state" in checkpoint:
+                scaler.load_state_dict(checkpoint["scaler_state"])
         else:
             print("No model \"%s\" found, starting training from scratch." % run_id)
     else:
         print("Starting the training from scratch.")
     model.train()
 
-    # Initialize the visualization environment
-    vis = Visualizations(run_id, vis_every, server=visdom_server, disabled=no_visdom)
-    vis.log_dataset(dataset)
-    vis.log_params()
-    device_name = str(torch.cuda.get_device_name(0) if torch.cuda.is_available() else "CPU")
-    vis.log_implementation({"Device": device_name})
+    # The gradients are averaged between processes by DDP, the model saved is the one it wraps
+    encoder = model
+    if world_size > 1:
+        device_ids = [device] if device.type == "cuda" else None
+        model = DistributedDataParallel(model, device_ids=device_ids)
+
+    # Initialize the visualization environment. Only the first process reports and saves the model.
+    if rank == 0:
+        vis = Visualizations(run_id, vis_every, server=visdom_server, disabled=no_visdom)
+        vis.log_dataset(dataset)
+        vis.log_params()
+        device_name = str(torch.cuda.get_device_name(0) if torch.cuda.is_available() else "CPU")
+        vis.log_implementation({"Device": device_name, "Processes": world_size,
+                                "Mixed precision": amp})
 
     # Training loop
-    profiler = Profiler(summarize_every=10, disabled=False)
-    for step, speaker_batch in enumerate(loader, init_step):
+    profiler = Profiler(summarize_every=10, disabled=rank != 0)
+    cache_stats = []
+    batches = BatchPrefetcher(loader, device, prefetch_batches)
+    for step, (speaker_batch, inputs) in enumerate(batches, init_step):
         profiler.tick("Blocking, waiting for batch (threaded)")
+        # Only rank 0 reports the statistics of the frame cache
+        if rank == 0 and speaker_batch.cache_stats is not None:
+            cache_stats.append(speaker_batch.cache_stats)
 
         # Forward pass
-        inputs = torch.from_numpy(speaker_batch.data).to(device)
-        sync(device)
-        profiler.tick("Data to %s" % device)
-        embeds = model(inputs)
+        with torch.cuda.amp.autocast(enabled=amp):
+            embeds = model(inputs)
+        embeds = embeds.float()
+        if world_size > 1:
+            embeds = gather_embeds(embeds)
         sync(device)
         profiler.tick("Forward pass")
         embeds_loss = embeds.view((speakers_per_batch, utterances_per_speaker, -1)).to(loss_device)
-        loss, eer = model.loss(embeds_loss)
+        loss, eer = encoder.loss(embeds_loss, compute_eer=eer_every != 0 and step % eer_every == 0)
         sync(loss_device)
         profiler.tick("Loss")
 
-        # Backward pass
+        # Backward pass. Each process computes the same loss: the gradients of its embeddings are
+        # summed over processes by gather_embeds(), then averaged by DDP, which gives the
+        # gradients of the loss.
         model.zero_grad()
-        loss.backward()
+        scaler.scale(loss).backward()
         profiler.tick("Backward pass")
-        model.do_gradient_ops()
-        optimizer.step()
+        scaler.unscale_(optimizer)
+        encoder.do_gradient_ops()
+        scaler.step(optimizer)
+        scaler.update()
         profiler.tick("Parameter update")
 
+        if rank != 0:
+            continue
+
         # Update visualizations
         # learning_rate = optimizer.param_groups[0]["lr"]
         vis.update(loss.item(), eer, step)
 
+        # Report the efficiency of the frame cache of the speaker pool
+        if step % vis_every == 0 and len(cache_stats) > 0:
+            hits = sum(stats["hits"] for stats in cache_stats)
+            misses = sum(stats["misses"] for stats in cache_stats)
+            bytes_read = sum(stats["bytes_read"] for stats in cache_stats)
+            print("Frame cache: hit rate %.1f%%, %.1fMB read per step" %
+                  (100 * hits / max(hits + misses, 1), bytes_read / len(cache_stats) / 1e6))
+            cache_stats = []
+
         # Draw projections and save them to the backup folder
         if umap_every != 0 and step % umap_every == 0:
             print("Drawing and saving projections (step %d)" % step)
             projection_fpath = model_dir / f"umap_{step:06d}.png"
             embeds = embeds.detach().cpu().numpy()
+            # The environment is saved once the projections are drawn, in the background
             vis.draw_projections(embeds, utterances_per_speaker, step, projection_fpath)
-            vis.save()
 
         # Overwrite the latest version of the model
         if save_every != 0 and step % save_every == 0:
-            print("Saving the model (step %d)" % step)
-            torch.save({
+            stall = writer.save({
                 "step": step + 1,
-                "model_state": model.state_dict(),
+                "model_state": encoder.state_dict(),
                 "optimizer_state": optimizer.state_dict(),
+                "scaler_state": scaler.state_dict(),
             }, state_fpath)
+            print("Saving the model (step %d), training stalled %dms" % (step, stall * 1000))
 
         # Make a backup
         if backup_every != 0 and step % backup_every == 0:
-            print("Making a backup (step %d)" % step)
             backup_fpath = model_dir / f"encoder_{step:06d}.bak"
-            torch.save({
+            stall = writer.save({
                 "step": step + 1,
-                "model_state": model.state_dict(),
+                "model_state": encoder.state_dict(),
                 "optimizer_state": optimizer.state_dict(),
-            }, backup_fpath)
+                "scaler_state": scaler.state_dict(),
+            }, backup_fpath, "encoder_*.bak")
+            print("Making a backup (step %d), training stalled %dms" % (step, stall * 1000))
 
         profiler.tick("Extras (visualizations, saving)")
@@ -1,11 +1,12 @@
 from datetime import datetime
 from time import perf_counter as timer
+from io import StringIO
 
 import numpy as np
-import umap
 import visdom
 
 from encoder.data_objects.speaker_verification_dataset import SpeakerVerificationDataset
+from utils.projections import ProjectionService
 
 
 colormap = np.array([
@@ -35,6 +36,9 @@ class Visualizations:
         self.eers = []
         print("Updating the visualizations every %d steps." % update_every)
 
+        # The projections are drawn in the background, with the default parameters of UMAP
+        self.projections = ProjectionService(n_neighbors=15, metric="euclidean")
+
         # If visdom is disabled TODO: use a better paradigm for that
         self.disabled = disabled
         if self.disabled:
@@ -106,7 +110,8 @@ class Visualizations:
         self.step_times.append(1000 * (now - self.last_update_timestamp))
         self.last_update_timestamp = now
         self.losses.append(loss)
-        self.eers.append(eer)
+        if eer is not None:
+            self.eers.append(eer)
         print(".", end="")
 
         # Update the plots every <update_every> steps
@@ -114,8 +119,9 @@ class Visualizations:
             return
         time_string = "Step time:  mean: %5dms  std: %5dms" % \
                       (int(np.mean(self.step_times)), int(np.std(self.step_times)))
-        print("\nStep %6d   Loss: %.4f   EER: %.4f   %s" %
-              (step, np.mean(self.losses), np.mean(self.eers), time_string))
+        eer_string = "%.4f" % np.mean(self.eers) if len(self.eers) > 0 else "-"
+        print("\nStep %6d   Loss: %.4f   EER: %s   %s" %
+              (step, np.mean(self.losses), eer_string, time_string))
         if not self.disabled:
             self.loss_win = self.vis.line(
                 [np.mean(self.losses)],
@@ -129,18 +135,19 @@ class Visualizations:
                     title="Loss",
                 )
             )
-            self.eer_win = self.vis.line(
-                [np.mean(self.eers)],
-                [step],
-                win=self.eer_win,
-                update="append" if self.eer_win else None,
-                opts=dict(
-                    legend=["Avg. EER"],
-                    xlabel="Step",
-                    ylabel="EER",
-                    title="Equal error rate"
+            if len(self.eers) > 0:
+                self.eer_win = self.vis.line(
+                    [np.mean(self.eers)],
+                    [step],
+                    win=self.eer_win,
+                    update="append" if self.eer_win else None,
+                    opts=dict(
+                        legend=["Avg. EER"],
+                        xlabel="Step",
+                        ylabel="EER",
+                        title="Equal error rate"
+                    )
                 )
-            )
             if self.implementation_win is not None:
                 self.vis.text(
                     self.implementation_string + ("<b>%s</b>" % time_string),
@@ -154,8 +161,11 @@ class Visualizations:
         self.step_times.clear()
 
     def draw_projections(self, embeds, utterances_per_speaker, step, out_fpath=None, max_speakers=10):
-        import matplotlib.pyplot as plt
-
+        """
+        Draws the projections of the embeddings in the background, to visdom and to <out_fpath>
+        if given, then saves the visdom environment with them. If the previous projections are
+        still being computed, only the latest ones requested are drawn once they are done.
+        """
         max_speakers = min(max_speakers, len(colormap))
         embeds = embeds[:max_speakers * utterances_per_speaker]
 
@@ -163,16 +173,22 @@ class Visualizations:
         ground_truth = np.repeat(np.arange(n_speakers), utterances_per_speaker)
         colors = [colormap[i] for i in ground_truth]
 
-        reducer = umap.UMAP()
-        projected = reducer.fit_transform(embeds)
-        plt.scatter(projected[:, 0], projected[:, 1], c=colors)
-        plt.gca().set_aspect("equal", "datalim")
-        plt.title("UMAP projection (step %d)" % step)
-        if not self.disabled:
-            self.projection_win = self.vis.matplot(plt, win=self.projection_win)
-        if out_fpath is not None:
-            plt.savefig(out_fpath)
-        plt.clf()
+        def draw(projected, method):
+            # Drawn with a figure of its own rather than with pyplot, which is not thread-safe
+            from matplotlib.figure import Figure
+            fig = Figure()
+            ax = fig.subplots()
+            ax.scatter(projected[:, 0], projected[:, 1], c=colors)
+            ax.set_aspect("equal", "datalim")
+            ax.set_title("%s projection (step %d)" % (method.upper(), step))
+            if not self.disabled:
+                svg = StringIO()
+                fig.savefig(svg, format="svg")
+                self.projection_win = self.vis.svg(svg.getvalue(), win=self.projection_win)
+            if out_fpath is not None:
+                fig.savefig(out_fpath)
+            self.save()
+        self.projections.project_async(embeds, draw)
 
     def save(self):
         if not self.disabled:
@@ -0,0 +1,35 @@
+from encoder.inference import convert_model, export_model
+from utils.argutils import print_args
+from pathlib import Path
+import argparse
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Exports a trained speaker encoder for inference, either to TorchScript or with "
+                    "--slim to a file of its weights only. Load the exported model with "
+                    "encoder.inference.load_model(..., backend=\"torchscript\") or, for the slim "
+                    "file, with the eager or int8 backends.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("weights_fpath", type=Path, help=\
+        "Path to the saved encoder, e.g. saved_models/default/encoder.pt.")
+    parser.add_argument("out_fpath", type=Path, help=\
+        "Path of the exported model.")
+    parser.add_argument("--int8", action="store_true", help=\
+        "Quantize the LSTM and linear layers to int8. Faster on CPU, the exported model will not "
+        "run on GPU.")
+    parser.add_argument("--slim", action="store_true", help=\
+        "Only export the weights, without the state of the optimizer, to a .safetensors file that "
+        "is memory-mapped when loaded. This loads much faster than the training checkpoint.")
+    args = parser.parse_args()
+    if args.slim and args.int8:
+        parser.error("--int8 applies to TorchScript exports, load the slim file with the int8 "
+                     "backend instead.")
+
+    print_args(args, parser)
+    if args.slim:
+        convert_model(args.weights_fpath, args.out_fpath)
+    else:
+        export_model(args.weights_fpath, args.out_fpath, quantize=args.int8)
+    print("Exported the encoder to %s" % args.out_fpath)
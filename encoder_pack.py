@@ -0,0 +1,31 @@
+from encoder.preprocess import pack_dataset
+from utils.argutils import print_args
+from pathlib import Path
+import argparse
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Packs the output of encoder_preprocess.py in a few large shards, which the "
+                    "encoder reads much faster during training than one file per utterance. Pass "
+                    "the output directory of this script to encoder_train.py instead of that of "
+                    "encoder_preprocess.py.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("clean_data_root", type=Path, help=\
+        "Path to the output directory of encoder_preprocess.py. If you left the default "
+        "output directory when preprocessing, it should be <datasets_root>/SV2TTS/encoder/.")
+    parser.add_argument("-o", "--out_dir", type=Path, default=argparse.SUPPRESS, help=\
+        "Path to the output directory of the packed dataset. If left out, defaults to "
+        "<clean_data_root>_packed/")
+    parser.add_argument("-s", "--max_shard_size", type=int, default=1024, help=\
+        "Size in megabytes above which a shard gets no more speakers.")
+    parser.add_argument("--float16", action="store_true", help=\
+        "Store the frames in float16, which halves the size of the dataset.")
+    args = parser.parse_args()
+
+    if not hasattr(args, "out_dir"):
+        args.out_dir = args.clean_data_root.with_name(args.clean_data_root.name + "_packed")
+    print_args(args, parser)
+    pack_dataset(args.clean_data_root, args.out_dir, args.max_shard_size * 1024 ** 2,
+                 "float16" if args.float16 else "float32")
@@ -36,7 +36,10 @@ if __name__ == "__main__":
         "voxceleb2.")
     parser.add_argument("-s", "--skip_existing", action="store_true", help=\
         "Whether to skip existing output files with the same name. Useful if this script was "
-        "interrupted.")
+        "interrupted, the preprocessing then resumes from its journal.")
+    parser.add_argument("-n", "--n_processes", type=int, default=4, help=\
+        "Number of processes to preprocess the utterances with. The utterances of a speaker are "
+        "distributed among them.")
     parser.add_argument("--no_trim", action="store_true", help=\
         "Preprocess audio without trimming silences (not recommended).")
     args = parser.parse_args()
@@ -6,7 +6,9 @@ import argparse
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
-        description="Trains the speaker encoder. You must have run encoder_preprocess.py first.",
+        description="Trains the speaker encoder. You must have run encoder_preprocess.py first. "
+                    "To train on several GPUs, launch it with torchrun --nproc_per_node=<n_gpus>, "
+                    "the speakers of each batch are then split between the GPUs.",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
 
@@ -16,13 +18,17 @@ if __name__ == "__main__":
         "states and restart from scratch.")
     parser.add_argument("clean_data_root", type=Path, help= \
         "Path to the output directory of encoder_preprocess.py. If you left the default "
-        "output directory when preprocessing, it should be <datasets_root>/SV2TTS/encoder/.")
+        "output directory when preprocessing, it should be <datasets_root>/SV2TTS/encoder/. "
+        "Packed datasets created with encoder_pack.py are read faster.")
     parser.add_argument("-m", "--models_dir", type=Path, default="saved_models", help=\
         "Path to the root directory that contains all models. A directory <run_name> will be created under this root."
         "It will contain the saved model weights, as well as backups of those weights and plots generated during "
         "training.")
     parser.add_argument("-v", "--vis_every", type=int, default=10, help= \
         "Number of steps between updates of the loss and the plots.")
+    parser.add_argument("-e", "--eer_every", type=int, default=10, help= \
+        "Number of steps between computations of the equal error rate of a batch. Set to 0 to "
+        "never compute it.")
     parser.add_argument("-u", "--umap_every", type=int, default=100, help= \
         "Number of steps between updates of the umap projection. Set to 0 to never update the "
         "projections.")
@@ -32,8 +38,24 @@ if __name__ == "__main__":
     parser.add_argument("-b", "--backup_every", type=int, default=7500, help= \
         "Number of steps between backups of the model. Set to 0 to never make backups of the "
         "model.")
+    parser.add_argument("--keep_backups", type=int, default=0, help= \
+        "Number of most recent backups to keep, the older ones are deleted. Set to 0 to keep all "
+        "backups.")
     parser.add_argument("-f", "--force_restart", action="store_true", help= \
         "Do not load any saved model.")
+    parser.add_argument("--speaker_pool_size", type=int, default=0, help= \
+        "If not 0, sample the speakers of each batch from a pool of this many speakers per data "
+        "loading worker, whose utterances are cached in memory and reused across batches. This "
+        "divides the reads from the disk. Use several times the number of speakers per batch.")
+    parser.add_argument("--speaker_pool_reuse", type=int, default=20, help= \
+        "Number of times a speaker of the pool is sampled before it is replaced.")
+    parser.add_argument("--frame_cache_size", type=int, default=1024, help= \
+        "Maximum size in megabytes of the utterances cached by each data loading worker with "
+        "--speaker_pool_size.")
+    parser.add_argument("--prefetch_batches", type=int, default=2, help= \
+        "Number of batches kept ready on the device ahead of the training step.")
+    parser.add_argument("--amp", action="store_true", help= \
+        "Train with automatic mixed precision, on GPU.")
     parser.add_argument("--visdom_server", type=str, default="http://localhost")
     parser.add_argument("--no_visdom", action="store_true", help= \
         "Disable visdom.")
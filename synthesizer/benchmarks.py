@@ -0,0 +1,110 @@
+"""
+Micro-benchmarks of the synthesizer. Run with:
+    python -m synthesizer.benchmarks [-s synthesizer.pt] [--cpu]
+Without a saved model, the benchmarks run on randomly initialized weights.
+"""
+from synthesizer.hparams import hparams
+from synthesizer.models.tacotron import Tacotron, InferenceDecoder
+from synthesizer.utils.symbols import symbols
+from time import perf_counter as timer
+from pathlib import Path
+import argparse
+import torch
+
+
+def _create_model(syn_model_fpath: Path = None, device=torch.device("cpu")):
+    model = Tacotron(embed_dims=hparams.tts_embed_dims,
+                     num_chars=len(symbols),
+                     encoder_dims=hparams.tts_encoder_dims,
+                     decoder_dims=hparams.tts_decoder_dims,
+                     n_mels=hparams.num_mels,
+                     fft_bins=hparams.num_mels,
+                     postnet_dims=hparams.tts_postnet_dims,
+                     encoder_K=hparams.tts_encoder_K,
+                     lstm_dims=hparams.tts_lstm_dims,
+                     postnet_K=hparams.tts_postnet_K,
+                     num_highways=hparams.tts_num_highways,
+                     dropout=hparams.tts_dropout,
+                     stop_threshold=hparams.tts_stop_threshold,
+                     speaker_embedding_size=hparams.speaker_embedding_size).to(device)
+    if syn_model_fpath is not None:
+        model.load(syn_model_fpath)
+    else:
+        model.r = hparams.tts_schedule[-1][0]
+    return model.eval()
+
+
+def benchmark_decoder_step(model: Tacotron, batch_sizes=(1, 16), text_len=100, n_steps=100,
+                           n_runs=3):
+    """
+    Compares the duration in milliseconds of a decoder step at inference with Decoder.forward(),
+    as in the training, and with InferenceDecoder, which reuses its buffers between steps. The
+    fastest of <n_runs> runs is reported.
+    """
+    device = next(model.parameters()).device
+    print("Decoder step with r=%d, texts of %d characters, on %s:" % (model.r, text_len, device))
+    for batch_size in batch_sizes:
+        chars = torch.randint(1, len(symbols), (batch_size, text_len), device=device)
+        embeds = torch.randn(batch_size, hparams.speaker_embedding_size, device=device)
+        with torch.no_grad():
+            encoder_seq, encoder_seq_proj = model.encode(chars, embeds)
+
+        def decoder_forward():
+            hidden_states = tuple(torch.zeros(batch_size, dims, device=device) for dims in
+                                  (model.decoder_dims, model.lstm_dims, model.lstm_dims))
+            cell_states = tuple(torch.zeros(batch_size, model.lstm_dims, device=device)
+                                for _ in range(2))
+            context_vec = torch.zeros(batch_size, encoder_seq.size(-1), device=device)
+            prenet_in = torch.zeros(batch_size, model.n_mels, device=device)
+            mel_outputs = []
+            for t in range(0, n_steps * model.r, model.r):
+                mel_frames, _, hidden_states, cell_states, context_vec, _ = \
+                    model.decoder(encoder_seq, encoder_seq_proj, prenet_in, hidden_states,
+                                  cell_states, context_vec, t, chars)
+                mel_outputs.append(mel_frames)
+                prenet_in = mel_frames[:, :, -1]
+            return torch.cat(mel_outputs, dim=2)
+
+        def inference_decoder():
+            decoder = InferenceDecoder(model.decoder, encoder_seq, encoder_seq_proj, chars)
+            mel_outputs = torch.zeros(batch_size, model.n_mels, n_steps * model.r, device=device)
+            prenet_in = torch.zeros(batch_size, model.n_mels, device=device)
+            for t in range(0, n_steps * model.r, model.r):
+                mel_frames, _, _ = decoder.step(prenet_in)
+                mel_outputs[:, :, t:t + model.r] = mel_frames
+                prenet_in = mel_outputs[:, :, t + model.r - 1]
+            return mel_outputs
+
+        durations = [float("inf")] * 2
+        with torch.no_grad():
+            # Warm up before timing
+            decoder_forward()
+            inference_decoder()
+            # Alternate between both, so that they suffer the same from the load of the machine
+            for _ in range(n_runs):
+                for i, func in enumerate([decoder_forward, inference_decoder]):
+                    if device.type == "cuda":
+                        torch.cuda.synchronize(device)
+                    start = timer()
+                    func()
+                    if device.type == "cuda":
+                        torch.cuda.synchronize(device)
+                    durations[i] = min(durations[i], (timer() - start) / n_steps * 1000)
+        print("  batch size %d: %.2fms per step with Decoder.forward(), %.2fms with "
+              "InferenceDecoder (%.2fx)" % (batch_size, *durations, durations[0] / durations[1]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Runs micro-benchmarks of the synthesizer.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("-s", "--syn_model_fpath", type=Path, default=None, help=\
+        "Path to a saved synthesizer. If not given, the benchmarks use random weights.")
+    parser.add_argument("--cpu", action="store_true", help=\
+        "If True, the benchmarks run on the CPU even if a GPU is available.")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.cpu else "cpu")
+    model = _create_model(args.syn_model_fpath, device)
+    benchmark_decoder_step(model)
@@ -0,0 +1,101 @@
+from collections import OrderedDict
+import hashlib
+import torch
+
+
+class EncoderOutputCache:
+    """
+    Keeps the outputs of the encoder CBHG for the most recently synthesized batches of texts in
+    memory, so that synthesizing the same texts again with the same seed only concatenates the
+    speaker embeddings, projects them and runs the decoder.
+
+    The encoder applies dropout to its inputs even at inference, so its outputs depend on the
+    state of the random number generator. The entries are thus addressed by that state and by
+    the padded character ids of the batch, and hold the state the encoder left it in, which is
+    restored when they are reused: the outputs and the random draws of the decoder are exactly
+    those without the cache. The cache is therefore only hit when the generator was seeded with
+    the same seed before the same number of random draws, as when the toolbox or demo_cli.py
+    reload the synthesizer after torch.manual_seed(). Synthesizing a text again with another
+    seed, or without a seed, always misses, so only use the cache with a seed. The outputs are
+    only valid for the weights they were computed with, see use_model().
+    """
+    def __init__(self, max_entries=64):
+        """
+        :param max_entries: the maximum number of batches of outputs to keep
+        """
+        self.max_entries = max_entries
+        self.model_key = None
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def use_model(self, model_key):
+        """
+        Clears the cache if the outputs it holds were computed by another model.
+
+        :param model_key: any value identifying the weights of the model, e.g. their path
+        """
+        if model_key != self.model_key:
+            self.clear()
+            self.model_key = model_key
+
+    def encode(self, model, x, speaker_embedding):
+        """
+        Encodes a batch with a Tacotron, only running the encoder CBHG if its outputs aren't
+        cached. See Tacotron.encode() for the arguments and outputs.
+        """
+        devices = [x.device] if x.device.type == "cuda" else []
+        h = hashlib.sha1()
+        for state in _get_rng_states(devices):
+            h.update(state.numpy().tobytes())
+        h.update(str(tuple(x.shape)).encode())
+        h.update(x.cpu().numpy().tobytes())
+        key = h.digest()
+
+        with torch.no_grad():
+            entry = self._get(self._entries, key)
+            if entry is not None:
+                self.hits += 1
+                text_encoding, rng_states = entry
+                _set_rng_states(rng_states, devices)
+            else:
+                self.misses += 1
+                text_encoding = model.encoder.encode_text(x)
+                rng_states = _get_rng_states(devices)
+                self._put(self._entries, key, (text_encoding, rng_states), self.max_entries)
+
+            # Concatenate the speaker embeddings and project
+            embeds = speaker_embedding.reshape(len(x), -1)
+            encoder_seq = model.encoder.add_speaker_embedding(text_encoding, embeds)
+            return encoder_seq, model.encoder_proj(encoder_seq)
+
+    @staticmethod
+    def _get(entries: OrderedDict, key):
+        value = entries.get(key)
+        if value is not None:
+            entries.move_to_end(key)
+        return value
+
+    @staticmethod
+    def _put(entries: OrderedDict, key, value, max_entries):
+        entries[key] = value
+        while len(entries) > max_entries:
+            entries.popitem(last=False)
+
+
+def _get_rng_states(devices):
+    # The states of the generators of the CPU and of the CUDA devices used
+    return [torch.get_rng_state()] + [torch.cuda.get_rng_state(device) for device in devices]
+
+
+def _set_rng_states(rng_states, devices):
+    torch.set_rng_state(rng_states[0])
+    for device, state in zip(devices, rng_states[1:]):
+        torch.cuda.set_rng_state(state, device)
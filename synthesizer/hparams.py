@@ -47,6 +47,10 @@ hparams = HParams(
                                                     # For example, for a range of [-4, 4], this
                                                     # will terminate the sequence at the first
                                                     # frame that has all values < -3.4
+        tts_stream_chunk_size = 20,                 # Number of mel frames yielded at once by streaming synthesis
+        tts_stream_lookahead = 20,                  # Number of frames decoded after a chunk before it is yielded,
+                                                    # as context for the postnet. The longer, the closer the chunks
+                                                    # are to the spectrogram synthesized in one go
 
         ### Tacotron Training
         tts_schedule = [(2,  1e-3,  20_000,  12),   # Progressive training schedule
@@ -61,6 +65,8 @@ hparams = HParams(
                                                     # Set to -1 to generate after completing epoch, or 0 to disable
 
         tts_eval_num_samples = 1,                   # Makes this number of samples
+        tts_bucket_batches = 32,                    # Batches utterances of similar mel lengths together, from
+                                                    # buckets of this many batches. Set to 0 to batch them at random
 
         ### Data Preprocessing
         max_mel_frames = 900,
@@ -1,13 +1,18 @@
 import torch
 from synthesizer import audio
 from synthesizer.hparams import hparams
-from synthesizer.models.tacotron import Tacotron
+from synthesizer.models.tacotron import Tacotron, InferenceDecoder
+from synthesizer.encoder_output_cache import EncoderOutputCache
 from synthesizer.utils.symbols import symbols
 from synthesizer.utils.text import text_to_sequence
 from vocoder.display import simple_table
+from concurrent.futures import Future
+from time import perf_counter as timer
+from queue import Queue, Empty
 from pathlib import Path
 from typing import Union, List
 import numpy as np
+import threading
 import librosa
 
 
@@ -15,15 +20,23 @@ class Synthesizer:
     sample_rate = hparams.sample_rate
     hparams = hparams
 
-    def __init__(self, model_fpath: Path, verbose=True):
+    def __init__(self, model_fpath: Path, verbose=True, cache: EncoderOutputCache = None):
         """
         The model isn't instantiated and loaded in memory until needed or until load() is called.
 
         :param model_fpath: path to the trained model file
         :param verbose: if False, prints less information when using the model
+        :param cache: an optional cache of the encoder outputs of the texts synthesized. It can
+        be shared by the successive synthesizers of a same model, e.g. when reloading the model
+        to reset the random seed. As the encoder applies dropout, the outputs are only reused
+        when a text is synthesized again after seeding the random number generator with the same
+        seed, and the spectrogram is then the same as before: a text synthesized with a new seed
+        or without a seed always goes through the encoder again. Only pass a cache when a seed is
+        set, see EncoderOutputCache.
         """
         self.model_fpath = model_fpath
         self.verbose = verbose
+        self.cache = cache
 
         # Check for GPU
         if torch.cuda.is_available():
@@ -63,6 +76,8 @@ class Synthesizer:
 
         self._model.load(self.model_fpath)
         self._model.eval()
+        if self.cache is not None:
+            self.cache.use_model(Path(self.model_fpath).resolve())
 
         if self.verbose:
             print("Loaded synthesizer \"%s\" trained to step %d" % (self.model_fpath.name, self._model.state_dict()["step"]))
@@ -114,19 +129,52 @@ class Synthesizer:
             chars = torch.tensor(chars).long().to(self.device)
             speaker_embeddings = torch.tensor(speaker_embeds).float().to(self.device)
 
-            # Inference
-            _, mels, alignments = self._model.generate(chars, speaker_embeddings)
+            # Inference. Rows are removed from the batch as they stop, so that finished rows no
+            # longer cost decoder steps, and each row is cut to its own length.
+            _, mels, alignments, lengths = self._model.generate(chars, speaker_embeddings,
+                                                                compact=True, cache=self.cache)
             mels = mels.detach().cpu().numpy()
-            for m in mels:
-                # Trim silence from end of each spectrogram
-                while np.max(m[:, -1]) < hparams.tts_stop_threshold:
-                    m = m[:, :-1]
-                specs.append(m)
+            for m, length in zip(mels, lengths.tolist()):
+                specs.append(trim_silence(m[:, :length]))
 
         if self.verbose:
             print("\n\nDone.\n")
         return (specs, alignments) if return_alignments else specs
 
+    def synthesize_spectrogram_stream(self, text: str, embedding: np.ndarray,
+                                      chunk_size=hparams.tts_stream_chunk_size,
+                                      lookahead=hparams.tts_stream_lookahead):
+        """
+        Synthesizes the mel spectrogram of a text, yielding it in chunks as it is generated, so
+        that its beginning can be vocoded and played before the rest is synthesized. Each chunk
+        is yielded once <lookahead> more frames are decoded after it, which the postnet uses as
+        context. The chunks only slightly differ from the spectrogram synthesize_spectrograms()
+        would return, see Tacotron.generate_stream().
+
+        :param text: the text prompt to synthesize
+        :param embedding: the speaker embedding of shape (256,)
+        :param chunk_size: the number of frames of the chunks, except the last one
+        :param lookahead: the number of frames decoded after a chunk before it is yielded
+        :return: a generator of the chunks of the mel spectrogram, as numpy arrays of shape
+        (80, Mi). The silence is only trimmed from the last chunk.
+        """
+        # Load the model on the first request.
+        if not self.is_loaded():
+            self.load()
+
+        chars = text_to_sequence(text.strip(), hparams.tts_cleaner_names)
+        chars = torch.tensor(chars).long()[None].to(self.device)
+        speaker_embedding = torch.tensor(embedding).float()[None].to(self.device)
+        chunks = self._model.generate_stream(chars, speaker_embedding, chunk_size=chunk_size,
+                                             lookahead=lookahead, cache=self.cache)
+        is_last = False
+        while not is_last:
+            # Grad mode is only disabled while the model runs, not in the caller between chunks
+            with torch.no_grad():
+                chunk, is_last = next(chunks)
+            chunk = chunk[0].cpu().numpy()
+            yield trim_silence(chunk) if is_last else chunk
+
     @staticmethod
     def load_preprocess_wav(fpath):
         """
@@ -161,5 +209,266 @@ class Synthesizer:
         return audio.inv_mel_spectrogram(mel, hparams)
 
 
+class SynthesisEngine:
+    """
+    Synthesizes the spectrograms of requests submitted from any thread with continuous batching:
+    a single thread runs the decoder on a batch of sequences, into which new requests are
+    admitted at any decoder step and from which sequences are retired as soon as they stop. A
+    request therefore never waits for the longest sequence of a batch to finish before starting,
+    and the decoder batch stays full under load.
+
+    The engine drives the model of a Synthesizer, whose other methods must not be used while the
+    engine runs. The encoder outputs of the texts of a batch are padded with zeros to the
+    longest text, so that, as with synthesize_spectrograms(), a spectrogram slightly depends on
+    the other texts decoded with it.
+    """
+    def __init__(self, synthesizer: Synthesizer, max_batch_size=hparams.synthesis_batch_size,
+                 max_latency=0.02, max_steps=2000):
+        """
+        :param synthesizer: the synthesizer of which to use the model. It is loaded if it isn't.
+        :param max_batch_size: the maximum number of sequences decoded at once
+        :param max_latency: when the decoder is idle, the time in seconds to wait after a first
+        request for more requests to start the batch with. Requests arriving while the decoder
+        runs are admitted at the next decoder step.
+        :param max_steps: the maximum number of frames of a spectrogram
+        """
+        assert max_batch_size > 0
+        if not synthesizer.is_loaded():
+            synthesizer.load()
+        self.model = synthesizer._model
+        self.device = synthesizer.device
+        self.cache = synthesizer.cache
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.max_steps = max_steps
+
+        # Number of requests and of decoder steps run, to monitor the size of the batches
+        self.n_requests = 0
+        self.n_steps = 0
+        self.n_decoded = 0
+
+        # Guards the queue once the engine is closed, so that no request is queued after the
+        # sentinel that stops the decoding thread
+        self._queue = Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._decode_loop, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Stops the engine once the requests already submitted are synthesized.
+        """
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(None)
+        self._thread.join()
+
+    def submit(self, text: str, embedding: np.ndarray):
+        """
+        Queues a text to be synthesized with the voice of a speaker embedding.
+
+        :param text: the text prompt to synthesize
+        :param embedding: the speaker embedding of shape (256,)
+        :return: a Future of the mel spectrogram, as a numpy array of shape (80, M)
+        """
+        chars = text_to_sequence(text.strip(), hparams.tts_cleaner_names)
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise Exception("The engine was closed.")
+            self._queue.put((chars, np.asarray(embedding, dtype=np.float32), future))
+        return future
+
+    def synthesize_spectrograms(self, texts: List[str],
+                                embeddings: Union[np.ndarray, List[np.ndarray]]):
+        """
+        Submits several requests and waits for their spectrograms, see
+        Synthesizer.synthesize_spectrograms().
+        """
+        futures = [self.submit(text, embed) for text, embed in zip(texts, embeddings)]
+        return [future.result() for future in futures]
+
+    @property
+    def mean_batch_size(self):
+        return self.n_decoded / max(self.n_steps, 1)
+
+    def _next_requests(self, n_active):
+        """
+        Gets the requests to admit in the batch. Blocks for a first request and waits up to
+        <max_latency> for more if the batch is empty, otherwise only takes those already queued.
+
+        :return: the list of requests, and whether the engine is closing
+        """
+        requests = []
+        deadline = None
+        while n_active + len(requests) < self.max_batch_size:
+            try:
+                if n_active == 0 and not requests:
+                    request = self._queue.get()
+                    deadline = timer() + self.max_latency
+                elif deadline is not None:
+                    request = self._queue.get(timeout=max(deadline - timer(), 0))
+                else:
+                    request = self._queue.get_nowait()
+            except Empty:
+                break
+            if request is None:
+                return requests, True
+            requests.append(request)
+        return requests, False
+
+    def _decode_loop(self):
+        # Grad mode is local to each thread
+        with torch.no_grad():
+            self.model.eval()
+            batch = _DecoderBatch(self.model, self.device, self.max_steps, self.cache)
+            closing = False
+            while not closing or batch.size > 0:
+                # Admit the new requests, unless the engine is closing
+                if not closing:
+                    requests, closing = self._next_requests(batch.size)
+                    if requests:
+                        self.n_requests += len(requests)
+                        try:
+                            batch.admit(requests)
+                        except Exception as e:
+                            for _, _, future in requests:
+                                future.set_exception(e)
+                if batch.size == 0:
+                    continue
+
+                # Run a decoder step and retire the sequences that stop
+                try:
+                    self.n_steps += 1
+                    self.n_decoded += batch.size
+                    for future, mel in batch.step():
+                        future.set_result(mel)
+                except Exception as e:
+                    for future in batch.clear():
+                        future.set_exception(e)
+
+        # Fail the requests submitted while the engine was closing
+        while not self._queue.empty():
+            request = self._queue.get()
+            if request is not None:
+                request[2].set_exception(Exception("The engine was closed."))
+
+
+class _DecoderBatch:
+    """
+    The sequences decoded by a SynthesisEngine, as the rows of an InferenceDecoder. Their frames
+    are written to a buffer of <max_steps> frames per row.
+    """
+    def __init__(self, model: Tacotron, device, max_steps, cache: EncoderOutputCache = None):
+        self.model = model
+        self.device = device
+        self.max_steps = max_steps
+        self.cache = cache
+        self.clear()
+
+    @property
+    def size(self):
+        return len(self.futures)
+
+    def clear(self):
+        """
+        Removes all sequences from the batch.
+
+        :return: the futures of the sequences removed
+        """
+        futures = getattr(self, "futures", [])
+        self.futures = []
+        self.decoder = None
+        # The input of the prenet, the number of frames decoded and the frames of each row
+        self.prenet_in = None
+        self.steps = None
+        self.mels = None
+        return futures
+
+    def admit(self, requests):
+        """
+        Runs the encoder on new requests, and appends them to the batch.
+        """
+        model = self.model
+        chars = [chars for chars, _, _ in requests]
+        max_text_len = max(len(text) for text in chars)
+        chars = torch.tensor(np.stack([pad1d(text, max_text_len) for text in chars]))
+        chars = chars.long().to(self.device)
+        embeds = torch.tensor(np.stack([embed for _, embed, _ in requests])).to(self.device)
+        encoder_seq, encoder_seq_proj = model.encode(chars, embeds, self.cache)
+
+        n = len(requests)
+        max_frames = (self.max_steps + model.r - 1) // model.r * model.r
+        prenet_in = torch.zeros(n, model.n_mels, device=self.device)
+        steps = torch.zeros(n, dtype=torch.long, device=self.device)
+        mels = torch.zeros(n, max_frames, model.n_mels, device=self.device)
+        if self.decoder is None:
+            self.decoder = InferenceDecoder(model.decoder, encoder_seq, encoder_seq_proj, chars)
+            self.prenet_in, self.steps, self.mels = prenet_in, steps, mels
+        else:
+            self.decoder.append(encoder_seq, encoder_seq_proj, chars)
+            self.prenet_in = torch.cat((self.prenet_in, prenet_in))
+            self.steps = torch.cat((self.steps, steps))
+            self.mels = torch.cat((self.mels, mels))
+        self.futures.extend(future for _, _, future in requests)
+
+    def step(self):
+        """
+        Runs a decoder step on all sequences, and retires the sequences that stop.
+
+        :return: a list of (future, mel spectrogram) of the sequences retired
+        """
+        model, r = self.model, self.decoder.r
+        mel_frames, _, stop_tokens = self.decoder.step(self.prenet_in)
+
+        # Each row writes its frames after those it decoded before
+        rows = torch.arange(self.size, device=self.device)[:, None]
+        frames = self.steps[:, None] + torch.arange(r, device=self.device)
+        self.mels[rows, frames] = mel_frames.transpose(1, 2)
+        self.prenet_in = mel_frames[:, :, -1].clone()
+
+        # A sequence stops once its stop token exceeds the threshold after the first steps, as in
+        # Tacotron.generate()
+        stopped = (stop_tokens.squeeze(1) > 0.5) & (self.steps > 10)
+        self.steps += r
+        stopped |= self.steps >= self.max_steps
+        if not stopped.any():
+            return []
+
+        outputs = []
+        retired = stopped.nonzero().squeeze(1).tolist()
+        for i, length in zip(retired, self.steps[stopped].tolist()):
+            mels = self.mels[i:i + 1, :length].transpose(1, 2)
+            linear = model.post_proj(model.postnet(mels)).transpose(1, 2)
+            outputs.append((self.futures[i], trim_silence(linear[0].cpu().numpy())))
+
+        keep = (~stopped).nonzero().squeeze(1)
+        if len(keep) == 0:
+            self.clear()
+            return outputs
+        self.futures = [self.futures[i] for i in keep.tolist()]
+        self.decoder.select(keep)
+        self.prenet_in = self.prenet_in[keep]
+        self.steps = self.steps[keep]
+        self.mels = self.mels[keep]
+        return outputs
+
+
+def trim_silence(mel):
+    """
+    Cuts the frames below hparams.tts_stop_threshold from the end of a mel spectrogram.
+    """
+    voiced = np.nonzero(mel.max(axis=0) >= hparams.tts_stop_threshold)[0]
+    return mel[:, :voiced[-1] + 1 if len(voiced) else 1]
+
+
 def pad1d(x, max_len, pad_value=0):
     return np.pad(x, (0, max_len - len(x)), mode="constant", constant_values=pad_value)
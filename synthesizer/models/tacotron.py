@@ -35,14 +35,20 @@ class Encoder(nn.Module):
                          num_highways=num_highways)
 
     def forward(self, x, speaker_embedding=None):
-        x = self.embedding(x)
-        x = self.pre_net(x)
-        x.transpose_(1, 2)
-        x = self.cbhg(x)
+        x = self.encode_text(x)
         if speaker_embedding is not None:
             x = self.add_speaker_embedding(x, speaker_embedding)
         return x
 
+    def encode_text(self, x):
+        """
+        Runs the encoder on the characters only, before the speaker embedding is concatenated.
+        """
+        x = self.embedding(x)
+        x = self.pre_net(x)
+        x.transpose_(1, 2)
+        return self.cbhg(x)
+
     def add_speaker_embedding(self, x, speaker_embedding):
         # SV2TTS
         # The input x is the encoder output and is a 3D tensor with size (batch_size, num_chars, tts_embed_dims)
@@ -128,6 +134,59 @@ class CBHG(nn.Module):
         # weights are contiguous in GPU memory. Hence, we must call it again
         self._flatten_parameters()
 
+        # Through the convolutions and the highways, then the RNN
+        x = self._convolve(x)
+        x, _ = self.rnn(x)
+        return x
+
+    @property
+    def conv_context(self):
+        """
+        The number of frames on each side of a frame that the output of the convolutions for
+        that frame depends on.
+        """
+        return max(self.bank_kernels) // 2 + 3
+
+    def forward_chunk(self, x, start, end, h=None, final=False):
+        """
+        Computes the outputs of frames [start, end) of a sequence of which only the beginning is
+        known, e.g. while it is being generated. The frames of the sequence before <start> only
+        contribute through the convolutions and the state of the forward RNN, which are exact.
+        Those after <end> serve as lookahead for the backward RNN, which starts from a zero
+        state at the last frame of the convolutions that is exact rather than at the end of the
+        sequence. Its outputs are thus approximate, and all the closer to those of forward()
+        that the lookahead is long.
+
+        :param x: the frames known, as a tensor of shape (batch_size, in_channels, n_frames)
+        :param start: the first frame to compute
+        :param end: the frame after the last to compute. Unless final, it must be at most
+        n_frames - conv_context.
+        :param h: the state of the forward RNN after frame start - 1, None for zeros
+        :param final: whether x is the whole sequence, in which case the outputs of the last
+        chunk are exact.
+        :return: the outputs of shape (batch_size, end - start, channels) and the state of the
+        forward RNN after frame end - 1
+        """
+        self._flatten_parameters()
+        n_frames = x.size(-1)
+        last = n_frames if final else n_frames - self.conv_context
+        assert start < end <= last
+
+        # Convolve the frames the lookahead needs, with enough context for the convolutions to
+        # be exact
+        offset = max(start - self.conv_context, 0)
+        x = self._convolve(x[:, :, offset:n_frames])[:, start - offset:last - offset]
+
+        # The state of the forward RNN is carried from the previous chunk, that of the backward
+        # RNN starts from zeros
+        hidden_size = self.rnn.hidden_size
+        if h is None:
+            h = x.new_zeros(x.size(0), hidden_size)
+        h0 = torch.stack((h, torch.zeros_like(h)))
+        x, _ = self.rnn(x, h0)
+        return x[:, :end - start], x[:, end - start - 1, :hidden_size].contiguous()
+
+    def _convolve(self, x):
         # Save these for later
         residual = x
         seq_len = x.size(-1)
@@ -156,9 +215,6 @@ class CBHG(nn.Module):
         if self.highway_mismatch is True:
             x = self.pre_highway(x)
         for h in self.highways: x = h(x)
-
-        # And then the RNN
-        x, _ = self.rnn(x)
         return x
 
     def _flatten_parameters(self):
@@ -325,6 +381,161 @@ class Decoder(nn.Module):
         return mels, scores, hidden_states, cell_states, context_vec, stop_tokens
 
 
+class InferenceDecoder:
+    """
+    Runs the steps of a Decoder for inference on a batch, with the outputs of Decoder.forward()
+    in eval mode. The attention mask and the rows of mel_proj used with the current r are
+    computed once, and the concatenations, the attention energies and the outputs of each step
+    are written to buffers allocated once, so that a step allocates little beyond the outputs
+    of the layers. The tensors returned by step() are overwritten by the next step.
+    """
+    def __init__(self, decoder: Decoder, encoder_seq, encoder_seq_proj, chars):
+        """
+        :param decoder: the decoder, in eval mode
+        :param encoder_seq: the encoder outputs of shape (batch_size, max_text_len, encoder_dims
+        + speaker_embedding_size)
+        :param encoder_seq_proj: their projection, of shape (batch_size, max_text_len,
+        decoder_dims)
+        :param chars: the padded character ids, of shape (batch_size, max_text_len)
+        """
+        self.decoder = decoder
+        self.r = decoder.r.item()
+        self.n_mels = decoder.n_mels
+
+        # Only the first r of the max_r frames mel_proj outputs for each channel are used
+        device = encoder_seq.device
+        rows = torch.arange(self.n_mels, device=device)[:, None] * decoder.max_r + \
+               torch.arange(self.r, device=device)
+        self.mel_weight = decoder.mel_proj.weight.detach()[rows.flatten()].t()
+
+        with torch.no_grad():
+            self._allocate(encoder_seq, encoder_seq_proj, (chars != 0).float())
+
+    def _allocate(self, encoder_seq, encoder_seq_proj, mask):
+        batch_size, max_text_len, context_dims = encoder_seq.size()
+        decoder_dims = self.decoder.attn_rnn.hidden_size
+        lstm_dims = self.decoder.res_rnn1.hidden_size
+        prenet_dims = self.decoder.prenet.fc2.out_features
+        zeros = lambda *size: encoder_seq.new_zeros(size)
+
+        self.encoder_seq = encoder_seq
+        self.encoder_seq_proj = encoder_seq_proj
+        self.mask = mask
+
+        # The states of the RNNs and of the attention
+        self.attn_hidden = zeros(batch_size, decoder_dims)
+        self.rnn1 = (zeros(batch_size, lstm_dims), zeros(batch_size, lstm_dims))
+        self.rnn2 = (zeros(batch_size, lstm_dims), zeros(batch_size, lstm_dims))
+        self.cumulative = zeros(batch_size, max_text_len)
+        self.context_vec = zeros(batch_size, 1, context_dims)
+
+        # The concatenations [context_vec, prenet_out], [context_vec, attn_hidden] and
+        # [x, context_vec] of Decoder.forward()
+        self.attn_rnn_in = zeros(batch_size, context_dims + prenet_dims)
+        self.rnn_in = zeros(batch_size, context_dims + decoder_dims)
+        self.stop_in = zeros(batch_size, lstm_dims + context_dims)
+        self.energies = zeros(batch_size, max_text_len, decoder_dims)
+        self.mels = zeros(batch_size, self.n_mels * self.r)
+        self.stop_tokens = zeros(batch_size, 1)
+
+    @torch.no_grad()
+    def select(self, index):
+        """
+        Keeps only some rows of the batch, e.g. to remove those that finished decoding.
+
+        :param index: the indices of the rows to keep, as a long tensor
+        """
+        states = (self.attn_hidden, self.rnn1, self.rnn2, self.cumulative, self.context_vec)
+        self._allocate(self.encoder_seq[index], self.encoder_seq_proj[index], self.mask[index])
+        attn_hidden, rnn1, rnn2, cumulative, context_vec = states
+        self.attn_hidden = attn_hidden[index]
+        self.rnn1 = (rnn1[0][index], rnn1[1][index])
+        self.rnn2 = (rnn2[0][index], rnn2[1][index])
+        self.cumulative = cumulative[index]
+        self.context_vec = context_vec[index]
+        self.attn_rnn_in[:, :self.context_vec.size(-1)] = self.context_vec.squeeze(1)
+
+    @torch.no_grad()
+    def append(self, encoder_seq, encoder_seq_proj, chars):
+        """
+        Appends rows to the batch, e.g. to start decoding new texts while the others continue.
+        The new rows start from the state of a first step. The characters dimension of the rows
+        is padded with zeros to the longest text, which the attention does not entirely ignore.
+
+        :param encoder_seq: the encoder outputs of the new rows, see __init__()
+        :param encoder_seq_proj: their projection
+        :param chars: the padded character ids of the new rows
+        """
+        batch_size = self.encoder_seq.size(0)
+        max_text_len = max(self.encoder_seq.size(1), encoder_seq.size(1))
+        cat = lambda x, y: torch.cat((_pad_text(x, max_text_len), _pad_text(y, max_text_len)))
+        states = (self.attn_hidden, self.rnn1, self.rnn2, self.cumulative, self.context_vec)
+        self._allocate(cat(self.encoder_seq, encoder_seq), cat(self.encoder_seq_proj,
+                       encoder_seq_proj), cat(self.mask, (chars != 0).float()))
+        attn_hidden, rnn1, rnn2, cumulative, context_vec = states
+        self.attn_hidden[:batch_size] = attn_hidden
+        for state, prev_state in zip(self.rnn1 + self.rnn2, rnn1 + rnn2):
+            state[:batch_size] = prev_state
+        self.cumulative[:batch_size, :cumulative.size(1)] = cumulative
+        self.context_vec[:batch_size] = context_vec
+        self.attn_rnn_in[:, :self.context_vec.size(-1)] = self.context_vec.squeeze(1)
+
+    @torch.no_grad()
+    def step(self, prenet_in):
+        """
+        Runs a decoder step.
+
+        :param prenet_in: the last frame of the previous step, or zeros at the first step, as a
+        tensor of shape (batch_size, n_mels)
+        :return: the mel frames of shape (batch_size, n_mels, r), the attention scores of shape
+        (batch_size, max_text_len) and the stop tokens of shape (batch_size, 1)
+        """
+        decoder, attn_net = self.decoder, self.decoder.attn_net
+        batch_size, context_dims = self.context_vec.size(0), self.context_vec.size(-1)
+        lstm_dims = self.rnn1[0].size(1)
+
+        # Attention RNN, the context vector of the previous step being in place already
+        self.attn_rnn_in[:, context_dims:] = decoder.prenet(prenet_in)
+        self.attn_hidden = decoder.attn_rnn(self.attn_rnn_in, self.attn_hidden)
+
+        # Location sensitive attention
+        processed_query = attn_net.W(self.attn_hidden).unsqueeze(1)
+        torch.add(self.encoder_seq_proj, processed_query, out=self.energies)
+        processed_loc = attn_net.L(attn_net.conv(self.cumulative.unsqueeze(1)).transpose(1, 2))
+        self.energies.add_(processed_loc).tanh_()
+        u = attn_net.v(self.energies).squeeze(-1).mul_(self.mask)
+        scores = F.softmax(u, dim=1)
+        self.cumulative.add_(scores)
+        torch.bmm(scores.unsqueeze(1), self.encoder_seq, out=self.context_vec)
+        context_vec = self.context_vec.squeeze(1)
+        self.attn_rnn_in[:, :context_dims] = context_vec
+
+        # Residual RNNs
+        self.rnn_in[:, :context_dims] = context_vec
+        self.rnn_in[:, context_dims:] = self.attn_hidden
+        x = decoder.rnn_input(self.rnn_in)
+        self.rnn1 = decoder.res_rnn1(x, self.rnn1)
+        x.add_(self.rnn1[0])
+        self.rnn2 = decoder.res_rnn2(x, self.rnn2)
+        x.add_(self.rnn2[0])
+
+        # Mels and stop token
+        torch.mm(x, self.mel_weight, out=self.mels)
+        self.stop_in[:, :lstm_dims] = x
+        self.stop_in[:, lstm_dims:] = context_vec
+        stop_proj = decoder.stop_proj
+        torch.addmm(stop_proj.bias, self.stop_in, stop_proj.weight.t(), out=self.stop_tokens)
+        self.stop_tokens.sigmoid_()
+
+        return self.mels.view(batch_size, self.n_mels, self.r), scores, self.stop_tokens
+
+
+def _pad_text(x, max_text_len):
+    # Pads the characters dimension (the second) of a batch with zeros
+    padding = [0, 0] * (x.dim() - 2) + [0, max_text_len - x.size(1)]
+    return F.pad(x, padding)
+
+
 class Tacotron(nn.Module):
     def __init__(self, embed_dims, num_chars, encoder_dims, decoder_dims, n_mels, 
                  fft_bins, postnet_dims, encoder_K, lstm_dims, postnet_K, num_highways,
@@ -414,66 +625,211 @@ class Tacotron(nn.Module):
 
         return mel_outputs, linear, attn_scores, stop_outputs
 
-    def generate(self, x, speaker_embedding=None, steps=2000):
+    def generate(self, x, speaker_embedding=None, steps=2000, compact=False, cache=None):
+        """
+        Generates spectrograms from a batch of texts, see encode() and decode().
+
+        :param x: the padded character ids, as a tensor of shape (batch_size, max_text_len)
+        :param speaker_embedding: the speaker embeddings, as a tensor of shape (batch_size,
+        speaker_embedding_size)
+        :param steps: the maximum number of frames generated
+        :param compact: if True, each row stops decoding once its own stop token exceeds 0.5 and
+        is removed from the batch, so that finished rows no longer cost decoder steps. The
+        outputs are then padded with zeros past the length of each row, and the lengths are
+        returned as a fourth output. If False, the whole batch is decoded until all rows stop.
+        :param cache: an optional EncoderOutputCache of the outputs of the encoder
+        :return: the mels, the postnet outputs (both of shape (batch_size, n_mels, n_frames)),
+        the attention scores of shape (batch_size, n_decoder_steps, max_text_len) and, with
+        compact, the number of frames of each row as a long tensor of shape (batch_size,)
+        """
+        encoder_seq, encoder_seq_proj = self.encode(x, speaker_embedding, cache)
+        return self.decode(x, encoder_seq, encoder_seq_proj, steps, compact)
+
+    def encode(self, x, speaker_embedding=None, cache=None):
+        """
+        Runs the encoder for inference, with the speaker embedding, and its projection for the
+        attention. The outputs only depend on the characters and the speaker embedding, so they
+        can be reused by several calls to decode().
+
+        :param x: the padded character ids, as a tensor of shape (batch_size, max_text_len)
+        :param speaker_embedding: the speaker embeddings, as a tensor of shape (batch_size,
+        speaker_embedding_size)
+        :param cache: an optional EncoderOutputCache. The outputs of the encoder CBHG are reused
+        if it holds them for the same texts and random state, otherwise they are computed and
+        added to it. Only used with speaker embeddings.
+        :return: the encoder outputs of shape (batch_size, max_text_len, encoder_dims +
+        speaker_embedding_size) and their projection of shape (batch_size, max_text_len,
+        decoder_dims)
+        """
+        training = self.training
         self.eval()
-        device = next(self.parameters()).device  # use same device as parameters
-
-        batch_size, _  = x.size()
-
-        # Need to initialise all hidden states and pack into tuple for tidyness
-        attn_hidden = torch.zeros(batch_size, self.decoder_dims, device=device)
-        rnn1_hidden = torch.zeros(batch_size, self.lstm_dims, device=device)
-        rnn2_hidden = torch.zeros(batch_size, self.lstm_dims, device=device)
-        hidden_states = (attn_hidden, rnn1_hidden, rnn2_hidden)
-
-        # Need to initialise all lstm cell states and pack into tuple for tidyness
-        rnn1_cell = torch.zeros(batch_size, self.lstm_dims, device=device)
-        rnn2_cell = torch.zeros(batch_size, self.lstm_dims, device=device)
-        cell_states = (rnn1_cell, rnn2_cell)
-
-        # Need a <GO> Frame for start of decoder loop
-        go_frame = torch.zeros(batch_size, self.n_mels, device=device)
-
-        # Need an initial context vector
-        context_vec = torch.zeros(batch_size, self.encoder_dims + self.speaker_embedding_size, device=device)
-
-        # SV2TTS: Run the encoder with the speaker embedding
-        # The projection avoids unnecessary matmuls in the decoder loop
-        encoder_seq = self.encoder(x, speaker_embedding)
-        encoder_seq_proj = self.encoder_proj(encoder_seq)
+        if cache is not None and speaker_embedding is not None:
+            outputs = cache.encode(self, x, speaker_embedding)
+        else:
+            # SV2TTS: Run the encoder with the speaker embedding
+            # The projection avoids unnecessary matmuls in the decoder loop
+            encoder_seq = self.encoder(x, speaker_embedding)
+            outputs = encoder_seq, self.encoder_proj(encoder_seq)
+        self.train(training)
+        return outputs
+
+    def decode(self, x, encoder_seq, encoder_seq_proj, steps=2000, compact=False):
+        """
+        Runs the decoder and the postnet for inference on the outputs of encode(). See
+        generate() for the arguments and outputs.
+        """
+        if compact:
+            return self._decode_compact(x, encoder_seq, encoder_seq_proj, steps)
 
-        # Need a couple of lists for outputs
-        mel_outputs, attn_scores, stop_outputs = [], [], []
+        self.eval()
+        device = next(self.parameters()).device  # use same device as parameters
 
-        # Run the decoder loop
-        for t in range(0, steps, self.r):
-            prenet_in = mel_outputs[-1][:, :, -1] if t > 0 else go_frame
-            mel_frames, scores, hidden_states, cell_states, context_vec, stop_tokens = \
-            self.decoder(encoder_seq, encoder_seq_proj, prenet_in,
-                         hidden_states, cell_states, context_vec, t, x)
-            mel_outputs.append(mel_frames)
-            attn_scores.append(scores)
-            stop_outputs.extend([stop_tokens] * self.r)
+        batch_size, max_text_len = x.size()
+        r = self.r
+
+        # The outputs are written to buffers sized for the maximum number of steps
+        n_steps = (steps + r - 1) // r
+        mel_outputs = torch.zeros(batch_size, self.n_mels, n_steps * r, device=device)
+        attn_scores = torch.zeros(batch_size, n_steps, max_text_len, device=device)
+
+        # Run the decoder loop, starting from a <GO> frame
+        decoder = InferenceDecoder(self.decoder, encoder_seq, encoder_seq_proj, x)
+        prenet_in = torch.zeros(batch_size, self.n_mels, device=device)
+        for i, t in enumerate(range(0, steps, r)):
+            mel_frames, scores, stop_tokens = decoder.step(prenet_in)
+            mel_outputs[:, :, t:t + r] = mel_frames
+            attn_scores[:, i] = scores
+            prenet_in = mel_outputs[:, :, t + r - 1]
             # Stop the loop when all stop tokens in batch exceed threshold
             if (stop_tokens > 0.5).all() and t > 10: break
-
-        # Concat the mel outputs into sequence
-        mel_outputs = torch.cat(mel_outputs, dim=2)
+        mel_outputs = mel_outputs[:, :, :t + r]
+        attn_scores = attn_scores[:, :i + 1]
 
         # Post-Process for Linear Spectrograms
-        postnet_out = self.postnet(mel_outputs)
-        linear = self.post_proj(postnet_out)
+        with torch.no_grad():
+            postnet_out = self.postnet(mel_outputs)
+            linear = self.post_proj(postnet_out)
+        linear = linear.transpose(1, 2)
 
+        self.train()
 
-        linear = linear.transpose(1, 2)
+        return mel_outputs, linear, attn_scores
 
-        # For easy visualisation
-        attn_scores = torch.cat(attn_scores, 1)
-        stop_outputs = torch.cat(stop_outputs, 1)
+    def _decode_compact(self, x, encoder_seq, encoder_seq_proj, steps):
+        self.eval()
+        device = next(self.parameters()).device  # use same device as parameters
+
+        batch_size, max_text_len = x.size()
+        r = self.r
+
+        # The outputs are written to their row of the batch. <active> holds the rows still
+        # decoding, in the order of the rows of the decoder.
+        n_steps = (steps + r - 1) // r
+        mel_outputs = torch.zeros(batch_size, self.n_mels, n_steps * r, device=device)
+        attn_scores = torch.zeros(batch_size, n_steps, max_text_len, device=device)
+        lengths = torch.full((batch_size,), n_steps * r, dtype=torch.long, device=device)
+        active = torch.arange(batch_size, device=device)
+
+        # Run the decoder loop, starting from a <GO> frame
+        decoder = InferenceDecoder(self.decoder, encoder_seq, encoder_seq_proj, x)
+        prenet_in = torch.zeros(batch_size, self.n_mels, device=device)
+        for i, t in enumerate(range(0, steps, r)):
+            mel_frames, scores, stop_tokens = decoder.step(prenet_in)
+            mel_outputs[active, :, t:t + r] = mel_frames
+            attn_scores[active, i] = scores
+            prenet_in = mel_frames[:, :, -1].clone()
+            if t <= 10:
+                continue
+
+            # Remove the rows whose stop token exceeds the threshold from the batch
+            stopped = stop_tokens.squeeze(1) > 0.5
+            if not stopped.any():
+                continue
+            lengths[active[stopped]] = t + r
+            if stopped.all():
+                break
+            keep = (~stopped).nonzero().squeeze(1)
+            active = active[keep]
+            prenet_in = prenet_in[keep]
+            decoder.select(keep)
+
+        # Trim the outputs to the longest row
+        max_len = lengths.max().item()
+        mel_outputs = mel_outputs[:, :, :max_len]
+        attn_scores = attn_scores[:, :(max_len + r - 1) // r]
+
+        # Post-Process each row on its own frames only, as the postnet sees the whole sequence
+        linear = torch.zeros_like(mel_outputs)
+        with torch.no_grad():
+            for j, length in enumerate(lengths.tolist()):
+                postnet_out = self.postnet(mel_outputs[j:j + 1, :, :length])
+                linear[j, :, :length] = self.post_proj(postnet_out).transpose(1, 2)[0]
 
         self.train()
 
-        return mel_outputs, linear, attn_scores
+        return mel_outputs, linear, attn_scores, lengths
+
+    def generate_stream(self, x, speaker_embedding=None, steps=2000, chunk_size=20,
+                        lookahead=20, cache=None):
+        """
+        Generates the spectrogram of a single text, yielding it in chunks while the decoder
+        runs. A chunk of postnet outputs is yielded once <lookahead> more frames are decoded
+        after it, the last chunk once the decoder stops.
+
+        Only the backward RNN of the postnet differs from generate(): it is run from the end of
+        the lookahead of each chunk rather than from the end of the spectrogram (see
+        CBHG.forward_chunk()). The frames of the last chunk are exact, and those of the other
+        chunks get closer to the outputs of generate() as the lookahead grows. The decoder
+        itself is unchanged, so that the mels and their length are the same as generate()'s for
+        the same random state.
+
+        :param x: the character ids, as a tensor of shape (1, text_len)
+        :param speaker_embedding: the speaker embedding, as a tensor of shape (1,
+        speaker_embedding_size)
+        :param steps: the maximum number of frames generated
+        :param chunk_size: the number of frames of the chunks yielded, except the last one
+        :param lookahead: the number of frames decoded after a chunk before it is yielded. It
+        is at least the context of the convolutions of the postnet.
+        :param cache: an optional EncoderOutputCache of the outputs of the encoder
+        :return: a generator of tuples (postnet_out, is_last), with the postnet outputs of the
+        chunk as a tensor of shape (1, n_mels, n_frames) and whether it is the last chunk
+        """
+        assert x.size(0) == 1 and chunk_size > 0
+        lookahead = max(lookahead, self.postnet.conv_context)
+        device = next(self.parameters()).device  # use same device as parameters
+        encoder_seq, encoder_seq_proj = self.encode(x, speaker_embedding, cache)
+
+        self.eval()
+        try:
+            decoder = InferenceDecoder(self.decoder, encoder_seq, encoder_seq_proj, x)
+            prenet_in = torch.zeros(1, self.n_mels, device=device)
+
+            # The mels decoded so far, and the postnet state after the last chunk yielded
+            r = self.r
+            mel_outputs = torch.zeros(1, self.n_mels, (steps + r - 1) // r * r, device=device)
+            n_frames, n_yielded, h = 0, 0, None
+
+            for t in range(0, steps, r):
+                mel_frames, _, stop_tokens = decoder.step(prenet_in)
+                mel_outputs[:, :, t:t + r] = mel_frames
+                prenet_in = mel_outputs[:, :, t + r - 1]
+                n_frames = t + r
+                if (stop_tokens > 0.5).all() and t > 10:
+                    break
+
+                # Yield the chunks of which the lookahead is decoded
+                while n_frames - n_yielded >= chunk_size + lookahead:
+                    chunk, h = self.postnet.forward_chunk(mel_outputs[:, :, :n_frames],
+                                                          n_yielded, n_yielded + chunk_size, h)
+                    n_yielded += chunk_size
+                    yield self.post_proj(chunk).transpose(1, 2), False
+
+            # The rest of the spectrogram, with the backward RNN run from its end
+            chunk, _ = self.postnet.forward_chunk(mel_outputs[:, :, :n_frames], n_yielded,
+                                                  n_frames, h, final=True)
+            yield self.post_proj(chunk).transpose(1, 2), True
+        finally:
+            self.train()
 
     def init_model(self):
         for p in self.parameters():
@@ -499,16 +855,17 @@ class Tacotron(nn.Module):
         if "optimizer_state" in checkpoint and optimizer is not None:
             optimizer.load_state_dict(checkpoint["optimizer_state"])
 
-    def save(self, path, optimizer=None):
+    def save(self, path, optimizer=None, writer=None, retention_glob=None):
+        """
+        Saves the model and the optimizer if given, from the background thread of a
+        CheckpointWriter if given. A retention_glob is passed to the writer.
+        """
+        checkpoint = {"model_state": self.state_dict()}
         if optimizer is not None:
-            torch.save({
-                "model_state": self.state_dict(),
-                "optimizer_state": optimizer.state_dict(),
-            }, str(path))
-        else:
-            torch.save({
-                "model_state": self.state_dict(),
-            }, str(path))
+            checkpoint["optimizer_state"] = optimizer.state_dict()
+        if writer is not None:
+            return writer.save(checkpoint, path, retention_glob)
+        torch.save(checkpoint, str(path))
 
 
     def num_params(self, print_out=True):
@@ -3,11 +3,15 @@ from synthesizer import audio
 from functools import partial
 from itertools import chain
 from encoder import inference as encoder
+from encoder.embedding_cache import EmbeddingCache
+from synthesizer.utils.text import text_to_sequence
+from synthesizer.synthesizer_dataset import corpus_sources
 from pathlib import Path
 from utils import logmmse
 from tqdm import tqdm
 import numpy as np
 import librosa
+import json
 
 
 def preprocess_dataset(datasets_root: Path, out_dir: Path, n_processes: int, skip_existing: bool, hparams,
@@ -226,19 +230,29 @@ def process_utterance(wav: np.ndarray, text: str, out_dir: Path, basename: str,
     return wav_fpath.name, mel_fpath.name, "embed-%s.npy" % basename, len(wav), mel_frames, text
 
 
-def embed_utterance(fpaths, encoder_model_fpath):
+_embed_cache = None # type: EmbeddingCache
+
+
+def embed_utterance(fpaths, encoder_model_fpath, embed_cache_dir=None):
+    global _embed_cache
     if not encoder.is_loaded():
         encoder.load_model(encoder_model_fpath)
+        if embed_cache_dir is not None:
+            _embed_cache = EmbeddingCache(embed_cache_dir, encoder_model_fpath)
 
     # Compute the speaker embedding of the utterance
     wav_fpath, embed_fpath = fpaths
     wav = np.load(wav_fpath)
-    wav = encoder.preprocess_wav(wav)
-    embed = encoder.embed_utterance(wav)
+    if _embed_cache is not None:
+        embed = _embed_cache.embed_utterance(wav)
+    else:
+        wav = encoder.preprocess_wav(wav)
+        embed = encoder.embed_utterance(wav)
     np.save(embed_fpath, embed, allow_pickle=False)
 
 
-def create_embeddings(synthesizer_root: Path, encoder_model_fpath: Path, n_processes: int):
+def create_embeddings(synthesizer_root: Path, encoder_model_fpath: Path, n_processes: int,
+                      embed_cache_dir: Path = None):
     wav_dir = synthesizer_root.joinpath("audio")
     metadata_fpath = synthesizer_root.joinpath("train.txt")
     assert wav_dir.exists() and metadata_fpath.exists()
@@ -252,7 +266,68 @@ def create_embeddings(synthesizer_root: Path, encoder_model_fpath: Path, n_proce
 
     # TODO: improve on the multiprocessing, it's terrible. Disk I/O is the bottleneck here.
     # Embed the utterances in separate threads
-    func = partial(embed_utterance, encoder_model_fpath=encoder_model_fpath)
+    func = partial(embed_utterance, encoder_model_fpath=encoder_model_fpath,
+                   embed_cache_dir=embed_cache_dir)
     job = Pool(n_processes).imap(func, fpaths)
     list(tqdm(job, "Embedding", len(fpaths), unit="utterances"))
 
+
+def compile_corpus(synthesizer_root: Path, hparams):
+    """
+    Compiles the training data of the synthesizer, once its embeddings are created, in a few
+    files in <synthesizer_root>/corpus that SynthesizerDataset reads by slicing rather than by
+    loading two files and cleaning a text per sample:
+        - mels.npy: the mel spectrograms of all samples concatenated, of shape
+        (n_frames, num_mels), with mel_offsets.npy giving the first frame of each and the end
+        - embeds.npy: the speaker embeddings, of shape (n_samples, speaker_embedding_size)
+        - tokens.npy: the int32 sequences of the cleaned texts concatenated, with
+        token_offsets.npy
+        - corpus.json: the number of samples, the text cleaners and the digests of the sources
+        (see synthesizer_dataset.corpus_sources()), so that a stale corpus is detected
+    The samples are those of train.txt with mel frames, in the same order.
+    """
+    metadata_fpath = synthesizer_root.joinpath("train.txt")
+    mel_dir = synthesizer_root.joinpath("mels")
+    embed_dir = synthesizer_root.joinpath("embeds")
+    assert metadata_fpath.exists() and mel_dir.exists() and embed_dir.exists()
+    corpus_dir = synthesizer_root.joinpath("corpus")
+    corpus_dir.mkdir(exist_ok=True)
+
+    with metadata_fpath.open("r", encoding="utf-8") as metadata_file:
+        metadata = [line.split("|") for line in metadata_file]
+    metadata = [m for m in metadata if int(m[4])]
+    sources = corpus_sources(metadata_fpath, mel_dir, embed_dir)
+
+    # The info file is removed first and written last, so that an incomplete corpus is not used
+    info_fpath = corpus_dir.joinpath("corpus.json")
+    if info_fpath.exists():
+        info_fpath.unlink()
+
+    mel_offsets = np.concatenate([[0], np.cumsum([int(m[4]) for m in metadata])])
+    mels = np.lib.format.open_memmap(corpus_dir.joinpath("mels.npy"), mode="w+", dtype=np.float32,
+                                     shape=(int(mel_offsets[-1]), hparams.num_mels))
+    embeds = np.lib.format.open_memmap(corpus_dir.joinpath("embeds.npy"), mode="w+",
+                                       dtype=np.float32,
+                                       shape=(len(metadata), hparams.speaker_embedding_size))
+    tokens = []
+    for i, m in enumerate(tqdm(metadata, "Compiling", unit="utterances")):
+        mel = np.load(mel_dir.joinpath(m[1]))
+        if len(mel) != mel_offsets[i + 1] - mel_offsets[i]:
+            raise Exception("The length of %s does not match train.txt" % m[1])
+        mels[mel_offsets[i]:mel_offsets[i + 1]] = mel
+        embeds[i] = np.load(embed_dir.joinpath(m[2]))
+        tokens.append(np.asarray(text_to_sequence(m[5].strip(), hparams.tts_cleaner_names),
+                                 dtype=np.int32))
+    mels.flush()
+    embeds.flush()
+    del mels, embeds
+
+    np.save(corpus_dir.joinpath("mel_offsets.npy"), mel_offsets.astype(np.int64))
+    np.save(corpus_dir.joinpath("tokens.npy"), np.concatenate(tokens))
+    token_offsets = np.concatenate([[0], np.cumsum([len(t) for t in tokens])])
+    np.save(corpus_dir.joinpath("token_offsets.npy"), token_offsets.astype(np.int64))
+    info = {"n_samples": len(metadata), "cleaner_names": hparams.tts_cleaner_names,
+            **sources}
+    with info_fpath.open("w") as info_file:
+        json.dump(info, info_file)
+    print("Compiled %d samples in %s" % (len(metadata), corpus_dir))
@@ -61,7 +61,11 @@ def run_synthesis(in_dir: Path, out_dir: Path, syn_model_fpath: Path, hparams):
     mel_dir = in_dir.joinpath("mels")
     embed_dir = in_dir.joinpath("embeds")
 
-    dataset = SynthesizerDataset(metadata_fpath, mel_dir, embed_dir, hparams)
+    corpus_dir = in_dir.joinpath("corpus")
+    if not corpus_dir.joinpath("corpus.json").exists():
+        print("No compiled corpus found, synthesizer_compile_corpus.py would speed up loading.")
+        corpus_dir = None
+    dataset = SynthesizerDataset(metadata_fpath, mel_dir, embed_dir, hparams, corpus_dir)
     collate_fn = partial(collate_synthesizer, r=r, hparams=hparams)
     data_loader = DataLoader(dataset, hparams.synthesis_batch_size, collate_fn=collate_fn, num_workers=2)
 
@@ -1,13 +1,27 @@
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import numpy as np
 from pathlib import Path
 from synthesizer.utils.text import text_to_sequence
+import hashlib
+import json
+import os
 
 
 class SynthesizerDataset(Dataset):
-    def __init__(self, metadata_fpath: Path, mel_dir: Path, embed_dir: Path, hparams):
-        print("Using inputs from:\n\t%s\n\t%s\n\t%s" % (metadata_fpath, mel_dir, embed_dir))
+    def __init__(self, metadata_fpath: Path, mel_dir: Path, embed_dir: Path, hparams,
+                 corpus_dir: Path = None, check_corpus_files=False):
+        """
+        :param corpus_dir: if given, the samples are read from the corpus compiled there by
+        synthesizer.preprocess.compile_corpus() instead of from mel_dir and embed_dir.
+        :param check_corpus_files: if True, the corpus is also checked against the size and the
+        modification time of the mel and embedding files it was compiled from, which lists every
+        file. Otherwise, only train.txt is checked, and the files aren't needed.
+        """
+        if corpus_dir is None:
+            print("Using inputs from:\n\t%s\n\t%s\n\t%s" % (metadata_fpath, mel_dir, embed_dir))
+        else:
+            print("Using inputs from:\n\t%s\n\t%s" % (metadata_fpath, corpus_dir))
         
         with metadata_fpath.open("r") as metadata_file:
             metadata = [line.split("|") for line in metadata_file]
@@ -18,17 +32,32 @@ class SynthesizerDataset(Dataset):
         embed_fpaths = [embed_dir.joinpath(fname) for fname in embed_fnames]
         self.samples_fpaths = list(zip(mel_fpaths, embed_fpaths))
         self.samples_texts = [x[5].strip() for x in metadata if int(x[4])]
+        self.samples_mel_lens = [int(x[4]) for x in metadata if int(x[4])]
         self.metadata = metadata
         self.hparams = hparams
+        self.corpus_dir = corpus_dir
+        self._corpus = None
+        if corpus_dir is not None:
+            _check_corpus(corpus_dir, len(self.samples_fpaths), hparams,
+                          corpus_sources(metadata_fpath, mel_dir, embed_dir, check_corpus_files))
         
         print("Found %d samples" % len(self.samples_fpaths))
     
     def __getitem__(self, index):  
         # Sometimes index may be a list of 2 (not sure why this happens)
         # If that is the case, return a single item corresponding to first element in index
-        if index is list:
+        if isinstance(index, list):
             index = index[0]
 
+        # The compiled corpus is sliced, without copies
+        if self.corpus_dir is not None:
+            if self._corpus is None:
+                self._corpus = _open_corpus(self.corpus_dir)
+            mels, mel_offsets, embeds, tokens, token_offsets = self._corpus
+            mel = mels[mel_offsets[index]:mel_offsets[index + 1]].T
+            text = tokens[token_offsets[index]:token_offsets[index + 1]]
+            return text, mel, embeds[index], index
+
         mel_path, embed_path = self.samples_fpaths[index]
         mel = np.load(mel_path).T.astype(np.float32)
         
@@ -46,6 +75,101 @@ class SynthesizerDataset(Dataset):
     def __len__(self):
         return len(self.samples_fpaths)
 
+    def __getstate__(self):
+        # Each DataLoader worker maps the corpus itself, rather than receiving a copy of its data
+        state = self.__dict__.copy()
+        state["_corpus"] = None
+        return state
+
+
+def corpus_sources(metadata_fpath: Path, mel_dir: Path, embed_dir: Path, files=True):
+    """
+    Digests the sources of a compiled corpus: the content of train.txt, and the size and the
+    modification time of the mel and embedding files of its samples. A corpus whose sources
+    changed since it was compiled is stale.
+
+    :param files: if False, only train.txt is digested, without listing the mel and embedding
+    files
+    :return: a dict of the digests of train.txt and, with files, of the mels and of the
+    embeddings
+    """
+    metadata_bytes = Path(metadata_fpath).read_bytes()
+    if not files:
+        return {"train_digest": hashlib.sha1(metadata_bytes).hexdigest()}
+    metadata = [line.split("|") for line in metadata_bytes.decode("utf-8").splitlines()]
+    metadata = [m for m in metadata if int(m[4])]
+
+    def files_digest(directory: Path, fnames):
+        h = hashlib.sha1()
+        for fname in fnames:
+            stat = os.stat(directory.joinpath(fname))
+            h.update(("%s|%d|%d\n" % (fname, stat.st_size, stat.st_mtime_ns)).encode())
+        return h.hexdigest()
+
+    return {
+        "train_digest": hashlib.sha1(metadata_bytes).hexdigest(),
+        "mels_digest": files_digest(Path(mel_dir), [m[1] for m in metadata]),
+        "embeds_digest": files_digest(Path(embed_dir), [m[2] for m in metadata]),
+    }
+
+
+def _check_corpus(corpus_dir: Path, n_samples: int, hparams, sources: dict):
+    with corpus_dir.joinpath("corpus.json").open("r") as info_file:
+        info = json.load(info_file)
+    if info["n_samples"] != n_samples or info["cleaner_names"] != hparams.tts_cleaner_names:
+        raise Exception("The corpus in %s does not match train.txt or the text cleaners of the "
+                        "hparams, compile it again with synthesizer_compile_corpus.py." % corpus_dir)
+    sources_names = {"train_digest": "train.txt", "mels_digest": "the mels",
+                     "embeds_digest": "the embeddings"}
+    changed = [name for key, name in sources_names.items() if key in sources and
+               info.get(key) != sources[key]]
+    if changed:
+        raise Exception("The corpus in %s is stale, %s changed since it was compiled. Compile it "
+                        "again with synthesizer_compile_corpus.py." % (corpus_dir,
+                                                                       ", ".join(changed)))
+
+
+def _open_corpus(corpus_dir: Path):
+    # The mels and embeddings are mapped in memory, the offsets and tokens are small
+    load = lambda fname, mmap_mode=None: np.load(corpus_dir.joinpath(fname), mmap_mode)
+    return (load("mels.npy", "r"), load("mel_offsets.npy"), load("embeds.npy", "r"),
+            load("tokens.npy"), load("token_offsets.npy"))
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batches samples of similar mel lengths together, so that the batches are padded less and
+    the decoder runs fewer steps over padding. Each epoch, the samples are shuffled and split
+    into buckets of <bucket_batches> batches. The samples of each bucket are sorted by length and
+    batched, and the batches of all buckets are shuffled. Both the composition and the order of
+    the batches thus change from one epoch to the next.
+    """
+    def __init__(self, mel_lens, batch_size: int, bucket_batches: int):
+        """
+        :param mel_lens: the number of mel frames of each sample of the dataset
+        :param batch_size: the number of samples per batch
+        :param bucket_batches: the number of batches per bucket. The larger it is, the closer
+        the lengths of the samples of a batch, and the less random the batches.
+        """
+        self.mel_lens = np.asarray(mel_lens)
+        self.batch_size = batch_size
+        self.bucket_batches = bucket_batches
+
+    def __iter__(self):
+        indices = np.random.permutation(len(self.mel_lens))
+        bucket_size = self.batch_size * self.bucket_batches
+        batches = []
+        for start in range(0, len(indices), bucket_size):
+            bucket = indices[start:start + bucket_size]
+            bucket = bucket[np.argsort(self.mel_lens[bucket], kind="stable")]
+            batches.extend(bucket[i:i + self.batch_size] for i in
+                           range(0, len(bucket), self.batch_size))
+        for i in np.random.permutation(len(batches)):
+            yield batches[i].tolist()
+
+    def __len__(self):
+        return int(np.ceil(len(self.mel_lens) / self.batch_size))
+
 
 def collate_synthesizer(batch, r, hparams):
     # Text
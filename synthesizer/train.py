@@ -9,11 +9,13 @@ from torch.utils.data import DataLoader
 
 from synthesizer import audio
 from synthesizer.models.tacotron import Tacotron
-from synthesizer.synthesizer_dataset import SynthesizerDataset, collate_synthesizer
+from synthesizer.synthesizer_dataset import SynthesizerDataset, LengthBucketBatchSampler, \
+    collate_synthesizer
 from synthesizer.utils import ValueWindow, data_parallel_workaround
 from synthesizer.utils.plot import plot_spectrogram
 from synthesizer.utils.symbols import symbols
 from synthesizer.utils.text import sequence_to_text
+from utils.checkpoint_writer import CheckpointWriter
 from vocoder.display import *
 
 
@@ -25,7 +27,7 @@ def time_string():
 
 
 def train(run_id: str, syn_dir: Path, models_dir: Path, save_every: int,  backup_every: int, force_restart: bool,
-          hparams):
+          hparams, keep_backups=0, check_corpus=False):
     models_dir.mkdir(exist_ok=True)
 
     model_dir = models_dir.joinpath(run_id)
@@ -82,10 +84,13 @@ def train(run_id: str, syn_dir: Path, models_dir: Path, save_every: int,  backup
     # Initialize the optimizer
     optimizer = optim.Adam(model.parameters())
 
+    # The model is saved from a background thread
+    writer = CheckpointWriter(keep_backups)
+
     # Load the weights
     if force_restart or not weights_fpath.exists():
         print("\nStarting the training of Tacotron from scratch\n")
-        model.save(weights_fpath)
+        model.save(weights_fpath, writer=writer)
 
         # Embeddings metadata
         char_embedding_fpath = meta_folder.joinpath("CharacterEmbeddings.tsv")
@@ -105,7 +110,12 @@ def train(run_id: str, syn_dir: Path, models_dir: Path, save_every: int,  backup
     metadata_fpath = syn_dir.joinpath("train.txt")
     mel_dir = syn_dir.joinpath("mels")
     embed_dir = syn_dir.joinpath("embeds")
-    dataset = SynthesizerDataset(metadata_fpath, mel_dir, embed_dir, hparams)
+    corpus_dir = syn_dir.joinpath("corpus")
+    if not corpus_dir.joinpath("corpus.json").exists():
+        print("No compiled corpus found, synthesizer_compile_corpus.py would speed up loading.")
+        corpus_dir = None
+    dataset = SynthesizerDataset(metadata_fpath, mel_dir, embed_dir, hparams, corpus_dir,
+                                 check_corpus)
 
     for i, session in enumerate(hparams.tts_schedule):
         current_step = model.get_step()
@@ -119,7 +129,8 @@ def train(run_id: str, syn_dir: Path, models_dir: Path, save_every: int,  backup
             # Are there no further sessions than the current one?
             if i == len(hparams.tts_schedule) - 1:
                 # We have completed training. Save the model and exit
-                model.save(weights_fpath, optimizer)
+                model.save(weights_fpath, optimizer, writer)
+                writer.wait()
                 break
             else:
                 # There is a following session, go to it
@@ -137,15 +148,26 @@ def train(run_id: str, syn_dir: Path, models_dir: Path, save_every: int,  backup
             p["lr"] = lr
 
         collate_fn = partial(collate_synthesizer, r=r, hparams=hparams)
-        data_loader = DataLoader(dataset, batch_size, shuffle=True, num_workers=2, collate_fn=collate_fn)
+        if hparams.tts_bucket_batches:
+            batch_sampler = LengthBucketBatchSampler(dataset.samples_mel_lens, batch_size,
+                                                     hparams.tts_bucket_batches)
+            data_loader = DataLoader(dataset, batch_sampler=batch_sampler, num_workers=2,
+                                     collate_fn=collate_fn)
+        else:
+            data_loader = DataLoader(dataset, batch_size, shuffle=True, num_workers=2, collate_fn=collate_fn)
 
         total_iters = len(dataset)
         steps_per_epoch = np.ceil(total_iters / batch_size).astype(np.int32)
         epochs = np.ceil(training_steps / steps_per_epoch).astype(np.int32)
 
         for epoch in range(1, epochs+1):
+            # Mel frames of the samples and of the padded batches, i.e. decoder steps * r
+            mel_frames, padded_frames = 0, 0
+
             for i, (texts, mels, embeds, idx) in enumerate(data_loader, 1):
                 start_time = time.time()
+                mel_frames += sum(dataset.samples_mel_lens[k] for k in idx)
+                padded_frames += mels.shape[0] * mels.shape[2]
 
                 # Generate stop tokens for training
                 stop = torch.ones(mels.shape[0], mels.shape[2])
@@ -194,12 +216,14 @@ def train(run_id: str, syn_dir: Path, models_dir: Path, save_every: int,  backup
                 # Backup or save model as appropriate
                 if backup_every != 0 and step % backup_every == 0 :
                     backup_fpath = weights_fpath.parent / f"synthesizer_{k:06d}.pt"
-                    model.save(backup_fpath, optimizer)
+                    stall = model.save(backup_fpath, optimizer, writer, "synthesizer_*.pt")
+                    print("\nMade a backup (step %d), training stalled %dms" % (step, stall * 1000))
 
                 if save_every != 0 and step % save_every == 0 :
                     # Must save latest optimizer state to ensure that resuming training
                     # doesn't produce artifacts
-                    model.save(weights_fpath, optimizer)
+                    stall = model.save(weights_fpath, optimizer, writer)
+                    print("\nSaved the model (step %d), training stalled %dms" % (step, stall * 1000))
 
                 # Evaluate model to generate samples
                 epoch_eval = hparams.tts_eval_interval == -1 and i == steps_per_epoch  # If epoch is done
@@ -231,7 +255,8 @@ def train(run_id: str, syn_dir: Path, models_dir: Path, save_every: int,  backup
                     break
 
             # Add line break after every epoch
-            print("")
+            print("\nPadding: %.1f%% of the mel frames of the epoch" %
+                  (100 * (1 - mel_frames / max(padded_frames, 1))))
 
 
 def eval_model(attention, mel_prediction, target_spectrogram, input_seq, step,
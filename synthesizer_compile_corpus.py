@@ -0,0 +1,38 @@
+from synthesizer.hparams import hparams
+from synthesizer.preprocess import compile_corpus
+from synthesizer.synthesizer_dataset import SynthesizerDataset
+from utils.argutils import print_args
+from pathlib import Path
+import argparse
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compiles the mel spectrograms, embeddings and texts of the synthesizer "
+                    "training data in a few files, which synthesizer_train.py and "
+                    "vocoder_preprocess.py then read much faster. Run it after "
+                    "synthesizer_preprocess_embeds.py.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("synthesizer_root", type=Path, help=\
+        "Path to the synthesizer training data that contains the mels, the embeds and the "
+        "train.txt file. If you let everything as default, it should be "
+        "<datasets_root>/SV2TTS/synthesizer/.")
+    parser.add_argument("--check", action="store_true", help=\
+        "Only check that the corpus compiled in synthesizer_root is up to date with train.txt and "
+        "with the size and the modification time of every mel and embedding file, without "
+        "compiling it.")
+    parser.add_argument("--hparams", type=str, default="", help=\
+        "Hyperparameter overrides as a comma-separated list of name=value pairs")
+    args = parser.parse_args()
+
+    print_args(args, parser)
+    hparams = hparams.parse(args.hparams)
+    if args.check:
+        # Raises if the corpus is stale
+        root = args.synthesizer_root
+        SynthesizerDataset(root.joinpath("train.txt"), root.joinpath("mels"),
+                           root.joinpath("embeds"), hparams, root.joinpath("corpus"), True)
+        print("The corpus is up to date.")
+    else:
+        compile_corpus(args.synthesizer_root, hparams)
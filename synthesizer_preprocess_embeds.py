@@ -6,7 +6,8 @@ import argparse
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
-        description="Creates embeddings for the synthesizer from the LibriSpeech utterances.",
+        description="Creates embeddings for the synthesizer from the LibriSpeech utterances. Then "
+                    "run synthesizer_compile_corpus.py to speed up the loading of the data.",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
     parser.add_argument("synthesizer_root", type=Path, help=\
@@ -18,6 +19,9 @@ if __name__ == "__main__":
     parser.add_argument("-n", "--n_processes", type=int, default=4, help= \
         "Number of parallel processes. An encoder is created for each, so you may need to lower "
         "this value on GPUs with low memory. Set it to 1 if CUDA is unhappy.")
+    parser.add_argument("-c", "--embed_cache_dir", type=Path, default=None, help=\
+        "Optional directory of a cache of embeddings shared with the toolbox and demo_cli.py. "
+        "Utterances already embedded with the same encoder are not embedded again.")
     args = parser.parse_args()
 
     # Preprocess the dataset
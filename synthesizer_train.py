@@ -23,6 +23,12 @@ if __name__ == "__main__":
     parser.add_argument("-b", "--backup_every", type=int, default=25000, help= \
         "Number of steps between backups of the model. Set to 0 to never make backups of the "
         "model.")
+    parser.add_argument("--keep_backups", type=int, default=0, help= \
+        "Number of most recent backups to keep, the older ones are deleted. Set to 0 to keep all "
+        "backups.")
+    parser.add_argument("--check_corpus", action="store_true", help= \
+        "Check that the compiled corpus is up to date with the size and the modification time of "
+        "every mel and embedding file, rather than only with train.txt.")
     parser.add_argument("-f", "--force_restart", action="store_true", help= \
         "Do not load any saved model and restart from scratch.")
     parser.add_argument("--hparams", default="", help=\
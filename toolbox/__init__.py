@@ -7,6 +7,8 @@ import numpy as np
 import torch
 
 from encoder import inference as encoder
+from encoder.embedding_cache import EmbeddingCache
+from synthesizer.encoder_output_cache import EncoderOutputCache
 from synthesizer.inference import Synthesizer
 from toolbox.ui import UI
 from toolbox.utterance import Utterance
@@ -42,13 +44,19 @@ MAX_WAVS = 15
 
 
 class Toolbox:
-    def __init__(self, datasets_root: Path, models_dir: Path, seed: int=None):
+    def __init__(self, datasets_root: Path, models_dir: Path, seed: int=None,
+                 embed_cache_dir: Path=None):
         sys.excepthook = self.excepthook
         self.datasets_root = datasets_root
+        self.embed_cache_dir = embed_cache_dir
+        self.embed_cache = None # type: EmbeddingCache
         self.utterances = set()
         self.current_generated = (None, None, None, None) # speaker_name, spec, breaks, wav
 
         self.synthesizer = None # type: Synthesizer
+        # Kept across the reloads of the synthesizer, so that synthesizing the same prompt again
+        # with the same seed only runs the decoder. Only used with a seed, see init_synthesizer()
+        self.synthesizer_cache = EncoderOutputCache()
         self.current_wav = None
         self.waves_list = []
         self.waves_count = 0
@@ -174,11 +182,17 @@ class Toolbox:
         spec = Synthesizer.make_spectrogram(wav)
         self.ui.draw_spec(spec, "current")
 
-        # Compute the embedding
+        # Compute the embedding, unless it is in the cache
         if not encoder.is_loaded():
             self.init_encoder()
-        encoder_wav = encoder.preprocess_wav(wav)
-        embed, partial_embeds, _ = encoder.embed_utterance(encoder_wav, return_partials=True)
+        embed = self.embed_cache.get(wav) if self.embed_cache is not None else None
+        if embed is not None:
+            partial_embeds = None
+        else:
+            encoder_wav = encoder.preprocess_wav(wav)
+            embed, partial_embeds, _ = encoder.embed_utterance(encoder_wav, return_partials=True)
+            if self.embed_cache is not None:
+                self.embed_cache.put(wav, embed)
 
         # Add the utterance
         utterance = Utterance(name, speaker_name, wav, spec, embed, partial_embeds, False)
@@ -209,7 +223,10 @@ class Toolbox:
 
         # Synthesize the spectrogram
         if self.synthesizer is None or seed is not None:
-            self.init_synthesizer()
+            self.init_synthesizer(use_cache=seed is not None)
+        else:
+            # Without a seed, the encoder outputs are never reused
+            self.synthesizer.cache = None
 
         texts = self.ui.text_prompt.toPlainText().split("\n")
         embed = self.ui.selected_utterance.embed
@@ -317,16 +334,20 @@ class Toolbox:
         self.ui.set_loading(1)
         start = timer()
         encoder.load_model(model_fpath)
+        if self.embed_cache_dir is not None:
+            self.embed_cache = EmbeddingCache(self.embed_cache_dir, model_fpath)
         self.ui.log("Done (%dms)." % int(1000 * (timer() - start)), "append")
         self.ui.set_loading(0)
 
-    def init_synthesizer(self):
+    def init_synthesizer(self, use_cache=False):
         model_fpath = self.ui.current_synthesizer_fpath
+        # The encoder outputs can only be reused after seeding, see EncoderOutputCache
+        cache = self.synthesizer_cache if use_cache else None
 
         self.ui.log("Loading the synthesizer %s... " % model_fpath)
         self.ui.set_loading(1)
         start = timer()
-        self.synthesizer = Synthesizer(model_fpath)
+        self.synthesizer = Synthesizer(model_fpath, cache=cache)
         self.ui.log("Done (%dms)." % int(1000 * (timer() - start)), "append")
         self.ui.set_loading(0)
 
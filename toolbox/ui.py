@@ -8,13 +8,13 @@ import matplotlib.pyplot as plt
 import numpy as np
 import sounddevice as sd
 import soundfile as sf
-import umap
-from PyQt5.QtCore import Qt, QStringListModel
+from PyQt5.QtCore import Qt, QStringListModel, pyqtSignal
 from PyQt5.QtWidgets import *
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 
 from encoder.inference import plot_embedding_as_heatmap
 from toolbox.utterance import Utterance
+from utils.projections import ProjectionService
 
 filterwarnings("ignore")
 
@@ -55,6 +55,9 @@ class UI(QDialog):
     max_log_lines = 5
     max_saved_utterances = 20
 
+    # Emitted from the thread of the projection service, received in the thread of the UI
+    projections_done = pyqtSignal(object, object, str)
+
     def draw_utterance(self, utterance: Utterance, which):
         self.draw_spec(utterance.spec, which)
         self.draw_embed(utterance.embed, utterance.name, which)
@@ -95,11 +98,30 @@ class UI(QDialog):
             self.vocode_button.setDisabled(spec is None)
 
     def draw_umap_projections(self, utterances: Set[Utterance]):
+        # Projections that finish after more recent ones were requested are not drawn
+        utterances = list(utterances)
+        self._projected_utterances = utterances
+
+        # Display a message if there aren't enough points
+        if len(utterances) < self.min_umap_points:
+            self._draw_projections(utterances, None, "")
+            return
+
+        # Compute the projections in the background, they are drawn once done
+        if not self.umap_hot and len(utterances) >= self.projections.min_umap_points:
+            self.log("Drawing UMAP projections for the first time, this will take a few seconds.")
+            self.umap_hot = True
+        callback = lambda projections, method: self.projections_done.emit(utterances, projections,
+                                                                          method)
+        self.projections.project_async([u.embed for u in utterances], callback)
+
+    def _draw_projections(self, utterances: List[Utterance], projections, method):
+        if utterances is not self._projected_utterances:
+            return
         self.umap_ax.clear()
 
         speakers = np.unique([u.speaker_name for u in utterances])
         colors = {speaker_name: colormap[i] for i, speaker_name in enumerate(speakers)}
-        embeds = [u.embed for u in utterances]
 
         # Display a message if there aren't enough points
         if len(utterances) < self.min_umap_points:
@@ -108,16 +130,8 @@ class UI(QDialog):
                               horizontalalignment='center', fontsize=15)
             self.umap_ax.set_title("")
 
-        # Compute the projections
+        # Draw the projections
         else:
-            if not self.umap_hot:
-                self.log(
-                    "Drawing UMAP projections for the first time, this will take a few seconds.")
-                self.umap_hot = True
-
-            reducer = umap.UMAP(int(np.ceil(np.sqrt(len(embeds)))), metric="cosine")
-            projections = reducer.fit_transform(embeds)
-
             speakers_done = set()
             for projection, utterance in zip(projections, utterances):
                 color = colors[utterance.speaker_name]
@@ -456,6 +470,9 @@ class UI(QDialog):
         fig.subplots_adjust(left=0.02, bottom=0.02, right=0.98, top=0.98)
         self.projections_layout.addWidget(FigureCanvas(fig))
         self.umap_hot = False
+        self.projections = ProjectionService()
+        self.projections_done.connect(self._draw_projections)
+        self._projected_utterances = []
         self.clear_button = QPushButton("Clear")
         self.projections_layout.addWidget(self.clear_button)
 
@@ -0,0 +1,106 @@
+from time import perf_counter as timer
+from threading import Thread
+from queue import Queue
+from pathlib import Path
+import atexit
+import torch
+import os
+
+
+def snapshot(obj):
+    """
+    Copies the tensors of a checkpoint (e.g. state dicts, possibly nested in dicts, lists and
+    tuples) to the CPU. Tensors already on the CPU are cloned, so that the snapshot is not
+    modified by the training that continues while it is written.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().clone() if obj.device.type == "cpu" else obj.detach().cpu()
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+class CheckpointWriter:
+    """
+    Saves checkpoints from a background thread, so that the training only stalls for the time
+    of copying them to the CPU. Each checkpoint is written to a temporary file that is then
+    renamed, so that an interrupted save never leaves a corrupt checkpoint in place of the
+    previous one. The checkpoints pending when the program exits are written before it does.
+    """
+    def __init__(self, keep_backups=0, max_pending=1):
+        """
+        :param keep_backups: if not 0, the number of most recent backups kept by save() with a
+        retention_glob, the older ones are deleted.
+        :param max_pending: the number of checkpoints that can wait to be written. When it is
+        reached, save() blocks until the oldest is written.
+        """
+        self.keep_backups = keep_backups
+        self.stall_duration = 0
+        self.write_duration = 0
+        self.n_saves = 0
+        self._queue = Queue(max_pending)
+        self._error = None
+        self._thread = Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def save(self, checkpoint: dict, fpath: Path, retention_glob: str = None):
+        """
+        Snapshots a checkpoint to the CPU and queues it to be written with torch.save().
+
+        :param checkpoint: the object to save, e.g. a dict of state dicts
+        :param fpath: the path of the checkpoint
+        :param retention_glob: a pattern of the backups of which the checkpoint is one, in its
+        directory, e.g. "encoder_*.bak". Once it is written, only the <keep_backups> most recent
+        files matching the pattern are kept.
+        :return: the duration in seconds the caller was stalled
+        """
+        self._raise_error()
+        start = timer()
+        self._queue.put((snapshot(checkpoint), Path(fpath), retention_glob))
+        stall = timer() - start
+        self.stall_duration += stall
+        self.n_saves += 1
+        return stall
+
+    def wait(self):
+        """
+        Blocks until all checkpoints queued are written.
+        """
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise Exception("Failed to write a checkpoint") from error
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            checkpoint, fpath, retention_glob = item
+            try:
+                start = timer()
+                tmp_fpath = fpath.with_name(fpath.name + ".tmp")
+                torch.save(checkpoint, str(tmp_fpath))
+                os.replace(tmp_fpath, fpath)
+                self.write_duration += timer() - start
+                if retention_glob is not None and self.keep_backups:
+                    backups = sorted(fpath.parent.glob(retention_glob), key=os.path.getmtime)
+                    for backup_fpath in backups[:-self.keep_backups]:
+                        backup_fpath.unlink()
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,123 @@
+from threading import Thread, Condition, Lock
+import traceback
+import numpy as np
+
+
+def pca_projections(embeds: np.ndarray):
+    """
+    Projects embeddings on their first two principal components. This is much faster than UMAP
+    and more stable on a handful of points.
+
+    :param embeds: the embeddings as an array of shape (n_points, embedding_size)
+    :return: the projections as an array of shape (n_points, 2)
+    """
+    centered = embeds - embeds.mean(axis=0)
+    _, _, components = np.linalg.svd(centered, full_matrices=False)
+    projections = centered @ components[:2].T
+    return np.pad(projections, ((0, 0), (0, 2 - projections.shape[1])))
+
+
+class ProjectionService:
+    """
+    Projects embeddings in 2D with UMAP, reusing the previous fit when the embeddings mostly
+    stay the same. The fitted reducer and the projections of its points are cached: points
+    added since the fit are projected with transform(), and the reducer is refit once more than
+    <refit_ratio> of the points have been added or removed. Sets of fewer than
+    <min_umap_points> points are projected with PCA instead.
+
+    Projecting with project_async() runs in a background thread, so that it never blocks the
+    UI or the training.
+    """
+    def __init__(self, n_neighbors=None, metric="cosine", min_umap_points=16, refit_ratio=0.25):
+        """
+        :param n_neighbors: the n_neighbors of UMAP. If None, the square root of the number of
+        points fit.
+        :param metric: the metric of UMAP
+        :param min_umap_points: the number of points from which UMAP is used rather than PCA
+        :param refit_ratio: the proportion of points of the fit that can be added or removed
+        before the reducer is fit again
+        """
+        self.n_neighbors = n_neighbors
+        self.metric = metric
+        self.min_umap_points = min_umap_points
+        self.refit_ratio = refit_ratio
+
+        # Projections by embedding of the points of the current fit still used and those added
+        # since, and the number of points added and removed since the fit
+        self._reducer = None
+        self._projections = {}
+        self._n_fitted = 0
+        self._n_transformed = 0
+        self._n_removed = 0
+        self._lock = Lock()
+
+        self._condition = Condition()
+        self._request = None
+        self._thread = None
+
+    def project(self, embeds):
+        """
+        Projects embeddings in 2D, blocking until done.
+
+        :param embeds: the embeddings as an array of shape (n_points, embedding_size)
+        :return: a tuple (projections, method), with the projections as an array of shape
+        (n_points, 2) and method either "umap" or "pca"
+        """
+        embeds = np.asarray(embeds, dtype=np.float32).reshape(len(embeds), -1)
+        if len(embeds) < self.min_umap_points:
+            return pca_projections(embeds), "pca"
+
+        with self._lock:
+            keys = [embed.tobytes() for embed in embeds]
+            new_keys = set(keys) - self._projections.keys()
+            new_idx = [keys.index(key) for key in new_keys]
+            removed_keys = self._projections.keys() - set(keys)
+            n_changed = self._n_transformed + self._n_removed + len(new_keys) + \
+                        len(removed_keys)
+            if self._reducer is None or n_changed > self.refit_ratio * self._n_fitted:
+                self._fit(embeds, keys)
+            else:
+                # The projections of the points no longer used are dropped
+                for key in removed_keys:
+                    del self._projections[key]
+                self._n_removed += len(removed_keys)
+                if len(new_idx) > 0:
+                    new_projections = self._reducer.transform(embeds[new_idx])
+                    self._projections.update(zip([keys[i] for i in new_idx], new_projections))
+                    self._n_transformed += len(new_idx)
+            return np.array([self._projections[key] for key in keys]), "umap"
+
+    def _fit(self, embeds, keys):
+        # Imported here, as importing umap takes seconds
+        import umap
+
+        n_neighbors = self.n_neighbors or int(np.ceil(np.sqrt(len(embeds))))
+        self._reducer = umap.UMAP(n_neighbors, metric=self.metric)
+        self._projections = dict(zip(keys, self._reducer.fit_transform(embeds)))
+        self._n_fitted = len(self._projections)
+        self._n_transformed = 0
+        self._n_removed = 0
+
+    def project_async(self, embeds, callback):
+        """
+        Projects embeddings in 2D in a background thread, then calls callback(projections,
+        method) from that thread (see project()). If the thread is busy, the projections are
+        computed once it is done, unless a newer call replaces them.
+        """
+        with self._condition:
+            self._request = (embeds, callback)
+            self._condition.notify()
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._request is None:
+                    self._condition.wait()
+                (embeds, callback), self._request = self._request, None
+            try:
+                callback(*self.project(embeds))
+            except Exception:
+                traceback.print_exc()
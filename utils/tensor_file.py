@@ -0,0 +1,75 @@
+from pathlib import Path
+from typing import Dict
+import numpy as np
+import torch
+import json
+
+
+# Data types of the safetensors format
+_dtypes = {
+    "F64": np.float64,
+    "F32": np.float32,
+    "F16": np.float16,
+    "I64": np.int64,
+    "I32": np.int32,
+    "I16": np.int16,
+    "I8": np.int8,
+    "U8": np.uint8,
+    "BOOL": np.bool_,
+}
+
+
+def save_tensors(tensors: Dict[str, torch.Tensor], fpath: Path, metadata: Dict[str, str] = None):
+    """
+    Saves tensors (e.g. the state dict of a model) to a flat file in the safetensors format: a
+    JSON header giving the name, data type, shape and offset of each tensor, followed by their
+    raw data. Unlike torch.save(), nothing needs to be unpickled to load them, and load_tensors()
+    maps the data in memory instead of reading it. The files can also be read with the
+    safetensors package.
+
+    :param tensors: the tensors by name. They are saved from the CPU.
+    :param fpath: the path of the file, conventionally with the .safetensors extension.
+    :param metadata: strings to store in the header, e.g. the training step.
+    """
+    names = {dtype: name for name, dtype in _dtypes.items()}
+    arrays = {name: tensor.detach().cpu().contiguous().numpy() for name, tensor in tensors.items()}
+
+    header = {"__metadata__": metadata or {}}
+    offset = 0
+    for name, array in arrays.items():
+        header[name] = {
+            "dtype": names[array.dtype.type],
+            "shape": list(array.shape),
+            "data_offsets": [offset, offset + array.nbytes],
+        }
+        offset += array.nbytes
+
+    # Pad the header with spaces so that the data is aligned on 8 bytes
+    header = json.dumps(header, separators=(",", ":")).encode()
+    header += b" " * (-len(header) % 8)
+    with Path(fpath).open("wb") as f:
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for array in arrays.values():
+            f.write(array.tobytes())
+
+
+def load_tensors(fpath: Path):
+    """
+    Loads the tensors saved by save_tensors(). The data is mapped in memory, so it is only read
+    from the disk as the tensors are used, and copied when they are written to.
+
+    :return: the tensors by name, on the CPU, and the metadata of the file
+    """
+    with Path(fpath).open("rb") as f:
+        header_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_size))
+    metadata = header.pop("__metadata__", {})
+
+    data = np.memmap(fpath, dtype=np.uint8, mode="c", offset=8 + header_size)
+    tensors = {}
+    for name, info in header.items():
+        start, end = info["data_offsets"]
+        array = data[start:end].view(_dtypes[info["dtype"]]).reshape(info["shape"])
+        tensors[name] = torch.from_numpy(array)
+    return tensors, metadata
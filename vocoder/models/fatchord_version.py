@@ -404,9 +404,10 @@ class WaveRNN(nn.Module):
     def get_step(self) :
         return self.step.data.item()
 
-    def checkpoint(self, model_dir, optimizer) :
+    def checkpoint(self, model_dir, optimizer, writer=None) :
         k_steps = self.get_step() // 1000
-        self.save(model_dir.joinpath("checkpoint_%dk_steps.pt" % k_steps), optimizer)
+        return self.save(model_dir.joinpath("checkpoint_%dk_steps.pt" % k_steps), optimizer, writer,
+                         "checkpoint_*k_steps.pt")
 
     def log(self, path, msg) :
         with open(path, 'a') as f:
@@ -421,11 +422,15 @@ class WaveRNN(nn.Module):
             # Backwards compatibility
             self.load_state_dict(checkpoint)
 
-    def save(self, path, optimizer) :
-        torch.save({
+    def save(self, path, optimizer, writer=None, retention_glob=None) :
+        # With a CheckpointWriter, the checkpoint is written from its background thread
+        checkpoint = {
             "model_state": self.state_dict(),
             "optimizer_state": optimizer.state_dict(),
-        }, path)
+        }
+        if writer is not None:
+            return writer.save(checkpoint, path, retention_glob)
+        torch.save(checkpoint, path)
 
     def num_params(self, print_out=True):
         parameters = filter(lambda p: p.requires_grad, self.parameters())
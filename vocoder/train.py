@@ -8,6 +8,7 @@ from torch import optim
 from torch.utils.data import DataLoader
 
 import vocoder.hparams as hp
+from utils.checkpoint_writer import CheckpointWriter
 from vocoder.display import stream, simple_table
 from vocoder.distribution import discretized_mix_logistic_loss
 from vocoder.gen_wavernn import gen_testset
@@ -16,7 +17,7 @@ from vocoder.vocoder_dataset import VocoderDataset, collate_vocoder
 
 
 def train(run_id: str, syn_dir: Path, voc_dir: Path, models_dir: Path, ground_truth: bool, save_every: int,
-          backup_every: int, force_restart: bool):
+          backup_every: int, force_restart: bool, keep_backups=0):
     # Check to make sure the hop length is correctly factorised
     assert np.cumprod(hp.voc_upsample_factors)[-1] == hp.hop_length
 
@@ -46,13 +47,14 @@ def train(run_id: str, syn_dir: Path, voc_dir: Path, models_dir: Path, ground_tr
         p["lr"] = hp.voc_lr
     loss_func = F.cross_entropy if model.mode == "RAW" else discretized_mix_logistic_loss
 
-    # Load the weights
+    # Load the weights. The model is saved from a background thread.
+    writer = CheckpointWriter(keep_backups)
     model_dir = models_dir / run_id
     model_dir.mkdir(exist_ok=True)
     weights_fpath = model_dir / "vocoder.pt"
     if force_restart or not weights_fpath.exists():
         print("\nStarting the training of WaveRNN from scratch\n")
-        model.save(weights_fpath, optimizer)
+        model.save(weights_fpath, optimizer, writer)
     else:
         print("\nLoading weights at %s" % weights_fpath)
         model.load(weights_fpath, optimizer)
@@ -102,10 +104,12 @@ def train(run_id: str, syn_dir: Path, voc_dir: Path, models_dir: Path, ground_tr
             k = step // 1000
 
             if backup_every != 0 and step % backup_every == 0 :
-                model.checkpoint(model_dir, optimizer)
+                stall = model.checkpoint(model_dir, optimizer, writer)
+                print("\nMade a backup (step %d), training stalled %dms" % (step, stall * 1000))
 
             if save_every != 0 and step % save_every == 0 :
-                model.save(weights_fpath, optimizer)
+                stall = model.save(weights_fpath, optimizer, writer)
+                print("\nSaved the model (step %d), training stalled %dms" % (step, stall * 1000))
 
             msg = f"| Epoch: {epoch} ({i}/{len(data_loader)}) | " \
                 f"Loss: {avg_loss:.4f} | {speed:.1f} " \